@@ -0,0 +1,178 @@
+"""
+Select the frames of an animation: frames are dropped evenly when there are more than the caps
+for the output size, so the work done for an animation is bounded whatever its number of frames.
+The Pillow engine reads the frames kept coalesced into full images, ImageMagick deletes the others
+once coalesced. The durations of the frames are read from the container, without decoding them.
+"""
+
+import logging
+
+from snappy.settings import (ANIMATION_MAX_FRAMES, ANIMATION_MAX_PIXELS, ANIMATION_THUMBNAIL_SIZE,
+                             ANIMATION_THUMBNAIL_MAX_FRAMES)
+
+LOG = logging.getLogger(__name__)
+
+#
+# the duration of the frames with no duration set, in milliseconds
+#
+DEFAULT_DURATION = 100
+
+#
+# the output formats which keep the frames of an animation, the others only keep the first one
+#
+ANIMATED_FMTS = ('gif', 'webp')
+
+
+def frame_limit(size):
+    """
+    Returns
+    -------
+    int
+        the maximum number of frames of an animation output at `size`
+    """
+    limit = ANIMATION_MAX_FRAMES
+    if max(size) <= ANIMATION_THUMBNAIL_SIZE:
+        limit = min(limit, ANIMATION_THUMBNAIL_MAX_FRAMES)
+    return max(1, min(limit, ANIMATION_MAX_PIXELS // (size[0] * size[1])))
+
+
+def decimate(count, limit):
+    """
+    Returns
+    -------
+    list
+        the indexes of the frames kept out of `count`, evenly spaced to keep at most `limit` of them
+    """
+    if count <= limit:
+        return list(range(count))
+    return [index * count // limit for index in range(limit)]
+
+
+def kept_frames(count, size, fmt):
+    """
+    Returns
+    -------
+    list
+        the indexes of the frames kept out of the `count` frames of an animation
+        output at `size` as `fmt`, see `frame_limit`
+    """
+    if fmt not in ANIMATED_FMTS:
+        return [0]
+    return decimate(count, frame_limit(size))
+
+
+def _skip_sub_blocks(data, pos):
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _gif_durations(data):
+    #
+    # the delay of a frame is in the graphic control extension before its image descriptor
+    #
+    flags, pos = data[10], 13
+    if flags & 0x80:
+        pos += 3 << ((flags & 0x07) + 1)
+    durations, delay = [], 0
+    while data[pos] != 0x3B:
+        if data[pos] == 0x21:
+            if data[pos + 1] == 0xF9:
+                delay = int.from_bytes(data[pos + 4:pos + 6], 'little') * 10
+            pos = _skip_sub_blocks(data, pos + 2)
+        elif data[pos] == 0x2C:
+            flags, pos = data[pos + 9], pos + 10
+            if flags & 0x80:
+                pos += 3 << ((flags & 0x07) + 1)
+            pos = _skip_sub_blocks(data, pos + 1)
+            durations.append(delay)
+            delay = 0
+        else:
+            return None
+    return durations
+
+
+def _webp_durations(data):
+    #
+    # the duration of a frame is in the header of its `ANMF` chunk
+    #
+    durations, pos = [], 12
+    while pos + 8 <= len(data):
+        size = int.from_bytes(data[pos + 4:pos + 8], 'little')
+        if data[pos:pos + 4] == b'ANMF':
+            durations.append(int.from_bytes(data[pos + 20:pos + 23], 'little'))
+        pos += 8 + size + (size & 1)
+    return durations
+
+
+def frame_durations(data):
+    """
+    Read the durations of the frames of the GIF or WebP image content `data`
+    Returns
+    -------
+    list
+        the duration of each frame in milliseconds, `DEFAULT_DURATION` when it is not set,
+        or None if `data` is not an animation it can read
+    """
+    try:
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            durations = _gif_durations(data)
+        elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            durations = _webp_durations(data)
+        else:
+            durations = None
+    except IndexError:
+        #
+        # the image is truncated
+        #
+        durations = None
+    if not durations:
+        return None
+    return [duration or DEFAULT_DURATION for duration in durations]
+
+
+def fold_durations(durations, kept):
+    """
+    Returns
+    -------
+    list
+        the durations of the frames in `kept`, the duration of a dropped frame being added
+        to the frame kept before it, so the animation keeps its speed
+    """
+    folded = []
+    kept = set(kept)
+    for index, duration in enumerate(durations):
+        if index in kept:
+            folded.append(duration)
+        elif folded:
+            folded[-1] += duration
+    return folded
+
+
+def coalesce(img, kept, durations=None):
+    """
+    Read the frames of the animation `img` whose indexes are in `kept`, the others before the last one
+    kept being only decoded to compose the next ones. The `durations` of the frames, as read by
+    `frame_durations`, are read from each frame when not given.
+    Returns
+    -------
+    tuple
+        the list of the kept frames, as full RGBA images, and the list of their durations, see `fold_durations`
+    """
+    known = durations is not None and len(durations) == img.n_frames
+    #
+    # the frames after the last one kept are only read for their duration, when it is not known
+    #
+    last = max(kept) if known else img.n_frames - 1
+    kept = set(kept)
+    frames, read_durations = [], []
+    for index in range(last + 1):
+        img.seek(index)
+        read_durations.append(img.info.get('duration') or DEFAULT_DURATION)
+        if index in kept:
+            #
+            # each frame is decoded over the previous ones, converting it gives the whole image
+            #
+            frames.append(img.convert('RGBA'))
+    LOG.debug('Read {} frames out of {}'.format(len(frames), img.n_frames))
+    return frames, fold_durations(durations if known else read_durations, kept)
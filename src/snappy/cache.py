@@ -0,0 +1,290 @@
+"""Caches for the source images and their renditions"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from snappy.s3 import get_s3_client
+from snappy.settings import (RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES, RENDITION_CACHE_BUCKET, RENDITION_CACHE_PREFIX,
+                             SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES)
+
+LOG = logging.getLogger(__name__)
+
+
+def canonical_ops(ops):
+    return json.dumps(ops, sort_keys=True, separators=(',', ':'))
+
+
+def rendition_key(s3_key, etag, ops):
+    """
+    Build the content addressed key of a rendition given the source `s3_key`,
+    its `etag` and the normalized operations `ops`
+    Returns
+    -------
+    str
+        the hex digest identifying the rendition
+    """
+    canonical = json.dumps([s3_key, etag, ops], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _ops_digest(ops):
+    return hashlib.sha256(canonical_ops(ops).encode()).hexdigest()[:16]
+
+
+def rendition_etag(source_etag, ops):
+    """
+    Build the strong ETag of a rendition from the `source_etag` and the normalized operations `ops`
+    Returns
+    -------
+    str
+        the quoted ETag, which is the source ETag itself when there are no operations
+    """
+    if not ops:
+        return source_etag
+    return '"{}-{}"'.format(source_etag.strip('"'), _ops_digest(ops))
+
+
+def source_etag(etag, ops):
+    """
+    Find the ETag of the source a rendition ETag was built from by `rendition_etag`
+    Returns
+    -------
+    str
+        the quoted source ETag or None if `etag` was not built for the operations `ops`
+    """
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        return None
+    if not ops:
+        return etag
+    source, _, digest = etag.strip('"').rpartition('-')
+    if not source or digest != _ops_digest(ops):
+        return None
+    return '"{}"'.format(source)
+
+
+class LocalCache(object):
+    """
+    Cache stored as files in `directory`, evicting the least recently used
+    entries once the total size goes above `max_bytes`.
+    Each entry can carry some metadata, which is kept in memory only.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        #
+        # pick up the entries left by a previous load of the module
+        # in the same container, oldest first
+        #
+        paths = (os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if not name.startswith('.'))
+        for path in sorted(paths, key=os.path.getmtime):
+            self._add(os.path.basename(path), os.path.getsize(path))
+        self._evict()
+
+    def _add(self, key, size, meta=None):
+        self._discard(key)
+        self.entries[key] = (size, meta)
+        self.size += size
+
+    def _discard(self, key):
+        if key in self.entries:
+            size, meta = self.entries.pop(key)
+            self.size -= size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, (size, meta) = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                LOG.warning('Cannot remove cache entry {}'.format(key))
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        bytes
+            the content of the cached entry or None if the entry is not cached
+        """
+        if key not in self.entries:
+            return None
+        try:
+            with open(self.path(key), 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            self._discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return data
+
+    def meta(self, key):
+        """
+        Returns
+        -------
+        object
+            the metadata stored along with the entry `key`
+        """
+        if key not in self.entries:
+            return None
+        return self.entries[key][1]
+
+    def put(self, key, data, meta=None):
+        """
+        Store `data` in the cache, along with its `meta` data
+        Returns
+        -------
+        bool
+            True if the entry was stored
+        """
+        size = len(data)
+        if size > self.max_bytes:
+            return False
+        #
+        # write to a hidden file first, so a partial entry is never read
+        #
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            LOG.exception('Cannot store cache entry {}'.format(key))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self._add(key, size, meta)
+        self._evict()
+        return True
+
+
+class MemoryCache(object):
+    """Cache kept in memory, evicting the least recently used entries above `max_entries`"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        object
+            the cached value or None if the entry is not cached
+        """
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class S3Cache(object):
+    """Cache stored as objects under `prefix` in the s3 `bucket`"""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        bytes
+            the content of the entry `key` or None if the entry is not cached
+        """
+        try:
+            s3_resp = get_s3_client().get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError:
+            return None
+        return s3_resp['Body'].read()
+
+    def put(self, key, data):
+        try:
+            get_s3_client().put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+        except ClientError:
+            LOG.exception('Cannot store rendition {} in s3'.format(key))
+
+
+class RenditionCache(object):
+    """Two tier cache with the `local` cache in front of an optional `remote` one"""
+
+    def __init__(self, local, remote=None):
+        self.local = local
+        self.remote = remote
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        bytes
+            the cached rendition or None if it is not cached
+        """
+        data = self.local.get(key)
+        if data is not None:
+            LOG.info('Rendition {} found in local cache'.format(key))
+            return data
+
+        if self.remote:
+            data = self.remote.get(key)
+            if data is not None:
+                LOG.info('Rendition {} found in s3 cache'.format(key))
+                self.local.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        self.local.put(key, data)
+        if self.remote:
+            self.remote.put(key, data)
+
+
+def rendition_cache():
+    """
+    Build the rendition cache configured in the settings
+    Returns
+    -------
+    RenditionCache
+        the cache or None if caching is disabled
+    """
+    if RENDITION_CACHE_MAX_BYTES <= 0:
+        return None
+    remote = None
+    if RENDITION_CACHE_BUCKET:
+        remote = S3Cache(RENDITION_CACHE_BUCKET, RENDITION_CACHE_PREFIX)
+    return RenditionCache(LocalCache(RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES), remote)
+
+
+def source_cache():
+    """
+    Build the source images cache configured in the settings
+    Returns
+    -------
+    LocalCache
+        the cache or None if caching is disabled
+    """
+    if SOURCE_CACHE_MAX_BYTES <= 0:
+        return None
+    return LocalCache(SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES)
@@ -0,0 +1,200 @@
+"""
+Estimate the time a transformation takes from the probe of the source image,
+and degrade it to cheaper choices when it would not complete before the deadline
+of the invocation, instead of letting the Lambda time out.
+"""
+
+import logging
+import time
+
+from snappy.images import normalize_format
+from snappy.animation import kept_frames
+from snappy.encoders import encoder_profile, lossless
+from snappy.pillow_engine import draft_size
+from snappy.plan import find, geometry, output_size, resample_filter, BOX_REDUCING_GAP, GEOMETRY_STAGES, Budget, Decode, Encode, Optimize, Similarity
+from snappy.settings import (DEADLINE_MARGIN_MS, DEADLINE_HEADROOM, TRANSFORM_MEGAPIXELS_PER_SECOND,
+                             DEGRADED_MEGAPIXELS_PER_SECOND, LOSSY_IMAGE_FMTS, MAX_BYTES_TRIALS, COMPRESS_TRIALS,
+                             OPTIMIZE_TIME_BUDGET_MS, TRANSFORM_ENGINE)
+
+LOG = logging.getLogger(__name__)
+
+#
+# the degradations in the order they are applied, each one adding to the previous ones:
+# - `low-effort` encodes with the fastest settings, the output is larger but looks the same
+# - `fast-filter` resizes with the `fast` filter, whatever the one requested
+# - `shrink-on-load` decodes JPEG images right at the output size instead of twice of it
+# - `original` serves the source image untransformed
+#
+DEGRADATIONS = ('low-effort', 'fast-filter', 'shrink-on-load', 'original')
+
+#
+# the cost of each step per megapixel, relative to decoding a megapixel. A JPEG decoded
+# at a reduced scale still has all its data read, at a fraction of the cost of the source pixels.
+#
+JPEG_SCALED_DECODE_COST = 0.25
+RESAMPLE_COSTS = {'sharp': 1.0, 'balanced': 0.7, 'fast': 0.4}
+BOX_COST = 0.1
+ENCODE_COSTS = {'jpeg': 0.5, 'png': 2.0, 'gif': 1.0, 'webp': 3.0}
+LOW_EFFORT_ENCODE_COSTS = {'jpeg': 0.5, 'png': 0.5, 'gif': 1.0, 'webp': 3.0}
+
+#
+# the cost of a frame of an animated WebP relative to the same frame encoded alone, at each
+# method from 0 to 6, lossy then lossless. The animation encoder tries several ways to encode
+# each frame against the previous ones, at method 6 a lossy frame costs 17 times as much.
+#
+ANIMATED_WEBP_FACTORS = {
+    False: (2.4, 2.0, 1.6, 1.5, 1.6, 1.3, 17.0),
+    True: (1.3, 2.0, 2.5, 2.7, 4.7, 1.4, 6.4),
+}
+
+#
+# the cost per megapixel of each frame of `-layers Optimize`, comparing it with the previous one
+#
+LAYERS_OPTIMIZE_COST = 0.5
+
+
+def encoder_effort(profile, fmt):
+    """
+    Returns
+    -------
+    float
+        the cost of encoding as `fmt` with the encoder `profile`, relative
+        to a baseline JPEG and a lossy WebP at the default method (4)
+    """
+    if fmt == 'jpeg':
+        return 1 + 0.5 * profile.progressive + 0.2 * profile.optimize
+    if fmt == 'webp':
+        return (1 + profile.webp_method) / 5 * (2 if profile.webp_lossless else 1)
+    return 1
+
+def request_deadline(context):
+    """
+    Compute the deadline of the transformations from the Lambda `context`
+    Returns
+    -------
+    float
+        the `time.monotonic()` the transformations must complete by,
+        or None if the time left is unknown
+    """
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return None
+    return time.monotonic() + (get_remaining_time() - DEADLINE_MARGIN_MS) / 1000
+
+
+def _decoded_pixels(info, plan, degraded):
+    w, h = info.width, info.height
+    if info.format != 'jpeg' or not find(plan, Decode).shrink_on_load:
+        return w * h
+    hint = draft_size((w, h), plan, 1 if 'shrink-on-load' in degraded else None)
+    if not hint:
+        return w * h
+    #
+    # the JPEG decoder scales down by powers of two, up to 1/8, keeping at least the size of `hint`
+    #
+    scale = 1
+    while scale < 8 and w // (scale * 2) >= hint[0] and h // (scale * 2) >= hint[1]:
+        scale *= 2
+    return (w // scale) * (h // scale)
+
+
+def estimate(info, plan, degraded=(), engine=None):
+    """
+    Estimate the time to execute `plan` on the image probed as `info`, with the `degraded` choices,
+    by the transformation `engine`, `TRANSFORM_ENGINE` if not given. ImageMagick does not search
+    for a similar quality nor optimize the output, it optimizes the layers of an animated GIF.
+    Returns
+    -------
+    float
+        the estimated time in seconds
+    """
+    size = (info.width, info.height)
+    decoded = _decoded_pixels(info, plan, degraded)
+    resize, crop = geometry(size, find(plan, GEOMETRY_STAGES))
+    width, height = output_size(size, plan)
+    output = width * height
+    fmt = normalize_format(find(plan, Encode).format or info.format)
+
+    engine = engine or TRANSFORM_ENGINE
+    #
+    # the frames of an animation are decoded up to the last one kept, only the ones kept
+    # are resized and encoded
+    #
+    kept = kept_frames(info.frames or 1, (width, height), fmt)
+    frames = kept[-1] + 1
+
+    decode_cost = decoded
+    if decoded < info.width * info.height:
+        decode_cost += info.width * info.height * JPEG_SCALED_DECODE_COST
+    cost = 0
+    if resize != size or crop:
+        method = resample_filter(size, plan, 'fast-filter' in degraded)
+        resampled = decoded
+        if method == 'fast':
+            #
+            # the boxes of pixels leave at most twice the reducing gap of the output size on each side
+            #
+            resampled = min(decoded, resize[0] * resize[1] * (2 * BOX_REDUCING_GAP) ** 2)
+            cost += decoded * BOX_COST
+        cost += resampled * RESAMPLE_COSTS[method]
+    encode_costs = LOW_EFFORT_ENCODE_COSTS if 'low-effort' in degraded else ENCODE_COSTS
+    profile = encoder_profile(plan, info.mode, low_effort='low-effort' in degraded)
+    #
+    # the quality is searched with several encodes, the similarity search
+    # also decodes each of them
+    #
+    encodes = 1
+    if fmt in LOSSY_IMAGE_FMTS and not lossless(profile, fmt):
+        if find(plan, Similarity) is not None and engine == 'pillow':
+            encodes += COMPRESS_TRIALS * 2
+        if find(plan, Budget) is not None:
+            encodes += MAX_BYTES_TRIALS
+    encode_cost = encode_costs.get(fmt, 1.0) * encoder_effort(profile, fmt)
+    if len(kept) > 1 and fmt == 'webp':
+        encode_cost *= ANIMATED_WEBP_FACTORS[lossless(profile, fmt)][profile.webp_method]
+    if len(kept) > 1 and fmt == 'gif' and engine != 'pillow':
+        encode_cost += LAYERS_OPTIMIZE_COST
+    cost += output * encode_cost * encodes
+    seconds = (frames * decode_cost + len(kept) * cost) / (TRANSFORM_MEGAPIXELS_PER_SECOND * 1000 * 1000)
+    #
+    # the lossless optimizations are bounded by their own time budget, and skipped by `low-effort`
+    #
+    if find(plan, Optimize) is not None and fmt in ('png', 'gif') and len(kept) == 1 and engine == 'pillow' \
+            and 'low-effort' not in degraded:
+        seconds += OPTIMIZE_TIME_BUDGET_MS / 1000
+    return seconds
+
+
+def degrade(info, plan, deadline):
+    """
+    Pick the degradations needed for `plan` on the image probed as `info` to complete before `deadline`,
+    with `DEADLINE_HEADROOM` for the errors of the estimate
+    Returns
+    -------
+    tuple
+        the names of the degradations, ending with `original` if the image
+        cannot be transformed in time, empty if there is no need to degrade
+    """
+    if deadline is None:
+        return ()
+    time_left = (deadline - time.monotonic()) / DEADLINE_HEADROOM
+    size = output_size((info.width, info.height), plan)
+    fmt = normalize_format(find(plan, Encode).format or info.format)
+    output = len(kept_frames(info.frames or 1, size, fmt)) * size[0] * size[1]
+    if output > time_left * DEGRADED_MEGAPIXELS_PER_SECOND * 1000 * 1000:
+        #
+        # even the cheapest choices would not produce that many pixels in time
+        #
+        LOG.warning('Serving the original image: {:.1f} megapixels to output for {:.2f} s left'.format(
+            output / 1000 / 1000, time_left))
+        return DEGRADATIONS
+    degraded = ()
+    for degradation in DEGRADATIONS:
+        seconds = estimate(info, plan, degraded)
+        if seconds <= time_left:
+            break
+        degraded += (degradation,)
+    if degraded:
+        LOG.warning('Degrading the transformation with {}: estimated {:.2f} s for {:.2f} s left'.format(
+            ', '.join(degraded), seconds, time_left))
+    return degraded
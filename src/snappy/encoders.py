@@ -0,0 +1,65 @@
+"""
+Pick the settings of the JPEG and WebP encoders beyond the quality: progressive or baseline
+JPEG, optimized Huffman tables, chroma subsampling, WebP effort and lossless WebP. They are
+grouped in the profiles of `ENCODER_PROFILES`, picked per request or from the image itself.
+"""
+
+from collections import namedtuple
+
+from snappy.plan import find, Budget, Lossy, Profile
+from snappy.settings import ENCODER_PROFILES, ENCODER_PROFILE, GRAPHIC_MAX_COLORS
+
+EncoderProfile = namedtuple('EncoderProfile', ['progressive', 'optimize', 'subsampling', 'webp_method', 'webp_lossless'])
+
+#
+# the settings replaced when the encoders must be fast, see `snappy.deadline`,
+# lossless WebP is several times slower than lossy WebP at any method
+#
+LOW_EFFORT = {'progressive': False, 'optimize': False, 'webp_method': 0, 'webp_lossless': False}
+
+
+def profile_name(plan, mode, colors=None):
+    """
+    Pick the profile for `plan` on an image of the Pillow `mode` with `colors` colors, when
+    counted: the one requested, else `ENCODER_PROFILE`, else `graphic` for the images with
+    a palette or few colors, `photo` for the others
+    Returns
+    -------
+    str
+        the name of the profile in `ENCODER_PROFILES`
+    """
+    stage = find(plan, Profile)
+    if stage is not None:
+        return stage.name
+    if ENCODER_PROFILE != 'auto':
+        return ENCODER_PROFILE
+    if mode in ('1', 'P') or (colors is not None and colors <= GRAPHIC_MAX_COLORS):
+        return 'graphic'
+    return 'photo'
+
+
+def encoder_profile(plan, mode, colors=None, low_effort=False):
+    """
+    Returns
+    -------
+    EncoderProfile
+        the settings of the encoders for `plan` on an image of the Pillow `mode` with `colors` colors,
+        see `profile_name`, with the fastest ones when `low_effort` is set. Lossless WebP is
+        only kept when there is no byte budget, which only the quality can meet, nor quality requested.
+    """
+    profile = EncoderProfile(**ENCODER_PROFILES[profile_name(plan, mode, colors)])
+    if low_effort:
+        profile = profile._replace(**LOW_EFFORT)
+    if find(plan, (Budget, Lossy)) is not None:
+        profile = profile._replace(webp_lossless=False)
+    return profile
+
+
+def lossless(profile, ext):
+    """
+    Returns
+    -------
+    bool
+        True if the image is encoded without loss as `ext` with `profile`
+    """
+    return ext == 'webp' and profile.webp_lossless
@@ -0,0 +1,68 @@
+"""Image formats and transformation results"""
+
+import logging
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from snappy.utils import mime_detector
+
+LOG = logging.getLogger(__name__)
+
+MIME_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+
+#
+# the transformed image content in `data`, along with what is known about it,
+# so the response can be built without inspecting the content again.
+# `quality` is the one found by the engine when it searched for it, and `optimization`
+# the lossless optimization of the encoder it found, None otherwise. `executed` describes
+# the stages the engine ran, as shown by the explain mode.
+#
+TransformResult = namedtuple('TransformResult', ['data', 'format', 'mime_type', 'width', 'height', 'length',
+                                                 'quality', 'optimization', 'executed'])
+
+
+def normalize_format(fmt):
+    fmt = fmt.lower()
+    return 'jpeg' if fmt == 'jpg' else fmt
+
+
+def make_result(data, fmt, size, quality=None, optimization=None, executed=None):
+    """
+    Build the result for the image content `data` encoded as `fmt` with the given `size`,
+    at the `quality` and with the `optimization` found by the engine, if any,
+    after the `executed` stages
+    Returns
+    -------
+    TransformResult
+        the result
+    """
+    fmt = normalize_format(fmt)
+    mime_type = MIME_TYPES.get(fmt) or Image.MIME.get(fmt.upper()) or 'application/octet-stream'
+    return TransformResult(data=data, format=fmt, mime_type=mime_type, width=size[0], height=size[1],
+                           length=len(data), quality=quality, optimization=optimization, executed=executed)
+
+
+def identify(data):
+    """
+    Build the result for the image content `data` from its header only,
+    libmagic is used for the content which is not a supported image
+    Returns
+    -------
+    TransformResult
+        the result, with no format nor size if it is not a supported image
+    """
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return make_result(data, img.format, img.size)
+    except Exception:
+        LOG.info('Cannot identify the image, sniffing its mime type')
+        mime_type = mime_detector().from_buffer(data)
+        return TransformResult(data=data, format=None, mime_type=mime_type, width=None, height=None,
+                               length=len(data), quality=None, optimization=None, executed=None)
@@ -0,0 +1,352 @@
+"""
+Long-lived ImageMagick workers, so the library is loaded once per worker instead of
+running `convert` for every request. Each worker is a process running the plans with
+the MagickWand binding (the optional `Wand` package), fed with the image content
+over a pipe. The workers are recycled after a number of jobs, when their memory
+goes above a high-water mark, or when a job does not complete in time.
+"""
+
+import logging
+import multiprocessing
+import queue
+import resource
+
+from snappy.animation import kept_frames
+from snappy.encoders import encoder_profile, lossless, profile_name
+from snappy.pillow_engine import draft_size
+from snappy.plan import (box_factor, describe, describe_encode, describe_executed, find, geometry, output_size,
+                         resample_filter, GEOMETRY_STAGES, Decode, Resize, Extent, Scale, Colorspace, Strip, Budget, Encode)
+from snappy.settings import LOSSY_IMAGE_FMTS
+
+LOG = logging.getLogger(__name__)
+
+#
+# the ImageMagick filter of each resampling filter, its default one is already Lanczos when reducing
+#
+MAGICK_FILTERS = {'fast': 'Triangle', 'balanced': 'Catrom', 'sharp': None}
+
+
+class PoolError(Exception):
+    """The job could not be run by a worker"""
+
+
+class JobTimeout(PoolError):
+    """The job did not complete in time, its worker was stopped"""
+
+
+def wand_available():
+    """
+    Returns
+    -------
+    bool
+        True if the MagickWand binding can be loaded
+    """
+    try:
+        import wand.image  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _geometry(width, height):
+    return '{}x{}'.format('' if width is None else '{:g}'.format(width),
+                          '' if height is None else '{:g}'.format(height))
+
+
+def degraded_options(degraded):
+    """
+    Returns
+    -------
+    list
+        the ImageMagick `(option, value)` pairs for the `degraded` encoder choices
+    """
+    options = []
+    if 'low-effort' in degraded:
+        options.append(('png:compression-level', '1'))
+    return options
+
+
+def profile_options(profile, ext):
+    """
+    Returns
+    -------
+    list
+        the ImageMagick `(option, value)` pairs for the encoder `profile` of the output format `ext`,
+        the JPEG interlacing is set with its own argument
+    """
+    if ext in ('jpg', 'jpeg'):
+        return [('jpeg:optimize-coding', str(profile.optimize).lower()), ('jpeg:sampling-factor', profile.subsampling)]
+    if ext == 'webp':
+        return [('webp:method', str(profile.webp_method)), ('webp:lossless', str(profile.webp_lossless).lower())]
+    return []
+
+
+def budget_option(stage, ext):
+    """
+    Returns
+    -------
+    tuple
+        the ImageMagick `(option, value)` making the encoder of `ext` fit
+        its output in the `Budget` stage, or None if it cannot
+    """
+    if ext in ('jpg', 'jpeg'):
+        return 'jpeg:extent', str(stage.max_bytes)
+    if ext == 'webp':
+        return 'webp:target-size', str(stage.max_bytes)
+    return None
+
+
+def magick_executed(plan, info, degraded=()):
+    """
+    Describe the stages ImageMagick runs for `plan` on the image probed as `info` with the `degraded`
+    choices, the same for `convert` and the workers. It does not search for a similar quality
+    nor optimize the output.
+    Returns
+    -------
+    str
+        the stages executed, as shown by the explain mode
+    """
+    size = (info.width, info.height)
+    method = resample_filter(size, plan, 'fast-filter' in degraded)
+    reducing_gap = 1 if 'shrink-on-load' in degraded else None
+    shrink_on_load = info.format == 'jpeg' and find(plan, Decode).shrink_on_load and draft_size(size, plan, reducing_gap)
+    colorspace = find(plan, Colorspace)
+    ext = colorspace.format if colorspace is not None else info.format
+    frames = None
+    if info.frames != 1:
+        frames = 'coalesce'
+        if info.frames:
+            frames += ', {}/{} frames'.format(len(kept_frames(info.frames, output_size(size, plan), ext)), info.frames)
+    executed = [describe_executed('decode', 'shrink-on-load' if shrink_on_load else None, frames)]
+    stage = find(plan, GEOMETRY_STAGES)
+    if stage is not None and output_size(size, plan) != size:
+        executed.append(describe_executed(type(stage).__name__.lower(), '{}x{}'.format(*output_size(size, plan)),
+                                          'box' if method == 'fast' and box_factor(size, geometry(size, stage)[0]) > 1
+                                          and not shrink_on_load else None, method))
+    if colorspace is not None and colorspace.format != info.format:
+        executed.append(describe(colorspace))
+    if find(plan, Strip) is not None:
+        executed.append('strip')
+    budget = find(plan, Budget)
+    if budget is not None and budget_option(budget, ext):
+        executed.append(describe(budget))
+    profile = encoder_profile(plan, info.mode, low_effort='low-effort' in degraded)
+    quality = find(plan, Encode).quality if ext in LOSSY_IMAGE_FMTS and not lossless(profile, ext) else None
+    executed.append(describe_encode(ext, quality, profile_name(plan, info.mode)))
+    if info.frames != 1 and ext == 'gif':
+        executed.append('layers(optimize)')
+    return ' > '.join(executed)
+
+
+def _box_reduce(img, stage):
+    #
+    # average boxes of pixels first, the final filter only has a few of them left to weight
+    #
+    resize, crop = geometry((img.width, img.height), stage)
+    factor = box_factor((img.width, img.height), resize)
+    if factor > 1:
+        img.scale(-(-img.width // factor), -(-img.height // factor))
+
+
+def run_plan(data, plan, info, degraded=()):
+    """
+    Execute the stages of `plan` with MagickWand on the image content `data` probed as `info`,
+    with the same semantics as the `convert` arguments built by `transform.imagemagick_args`,
+    including the `degraded` choices
+    Returns
+    -------
+    tuple
+        the transformed image content, its format and its `(width, height)`
+    """
+    from wand.image import Image
+
+    ext = info.format
+    method = resample_filter((info.width, info.height), plan, 'fast-filter' in degraded)
+    profile = encoder_profile(plan, info.mode, low_effort='low-effort' in degraded)
+    with Image() as img:
+        if MAGICK_FILTERS[method]:
+            img.options['filter'] = MAGICK_FILTERS[method]
+        for option, value in degraded_options(degraded):
+            img.options[option] = value
+        for stage in plan:
+            if isinstance(stage, Decode):
+                reducing_gap = 1 if 'shrink-on-load' in degraded else None
+                hint = draft_size((info.width, info.height), plan, reducing_gap) if stage.shrink_on_load else None
+                if hint and ext == 'jpeg':
+                    img.options['jpeg:size'] = '{}x{}'.format(*hint)
+                img.read(blob=data)
+            elif isinstance(stage, Resize):
+                if method == 'fast':
+                    _box_reduce(img, stage)
+                img.transform(resize=_geometry(stage.width, stage.height) + ('!' if stage.fit == 'distort' else ''))
+            elif isinstance(stage, Extent):
+                if method == 'fast':
+                    _box_reduce(img, stage)
+                img.transform(resize=_geometry(stage.width, stage.height) + '^')
+                resize, crop = geometry((img.width, img.height), stage)
+                img.crop(width=crop[0], height=crop[1], gravity='center')
+            elif isinstance(stage, Scale):
+                resize, crop = geometry((img.width, img.height), stage)
+                img.scale(*resize)
+            elif isinstance(stage, Colorspace):
+                ext = stage.format
+            elif isinstance(stage, Strip):
+                img.strip()
+            elif isinstance(stage, Budget):
+                option = budget_option(stage, ext)
+                if option:
+                    img.options[option[0]] = option[1]
+            elif isinstance(stage, Encode):
+                img.format = ext
+                for option, value in profile_options(profile, ext):
+                    img.options[option] = value
+                if ext in ('jpg', 'jpeg'):
+                    img.interlace_scheme = 'plane' if profile.progressive else 'no'
+                if ext in LOSSY_IMAGE_FMTS and not lossless(profile, ext):
+                    img.compression_quality = stage.quality
+        return img.make_blob(), ext, (img.width, img.height)
+
+
+def _max_rss_bytes():
+    #
+    # the peak resident memory of the process, in KiB on Linux
+    #
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _serve(conn, execute):
+    """Run the jobs received on `conn` until it is closed or None is received"""
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            conn.send(('ok', execute(*job), _max_rss_bytes()))
+        except Exception as e:
+            conn.send(('error', repr(e), _max_rss_bytes()))
+
+
+class Worker(object):
+    """A worker process running the jobs sent over a pipe"""
+
+    def __init__(self, execute):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_conn, execute), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.max_rss = 0
+
+    def run(self, job, timeout):
+        """
+        Returns
+        -------
+        object
+            the result of the job, `PoolError` is raised if it failed
+        """
+        self.jobs += 1
+        self.conn.send(job)
+        if not self.conn.poll(timeout):
+            self.stop(force=True)
+            raise JobTimeout('The job did not complete in {} s'.format(timeout))
+        try:
+            status, result, self.max_rss = self.conn.recv()
+        except EOFError:
+            self.stop(force=True)
+            raise PoolError('The worker exited while running the job')
+        if status != 'ok':
+            raise PoolError(result)
+        return result
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self, force=False):
+        if force:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of at most `size` workers running `execute(*job)`, each job must complete
+    within `timeout` seconds. A worker is replaced after `max_jobs` jobs, or once its peak
+    memory goes above `max_rss` bytes.
+    """
+
+    def __init__(self, execute, size, timeout, max_jobs, max_rss):
+        self.execute = execute
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        #
+        # None stands for a worker which is not started yet
+        #
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def _recycle(self, worker):
+        if not worker.alive():
+            return True
+        if worker.jobs >= self.max_jobs:
+            LOG.info('Recycling the worker after {} jobs'.format(worker.jobs))
+            return True
+        if worker.max_rss >= self.max_rss:
+            LOG.info('Recycling the worker at {} bytes of memory'.format(worker.max_rss))
+            return True
+        return False
+
+    def start(self):
+        """Start all the workers, so the first jobs do not wait for them"""
+        workers = []
+        while True:
+            try:
+                workers.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        for worker in workers:
+            self.idle.put(worker or Worker(self.execute))
+
+    def run(self, *job):
+        """
+        Run `job` on the next idle worker, waiting for one if they are all busy
+        Returns
+        -------
+        object
+            the result of `execute(*job)`, `PoolError` is raised if it failed
+        """
+        try:
+            worker = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolError('No idle worker')
+        try:
+            if worker is None or not worker.alive():
+                worker = Worker(self.execute)
+            return worker.run(job, self.timeout)
+        finally:
+            if worker is not None and self._recycle(worker):
+                worker.stop()
+                worker = None
+            self.idle.put(worker)
+
+    def close(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            if worker is not None:
+                worker.stop()
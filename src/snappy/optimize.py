@@ -0,0 +1,187 @@
+"""
+Lossless optimization of the PNG and GIF outputs for `auto=compress`: the image is encoded
+with a palette when it has no more than 256 colors, without its alpha channel when it is
+fully opaque, and with several zlib strategies. The smallest output decoding to the same
+pixels is kept.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from snappy.settings import OPTIMIZE_TIME_BUDGET_MS
+
+LOG = logging.getLogger(__name__)
+
+#
+# the parameters of an optimized encode: the `variant` of the image (`source`, `opaque`
+# without its alpha channel or `palette` with its exact colors) and the `options` items
+# added to the ones of `Image.save`. The `original` variant is the source image content
+# itself, which no encode made smaller.
+#
+Optimization = namedtuple('Optimization', ['variant', 'options'])
+
+#
+# the zlib strategies tried for PNG, from the most likely to win:
+# the default, `Z_FILTERED`, `Z_RLE` and `Z_HUFFMAN_ONLY`
+#
+PNG_OPTIONS = (
+    (('optimize', True),),
+    (('compress_level', 9), ('compress_type', 1)),
+    (('compress_level', 9), ('compress_type', 3)),
+    (('compress_level', 9), ('compress_type', 2)),
+)
+
+GIF_OPTIONS = (
+    (('optimize', True),),
+)
+
+OPTIMIZED_FMTS = {'PNG': PNG_OPTIONS, 'GIF': GIF_OPTIONS}
+
+ORIGINAL = Optimization('original', ())
+
+
+def _rgba(img):
+    #
+    # numpy takes a while to import, only the optimized requests need it
+    #
+    import numpy
+    return numpy.asarray(img.convert('RGBA'))
+
+
+def opaque(img):
+    """
+    Returns
+    -------
+    Image
+        `img` without its alpha channel, or None if it has none or some pixels are not opaque
+    """
+    if img.mode not in ('RGBA', 'LA'):
+        return None
+    if img.getchannel('A').getextrema() != (255, 255):
+        return None
+    return img.convert(img.mode[:-1])
+
+
+def exact_palette(img, fmt):
+    """
+    Convert `img` into a palette image with its exact colors, GIF only has binary transparency
+    Returns
+    -------
+    tuple
+        the palette image and its `transparency` option, or None if `img` has more than 256 colors
+    """
+    if img.mode == 'P' or img.getcolors(256) is None:
+        return None
+    import numpy
+    rgba = _rgba(img).astype(numpy.uint32)
+    packed = (rgba[..., 0] << 24) | (rgba[..., 1] << 16) | (rgba[..., 2] << 8) | rgba[..., 3]
+    colors, indices = numpy.unique(packed.ravel(), return_inverse=True)
+    palette_img = Image.fromarray(indices.reshape(packed.shape).astype(numpy.uint8), 'P')
+    palette_img.putpalette([int(color >> shift) & 0xFF for color in colors for shift in (24, 16, 8)])
+
+    alpha = [int(color) & 0xFF for color in colors]
+    if min(alpha) == 255:
+        return palette_img, None
+    if fmt == 'PNG':
+        return palette_img, bytes(alpha)
+    transparent = [index for index, value in enumerate(alpha) if value != 255]
+    if len(transparent) > 1 or alpha[transparent[0]] != 0:
+        return None
+    return palette_img, transparent[0]
+
+
+def variant(img, name, fmt):
+    """
+    Returns
+    -------
+    tuple
+        the image of the variant `name` of `img` and the options it needs, or None if it does not apply
+    """
+    if name == 'source':
+        return img, {}
+    if name == 'opaque':
+        img = opaque(img)
+        return (img, {}) if img is not None else None
+    if name == 'palette':
+        img = opaque(img) or img
+        palette = exact_palette(img, fmt)
+        if palette is None:
+            return None
+        palette_img, transparency = palette
+        return palette_img, {} if transparency is None else {'transparency': transparency}
+    raise ValueError('Unknown variant {}'.format(name))
+
+
+def _encode(img, fmt, options):
+    output = BytesIO()
+    img.save(output, fmt, **options)
+    return output.getvalue()
+
+
+def optimize(img, fmt, options, known=None, source=None):
+    """
+    Encode `img` as `fmt` with `options` for `Image.save`, then try the lossless optimizations
+    for `OPTIMIZE_TIME_BUDGET_MS` at most, keeping the smallest output which decodes to
+    the same pixels as `img` or as the output with the original options. The `source` image
+    content `img` was decoded from, if given, is kept when no output is smaller.
+    With the `known` optimization found by a previous call, it is used without searching.
+    Returns
+    -------
+    tuple
+        the Optimization used, None if it is the original options, and the output
+    """
+    best, best_output = _optimize(img, fmt, options, known, source)
+    if source is not None and len(source) <= len(best_output):
+        LOG.debug('Keeping the {} source of {} bytes'.format(fmt, len(source)))
+        return ORIGINAL, source
+    return best, best_output
+
+
+def _optimize(img, fmt, options, known, source):
+    if known == ORIGINAL:
+        if source is not None:
+            return known, source
+        known = None
+    if known is not None:
+        image_variant = variant(img, known.variant, fmt)
+        if image_variant is not None:
+            img, variant_options = image_variant
+            return known, _encode(img, fmt, dict(options, **dict(known.options), **variant_options))
+
+    import numpy
+    start = time.monotonic()
+    best, best_output = None, _encode(img, fmt, options)
+    references = [_rgba(img)]
+    baseline = best_output
+
+    for name in ('palette', 'opaque', 'source'):
+        image_variant = variant(img, name, fmt)
+        if image_variant is None:
+            continue
+        variant_img, variant_options = image_variant
+        for extra in OPTIMIZED_FMTS[fmt]:
+            if (time.monotonic() - start) * 1000 > OPTIMIZE_TIME_BUDGET_MS:
+                LOG.debug('Optimization time budget exhausted')
+                return best, best_output
+            output = _encode(variant_img, fmt, dict(options, **dict(extra), **variant_options))
+            if len(output) >= len(best_output):
+                continue
+            with Image.open(BytesIO(output)) as decoded:
+                pixels = _rgba(decoded)
+            if not any(numpy.array_equal(pixels, reference) for reference in references):
+                if len(references) == 1:
+                    #
+                    # the original options may not be lossless for GIF, which quantizes the colors
+                    #
+                    with Image.open(BytesIO(baseline)) as decoded:
+                        references.append(_rgba(decoded))
+                if not numpy.array_equal(pixels, references[-1]):
+                    LOG.debug('Optimization {} {} changes the pixels'.format(name, extra))
+                    continue
+            best, best_output = Optimization(name, extra), output
+    LOG.debug('Optimized {} from {} to {} bytes with {}'.format(fmt, len(baseline), len(best_output), best))
+    return best, best_output
@@ -0,0 +1,175 @@
+"""
+Detect the transformations which would not change the source image,
+so it is served as is instead of being encoded again.
+"""
+
+import logging
+import struct
+
+from snappy.images import normalize_format
+from snappy.pillow_engine import resize_geometry
+from snappy.plan import auto_options, compile_plan, find, Optimize, Profile, Lossy
+from snappy.probe import jpeg_segments, jpeg_quality, ProbeError
+from snappy.settings import LOSSY_IMAGE_FMTS, DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE, TRANSFORM_ENGINE
+
+LOG = logging.getLogger(__name__)
+
+#
+# the JPEG segments kept when the metadata is removed: JFIF (APP0), Adobe (APP14)
+# which tells how to convert the colors, and all the segments which are not
+# application data (APPn) or comments (COM)
+#
+JPEG_METADATA_MARKERS = set(range(0xE1, 0xEE)) | {0xEF, 0xFE}
+
+#
+# the PNG chunks kept when the metadata is removed
+#
+PNG_CHUNKS = (b'IHDR', b'PLTE', b'tRNS', b'IDAT', b'IEND', b'acTL', b'fcTL', b'fdAT')
+
+#
+# the GIF application extension kept when the metadata is removed, it holds the loop count
+#
+GIF_LOOP_EXTENSION = b'NETSCAPE2.0'
+
+
+def strip_jpeg(data):
+    output = [data[:2]]
+    for marker, start, end in jpeg_segments(data):
+        if marker not in JPEG_METADATA_MARKERS:
+            output.append(data[start:end])
+    return b''.join(output)
+
+
+def strip_png(data):
+    output = [data[:8]]
+    offset = 8
+    while offset < len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, offset)
+        end = offset + 12 + length
+        if chunk_type in PNG_CHUNKS:
+            output.append(data[offset:end])
+        offset = end
+    return b''.join(output)
+
+
+def _gif_sub_blocks_end(data, offset):
+    while data[offset]:
+        offset += data[offset] + 1
+    return offset + 1
+
+
+def strip_gif(data):
+    #
+    # the comment extensions and the application extensions (XMP...) are removed,
+    # the graphic control extensions and the images are kept
+    #
+    flags = data[10]
+    offset = 13 + (3 << ((flags & 0x07) + 1) if flags & 0x80 else 0)
+    output = [data[:offset]]
+    while data[offset] != 0x3B:
+        start = offset
+        if data[offset] == 0x21:
+            label = data[offset + 1]
+            offset = _gif_sub_blocks_end(data, offset + 2)
+            if label == 0xFE or (label == 0xFF and data[start + 3:start + 14] != GIF_LOOP_EXTENSION):
+                continue
+        elif data[offset] == 0x2C:
+            flags = data[offset + 9]
+            offset += 10 + (3 << ((flags & 0x07) + 1) if flags & 0x80 else 0)
+            offset = _gif_sub_blocks_end(data, offset + 1)
+        else:
+            raise ProbeError('Unknown GIF block {:#x}'.format(data[offset]))
+        output.append(data[start:offset])
+    output.append(data[offset:offset + 1])
+    return b''.join(output)
+
+
+def strip_metadata(data, fmt):
+    """
+    Remove the metadata (EXIF, XMP, ICC, comments...) from the image content `data`
+    in the format `fmt`, without decoding the image
+    Returns
+    -------
+    bytes
+        the image without metadata or None if the format is not supported
+    """
+    try:
+        if fmt == 'jpeg':
+            return strip_jpeg(data)
+        elif fmt == 'png':
+            return strip_png(data)
+        elif fmt == 'gif':
+            return strip_gif(data)
+    except (ProbeError, struct.error, IndexError):
+        LOG.exception('Cannot remove the metadata of the image')
+    return None
+
+
+def _quality(ops):
+    if 'q' in ops:
+        return int(ops['q'])
+    if 'compress' in auto_options(ops):
+        return AGRESSIVE_QUALITY_RATE
+    return DEFAULT_QUALITY_RATE
+
+
+def _same_format_and_size(info, ops):
+    if normalize_format(ops.get('fm') or info.format) != info.format:
+        return False
+    size = (info.width, info.height)
+    resize, crop = resize_geometry(size, ops)
+    return resize == size and (not crop or crop == size)
+
+
+def stripped_source(data, info, ops):
+    """
+    Returns
+    -------
+    bytes
+        the image content `data`, probed as `info`, without its metadata when the operations
+        `ops` keep its format and size, so the output can be no larger, or None
+    """
+    if not _same_format_and_size(info, ops):
+        return None
+    return strip_metadata(data, info.format)
+
+
+def passthrough(data, info, ops):
+    """
+    Check if the operations `ops` would leave the image content `data`, probed as `info`, unchanged:
+    the output would have the same format and size, no more than `max_bytes`, and for lossy formats
+    the image is already at or below the requested quality, and no encoder profile is requested.
+    With `auto=compress`, only the metadata is removed.
+    The PNG and GIF images are optimized by the Pillow engine instead, see `snappy.optimize`.
+    Returns
+    -------
+    bytes
+        the content to serve instead of the transformed image, or None if it must be transformed
+    """
+    if not _same_format_and_size(info, ops):
+        return None
+
+    plan = compile_plan(ops)
+    if find(plan, Optimize) is not None and info.format in ('png', 'gif') and info.frames == 1 \
+            and TRANSFORM_ENGINE == 'pillow':
+        return None
+    #
+    # the encoder settings requested would not apply to the image served as is,
+    # an explicit quality only changes the encoding of WebP, which it makes lossy
+    #
+    if find(plan, Profile) is not None or (find(plan, Lossy) is not None and info.format == 'webp'):
+        return None
+
+    if info.format in LOSSY_IMAGE_FMTS:
+        #
+        # encoding the image again would only lose some more details
+        #
+        quality = jpeg_quality(data) if info.format == 'jpeg' else None
+        if quality is None or quality > _quality(ops):
+            return None
+
+    if 'compress' in auto_options(ops):
+        data = strip_metadata(data, info.format)
+    if data is None or len(data) > ops.get('max_bytes', len(data)):
+        return None
+    return data
@@ -0,0 +1,333 @@
+"""In-process image transformations using Pillow"""
+
+import logging
+from io import BytesIO
+
+from PIL import Image
+
+from snappy.animation import coalesce, frame_durations, kept_frames, ANIMATED_FMTS
+from snappy.encoders import encoder_profile, lossless, profile_name
+from snappy.images import make_result
+from snappy.optimize import optimize, OPTIMIZED_FMTS, ORIGINAL
+from snappy.plan import (box_factor, compile_plan, describe, describe_encode, describe_executed, find, geometry, output_size,
+                         resample_filter, GEOMETRY_STAGES, Budget, Decode, Encode, Optimize, Profile, Similarity, Strip)
+from snappy.quality import search_quality, search_similar_quality
+from snappy.similarity import luma, similarity
+from snappy.settings import LOSSY_IMAGE_FMTS, MAX_SOURCE_PIXELS, ENCODER_PROFILE, GRAPHIC_MAX_COLORS
+
+LOG = logging.getLogger(__name__)
+
+#
+# Pillow warns above this size, and refuses to open images twice as large
+#
+Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+
+#
+# maps the `fm` values into the format names used by Pillow
+#
+PIL_FORMATS = {
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+}
+
+#
+# the Pillow filter of each resampling filter, `fast` averages boxes of pixels first
+#
+PIL_FILTERS = {
+    'fast': Image.BILINEAR,
+    'balanced': Image.BICUBIC,
+    'sharp': Image.LANCZOS,
+}
+
+#
+# decode at no less than this factor of the target size, so the resize
+# filter still has enough pixels to produce a sharp image
+#
+DRAFT_REDUCING_GAP = 2
+
+
+def resize_geometry(size, ops):
+    """
+    Compute the geometry for the resize operations in `ops`, following
+    the same semantics as the ImageMagick `-resize` and `-scale` arguments.
+    Returns
+    -------
+    tuple
+        the `(width, height)` to resize the image to and the `(width, height)`
+        to crop from the center afterwards, or None if no crop is needed
+    """
+    return geometry(size, find(compile_plan(ops), GEOMETRY_STAGES))
+
+
+def draft_size(size, plan, reducing_gap=None):
+    """
+    Compute the smallest size the image of `size` can be decoded at for the resize
+    stage of `plan`, without any visible loss once resized, or at `reducing_gap`
+    times the output size when given.
+    JPEG decoders only scale by powers of two, so there is no gain below half the size.
+    Returns
+    -------
+    tuple
+        the minimum `(width, height)` to decode the image at, or None if
+        the image is not downscaled enough to be decoded at a reduced scale
+    """
+    resize, crop = geometry(size, find(plan, GEOMETRY_STAGES))
+    reducing_gap = reducing_gap or DRAFT_REDUCING_GAP
+    w, h = resize[0] * reducing_gap, resize[1] * reducing_gap
+    if w * 2 > size[0] or h * 2 > size[1]:
+        return None
+    return w, h
+
+
+def _center_box(size, crop):
+    w, h = size
+    cw, ch = min(crop[0], w), min(crop[1], h)
+    left = (w - cw) // 2
+    top = (h - ch) // 2
+    return (left, top, left + cw, top + ch)
+
+
+def _for_resize(frame):
+    #
+    # palette images can only be resized with the nearest neighbour filter
+    #
+    if frame.mode == 'P':
+        return frame.convert('RGBA' if 'transparency' in frame.info else 'RGB')
+    if frame.mode not in ('1', 'L', 'LA', 'RGB', 'RGBA', 'CMYK'):
+        return frame.convert('RGBA')
+    return frame
+
+
+def _for_format(frame, pil_fmt):
+    if pil_fmt == 'JPEG':
+        if frame.mode in ('RGBA', 'LA', 'P'):
+            #
+            # JPEG has no alpha channel, flatten over a white background
+            #
+            frame = frame.convert('RGBA')
+            background = Image.new('RGB', frame.size, (255, 255, 255))
+            background.paste(frame, mask=frame.split()[-1])
+            return background
+        if frame.mode not in ('L', 'RGB', 'CMYK'):
+            return frame.convert('RGB')
+    elif pil_fmt == 'WEBP':
+        if frame.mode not in ('RGB', 'RGBA'):
+            return frame.convert('RGBA' if 'A' in frame.getbands() else 'RGB')
+    elif pil_fmt == 'PNG' and frame.mode == 'CMYK':
+        return frame.convert('RGB')
+    elif pil_fmt == 'GIF' and frame.mode == 'RGBA':
+        #
+        # GIF has a single fully transparent color, put it at the last index of the palette
+        #
+        alpha = frame.getchannel('A')
+        if alpha.getextrema()[0] >= 128:
+            return frame.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+        palette_frame = frame.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
+        palette_frame.paste(255, mask=alpha.point(lambda value: 255 if value < 128 else 0))
+        palette_frame.info['transparency'] = 255
+        return palette_frame
+    return frame
+
+
+def transform_frame(frame, stage, size=None, resample='sharp'):
+    #
+    # the geometry of the resize `stage` is always computed from the original `size`,
+    # the frame may have been decoded at a reduced scale
+    #
+    resize, crop = geometry(size or frame.size, stage)
+    if resize != frame.size or crop:
+        frame = _for_resize(frame)
+    if resize != frame.size:
+        factor = box_factor(frame.size, resize) if resample == 'fast' else 1
+        if factor > 1:
+            frame = frame.resize((-(-frame.size[0] // factor), -(-frame.size[1] // factor)), Image.BOX)
+        frame = frame.resize(resize, PIL_FILTERS[resample])
+    if crop:
+        frame = frame.crop(_center_box(frame.size, crop))
+    return frame
+
+
+def count_colors(img):
+    """
+    Returns
+    -------
+    int
+        the number of colors of `img`, or None if it is a JPEG image or has more than `GRAPHIC_MAX_COLORS`
+    """
+    #
+    # a JPEG image is a photo, counting the colors of the others stops past the maximum
+    #
+    if img.format == 'JPEG':
+        return None
+    colors = img.getcolors(GRAPHIC_MAX_COLORS)
+    return len(colors) if colors else None
+
+
+def save_options(img, ext, plan, low_effort=False, profile=None):
+    """
+    Build the Pillow encoder options for the output format `ext` with the encoder `profile`,
+    picked from the mode of `img` if not given, with the fastest encoder settings when `low_effort` is set
+    Returns
+    -------
+    dict
+        the keyword arguments for `Image.save`
+    """
+    options = {}
+    profile = profile or encoder_profile(plan, img.mode, low_effort=low_effort)
+    lossy = ext in LOSSY_IMAGE_FMTS and not lossless(profile, ext)
+
+    if lossy:
+        options['quality'] = find(plan, Encode).quality
+    if ext in ('jpg', 'jpeg'):
+        options.update(progressive=profile.progressive, optimize=profile.optimize, subsampling=profile.subsampling)
+    elif ext == 'webp':
+        options.update(method=profile.webp_method, lossless=profile.webp_lossless)
+    elif ext == 'png' and low_effort:
+        options['compress_level'] = 1
+
+    if find(plan, Strip) is None:
+        #
+        # keep the profiles attached to the image, as ImageMagick does,
+        # they are removed only by `auto=compress`
+        #
+        if img.info.get('icc_profile') and ext != 'gif':
+            options['icc_profile'] = img.info['icc_profile']
+        if img.info.get('exif') and lossy:
+            options['exif'] = img.info['exif']
+
+    return options
+
+
+def encode(frames, pil_fmt, options):
+    """
+    Returns
+    -------
+    bytes
+        the `frames` encoded as `pil_fmt` with the `options` for `Image.save`
+    """
+    output = BytesIO()
+    LOG.debug('saving {} with {}'.format(pil_fmt, {k: v for k, v in options.items() if k != 'append_images'}))
+    frames[0].save(output, pil_fmt, **options)
+    return output.getvalue()
+
+
+def encode_plan(frames, pil_fmt, options, plan):
+    """
+    Search for the quality to encode the `frames` at for the similarity and budget stages of `plan`,
+    the similarity is only checked on the first frame
+    Returns
+    -------
+    tuple
+        the quality found and the encoded image, or `(None, None)` if `plan` has no search
+    """
+    def encode_at(quality):
+        return encode(frames, pil_fmt, dict(options, quality=quality))
+
+    quality, output = None, None
+    target = find(plan, Similarity)
+    if target is not None:
+        reference = luma(frames[0])
+        quality, output = search_similar_quality(encode_at, lambda data: similarity(reference, data),
+                                                 target.threshold)
+    budget = find(plan, Budget)
+    if budget is not None and (output is None or len(output) > budget.max_bytes):
+        quality, output = search_quality(encode_at, budget.max_bytes, quality or options['quality'])
+    return quality, output
+
+
+def image_transform(data, ops, degraded=(), optimization=None, source=None):
+    """
+    Transform the image content `data` using the transformations specified by `ops` (operations),
+    with the cheaper choices named in `degraded` (see `snappy.deadline`). The lossless
+    `optimization` found for the same image and operations is used instead of searching again,
+    the `source` content is served when the optimized output is not smaller.
+    Returns
+    -------
+    TransformResult
+        the transformed image
+    """
+    plan = compile_plan(ops)
+    stage = find(plan, GEOMETRY_STAGES)
+    img = Image.open(BytesIO(data))
+    executed = []
+    try:
+        resample = resample_filter(img.size, plan, 'fast-filter' in degraded)
+        ext = find(plan, Encode).format or (img.format or '').lower()
+        pil_fmt = PIL_FORMATS.get(ext, img.format)
+        mode, colors = img.mode, None
+
+        if getattr(img, 'is_animated', False) and ext in ANIMATED_FMTS:
+            #
+            # a GIF without a loop count plays once, Pillow would write one looping forever
+            #
+            loop = img.info.get('loop')
+            kept = kept_frames(img.n_frames, output_size(img.size, plan), ext)
+            frames, durations = coalesce(img, kept, frame_durations(data))
+            executed.append(describe_executed('decode', '{}/{} frames'.format(len(kept), img.n_frames)))
+            source_size = frames[0].size
+            frames = [transform_frame(frame, stage, resample=resample) for frame in frames]
+        else:
+            size = img.size
+            shrink_on_load = img.format == 'JPEG' and find(plan, Decode).shrink_on_load
+            reducing_gap = 1 if 'shrink-on-load' in degraded else None
+            hint = draft_size(size, plan, reducing_gap) if shrink_on_load else None
+            if hint:
+                #
+                # let the JPEG decoder scale the DCT blocks down, instead of
+                # decoding every pixel of a large image only to shrink it
+                #
+                img.draft(img.mode, hint)
+                LOG.debug('decoding {} at {}'.format(size, img.size))
+            executed.append('decode(shrink-on-load)' if img.size != size else 'decode')
+            source_size = img.size
+            if ext in LOSSY_IMAGE_FMTS and ENCODER_PROFILE == 'auto' and find(plan, Profile) is None:
+                colors = count_colors(img)
+            frames = [transform_frame(img, stage, size, resample)]
+        if frames[0].size != source_size:
+            executed.append(describe_executed(type(stage).__name__.lower(), '{}x{}'.format(*frames[0].size), resample))
+        modes = [frame.mode for frame in frames]
+        frames = [_for_format(frame, pil_fmt) for frame in frames]
+        if modes != [frame.mode for frame in frames]:
+            executed.append(describe_executed('colorspace', ext))
+        if find(plan, Strip) is not None:
+            executed.append('strip')
+
+        profile = encoder_profile(plan, mode, colors, 'low-effort' in degraded)
+        options = save_options(img, ext, plan, 'low-effort' in degraded, profile)
+        if len(frames) > 1:
+            options.update({
+                'save_all': True,
+                'append_images': frames[1:],
+                'duration': durations,
+            })
+            if loop is not None:
+                options['loop'] = loop
+
+        quality, output = None, None
+        if ext in LOSSY_IMAGE_FMTS and not lossless(profile, ext):
+            quality, output = encode_plan(frames, pil_fmt, options, plan)
+            if quality is not None:
+                executed.extend(describe(find(plan, stage_type)) for stage_type in (Similarity, Budget)
+                                if find(plan, stage_type) is not None)
+        #
+        # the animations are not optimized, each frame would have to be checked
+        #
+        if find(plan, Optimize) is not None and pil_fmt in OPTIMIZED_FMTS and len(frames) == 1 \
+                and 'low-effort' not in degraded:
+            optimization, output = optimize(frames[0], pil_fmt, options, optimization, source)
+        else:
+            optimization = None
+        if optimization is not None:
+            executed.append(describe_executed('optimize', optimization.variant))
+        if output is None:
+            output = encode(frames, pil_fmt, options)
+        if optimization != ORIGINAL:
+            executed.append(describe_encode(ext, options.get('quality') if quality is None else quality,
+                                            profile_name(plan, mode, colors)))
+    finally:
+        img.close()
+
+    return make_result(output, pil_fmt, frames[0].size, quality, optimization, ' > '.join(executed))
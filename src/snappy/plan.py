@@ -0,0 +1,366 @@
+"""
+Compile the operations of a request into an ordered plan of stages,
+executed in turn by the transformation engines:
+
+    decode > resample > resize | extent | scale > colorspace > strip > similarity > budget > optimize > profile > lossy > encode
+
+The plan only depends on the operations, the geometry of each stage
+is resolved against the size of the source image by the engines.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+from snappy.settings import (DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE, PARAMS_CACHE_SIZE, COMPRESS_SSIM_THRESHOLD,
+                             RESAMPLE_DEFAULT, RESAMPLE_FAST_FACTOR)
+
+#
+# read the source, at a reduced scale when the image is downscaled enough
+#
+Decode = namedtuple('Decode', ['shrink_on_load'])
+
+#
+# resize with the `filter` requested, one of `fast`, `balanced` or `sharp`,
+# see `resample_filter` for the one used otherwise
+#
+Resample = namedtuple('Resample', ['filter'])
+
+#
+# resize to `width` x `height`, ignoring the aspect ratio (`distort`) or fitting the image
+# into them (`fit`). Either side is None when only the other one is given.
+#
+Resize = namedtuple('Resize', ['width', 'height', 'fit'])
+
+#
+# crop the center of the image once resized to the requested size.
+# Only in a plan before its stages are fused.
+#
+Crop = namedtuple('Crop', ['width', 'height'])
+
+#
+# resize the image to cover `width` x `height`, then crop the center to that size
+#
+Extent = namedtuple('Extent', ['width', 'height'])
+
+#
+# device pixel ratio, applied to the size of the stage before it
+# or to the size of the source. Only in a plan before its stages are fused.
+#
+Dpr = namedtuple('Dpr', ['factor'])
+
+#
+# scale the image by `factor`
+#
+Scale = namedtuple('Scale', ['factor'])
+
+#
+# convert the image into a mode supported by the output `format`
+#
+Colorspace = namedtuple('Colorspace', ['format'])
+
+#
+# remove the metadata and the profiles
+#
+Strip = namedtuple('Strip', [])
+
+#
+# search for the lowest quality whose output keeps a structural similarity to the image
+# of at least `threshold`. Only used by the lossy formats, the engines which cannot
+# search use the quality of the encode stage.
+#
+Similarity = namedtuple('Similarity', ['threshold'])
+
+#
+# search for the highest quality, up to the one of the encode stage, whose output
+# fits in `max_bytes`. Only used by the lossy formats.
+#
+Budget = namedtuple('Budget', ['max_bytes'])
+
+#
+# try the lossless optimizations of the PNG and GIF encoders, see `snappy.optimize`
+#
+Optimize = namedtuple('Optimize', [])
+
+#
+# encode with the settings of the encoder profile `name`, see `snappy.encoders`
+# for the one used otherwise
+#
+Profile = namedtuple('Profile', ['name'])
+
+#
+# encode with loss at the quality of the encode stage, which was requested, even
+# when the encoder profile would encode without loss
+#
+Lossy = namedtuple('Lossy', [])
+
+#
+# encode the image as `format`, the format of the source if None,
+# `quality` is only used by the lossy formats
+#
+Encode = namedtuple('Encode', ['format', 'quality'])
+
+GEOMETRY_STAGES = (Resize, Extent, Scale)
+
+#
+# the `fast` filter first averages boxes of pixels, down to no less
+# than this factor of the output size, before the final filter
+#
+BOX_REDUCING_GAP = 2
+
+
+def _round(value):
+    return max(1, int(value + 0.5))
+
+
+def auto_options(ops):
+    """
+    Returns
+    -------
+    set
+        the values of the `auto` operation, a comma separated list
+    """
+    return set((ops.get('auto') or '').split(',')) - {''}
+
+
+def _stages(ops):
+    """
+    Returns
+    -------
+    list
+        the stages for the operations `ops`, in their order of execution
+    """
+    stages = [Decode(shrink_on_load='w' in ops or 'h' in ops)]
+    if 'resample' in ops:
+        stages.append(Resample(ops['resample']))
+
+    if 'w' in ops and 'h' in ops:
+        fit = ops.get('fit')
+        if fit == 'crop':
+            stages.append(Resize(ops['w'], ops['h'], 'cover'))
+            stages.append(Crop(ops['w'], ops['h']))
+        else:
+            #
+            # `clip` has the same behavior as `bounds` for compatibility, may be removed later
+            # https://github.com/caffeinetv/snappy/issues/5
+            #
+            stages.append(Resize(ops['w'], ops['h'], 'fit' if fit else 'distort'))
+    elif 'w' in ops:
+        stages.append(Resize(ops['w'], None, 'fit'))
+    elif 'h' in ops:
+        stages.append(Resize(None, ops['h'], 'fit'))
+    if 'dpr' in ops:
+        stages.append(Dpr(float(ops['dpr'])))
+
+    if 'fm' in ops:
+        stages.append(Colorspace(ops['fm']))
+    compress = 'compress' in auto_options(ops)
+    if compress:
+        stages.append(Strip())
+
+    if compress and 'q' not in ops:
+        stages.append(Similarity(COMPRESS_SSIM_THRESHOLD))
+    if 'max_bytes' in ops:
+        stages.append(Budget(ops['max_bytes']))
+    if compress:
+        stages.append(Optimize())
+    if 'profile' in ops:
+        stages.append(Profile(ops['profile']))
+    if 'q' in ops:
+        stages.append(Lossy())
+
+    if 'q' in ops:
+        quality = int(ops['q'])
+    elif compress:
+        quality = AGRESSIVE_QUALITY_RATE
+    else:
+        quality = DEFAULT_QUALITY_RATE
+    stages.append(Encode(ops.get('fm'), quality))
+    return stages
+
+
+def _scaled(value, factor):
+    return None if value is None else value * factor
+
+
+def fuse(stages):
+    """
+    Merge the adjacent stages which can be executed as one:
+    the device pixel ratio is folded into the size of the resize before it,
+    or becomes a scale of its own, and a resize covering the requested size
+    followed by a crop of that size becomes an extent
+    Returns
+    -------
+    list
+        the fused stages
+    """
+    fused = []
+    for stage in stages:
+        previous = fused[-1] if fused else None
+        if isinstance(stage, Dpr):
+            if isinstance(previous, (Resize, Extent)):
+                fused[-1] = previous._replace(width=_scaled(previous.width, stage.factor),
+                                              height=_scaled(previous.height, stage.factor))
+            elif stage.factor != 1:
+                fused.append(Scale(stage.factor))
+        elif isinstance(stage, Crop) and isinstance(previous, Resize) and previous.fit == 'cover' \
+                and (previous.width, previous.height) == (stage.width, stage.height):
+            fused[-1] = Extent(stage.width, stage.height)
+        else:
+            fused.append(stage)
+    return fused
+
+
+@lru_cache(maxsize=PARAMS_CACHE_SIZE)
+def _compile(items):
+    return tuple(fuse(_stages(dict(items))))
+
+
+def compile_plan(ops):
+    """
+    Compile the normalized operations `ops` into a plan, the plans are memoized
+    Returns
+    -------
+    tuple
+        the fused stages of the plan, in their order of execution
+    """
+    return _compile(tuple(sorted(ops.items())))
+
+
+def find(plan, stage_types):
+    """
+    Returns
+    -------
+    namedtuple
+        the first stage of `plan` of one of `stage_types` or None
+    """
+    for stage in plan:
+        if isinstance(stage, stage_types):
+            return stage
+    return None
+
+
+def geometry(size, stage):
+    """
+    Compute the geometry of the resize `stage` for an image of `size`, following
+    the same semantics as the ImageMagick `-resize`, `-extent` and `-scale` arguments.
+    Returns
+    -------
+    tuple
+        the `(width, height)` to resize the image to and the `(width, height)`
+        to crop from the center afterwards, or None if no crop is needed
+    """
+    src_w, src_h = size
+    if isinstance(stage, Scale):
+        return (_round(src_w * stage.factor), _round(src_h * stage.factor)), None
+    if isinstance(stage, Extent):
+        #
+        # resize based on the smallest fitting dimension,
+        # then crop the exceeding side from the center
+        #
+        scale = max(stage.width / src_w, stage.height / src_h)
+        return (_round(src_w * scale), _round(src_h * scale)), (_round(stage.width), _round(stage.height))
+    if isinstance(stage, Resize):
+        w, h = stage.width, stage.height
+        if w is None:
+            return (_round(src_w * h / src_h), _round(h)), None
+        if h is None:
+            return (_round(w), _round(src_h * w / src_w)), None
+        if stage.fit == 'distort':
+            return (_round(w), _round(h)), None
+        scale = min(w / src_w, h / src_h)
+        return (_round(src_w * scale), _round(src_h * scale)), None
+    return size, None
+
+
+def output_size(size, plan):
+    """
+    Returns
+    -------
+    tuple
+        the `(width, height)` of the output of `plan` for an image of `size`
+    """
+    resize, crop = geometry(size, find(plan, GEOMETRY_STAGES))
+    return crop or resize
+
+
+def resample_filter(size, plan, fast=False):
+    """
+    Returns
+    -------
+    str
+        the filter resizing an image of `size` for `plan`: `fast` if `fast` is set, else the one
+        requested, else `fast` for the downscales by `RESAMPLE_FAST_FACTOR` or more, else `RESAMPLE_DEFAULT`
+    """
+    if fast:
+        return 'fast'
+    stage = find(plan, Resample)
+    if stage is not None:
+        return stage.filter
+    resize, crop = geometry(size, find(plan, GEOMETRY_STAGES))
+    if size[0] >= resize[0] * RESAMPLE_FAST_FACTOR and size[1] >= resize[1] * RESAMPLE_FAST_FACTOR:
+        return 'fast'
+    return RESAMPLE_DEFAULT
+
+
+def box_factor(size, resize):
+    """
+    Returns
+    -------
+    int
+        the integer factor to average the pixels of an image of `size` by, before
+        resizing it to `resize` with the `fast` filter, 1 when it is not worth it
+    """
+    return max(1, min(size[0] // resize[0], size[1] // resize[1]) // BOX_REDUCING_GAP)
+
+
+def _number(value):
+    return '{:g}'.format(value) if value is not None else ''
+
+
+def describe(stage):
+    if isinstance(stage, Decode):
+        return 'decode(shrink-on-load)' if stage.shrink_on_load else 'decode'
+    if isinstance(stage, (Resize, Extent, Crop)):
+        fit = getattr(stage, 'fit', None)
+        return '{}({}x{}{})'.format(type(stage).__name__.lower(), _number(stage.width), _number(stage.height),
+                                    ', ' + fit if fit else '')
+    if isinstance(stage, Encode):
+        return 'encode({}, q={})'.format(stage.format or 'source', stage.quality)
+    if not stage:
+        return type(stage).__name__.lower()
+    return '{}({})'.format(type(stage).__name__.lower(), ', '.join(_number(v) if isinstance(v, float) else str(v)
+                                                                   for v in stage))
+
+
+def describe_executed(name, *details):
+    """
+    Returns
+    -------
+    str
+        the description of the stage `name` as executed by an engine, with the `details` which are not None
+    """
+    details = [str(detail) for detail in details if detail is not None]
+    return '{}({})'.format(name, ', '.join(details)) if details else name
+
+
+def describe_encode(ext, quality, profile=None):
+    """
+    Returns
+    -------
+    str
+        the description of the encode as `ext` at `quality`, None for a lossless encode of a lossy format,
+        with the encoder `profile` of the lossy formats
+    """
+    if ext not in ('jpg', 'jpeg', 'webp'):
+        return describe_executed('encode', ext)
+    return describe_executed('encode', ext, 'lossless' if quality is None else 'q={}'.format(quality), profile)
+
+
+def explain(plan):
+    """
+    Returns
+    -------
+    str
+        the stages of `plan` on one line, as shown by the explain mode
+    """
+    return ' > '.join(describe(stage) for stage in plan)
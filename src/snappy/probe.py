@@ -0,0 +1,349 @@
+"""
+Read what is needed to plan a transformation from the header of an image only,
+without decoding any pixel.
+"""
+
+import struct
+from collections import namedtuple
+from io import BytesIO
+
+#
+# `frames` is None when the content given ends before all the frames could be counted,
+# `mode` follows the Pillow mode names
+#
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height', 'frames', 'mode'])
+
+
+class ProbeError(Exception):
+    """The content is not a supported image or its header is corrupt"""
+
+
+class TruncatedHeader(ProbeError):
+    """The content ends before the end of the image header"""
+
+
+JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+
+PNG_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+#
+# the start of frame markers, which carry the size of the image,
+# 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) are in the same range but are not frames
+#
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+#
+# the luminance quantization table of the JPEG standard (Annex K),
+# which libjpeg scales to the requested quality
+#
+JPEG_STD_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+#
+# the tags of the TIFF structure of the EXIF segment locating the thumbnail
+#
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+
+#
+# the markers with no length nor payload
+#
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | {0x01}
+
+
+def _unpack(fmt, data, offset):
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error:
+        raise TruncatedHeader('The image header ends before offset {}'.format(offset))
+
+
+def jpeg_segments(data):
+    """
+    Walk through the segments of the JPEG content `data`, the last one is the
+    start of scan (SOS) segment, followed by the image data up to the end of `data`
+    Returns
+    -------
+    generator
+        the `(marker, start, end)` of each segment, `start` being the offset of its marker,
+        its payload starts 4 bytes after it, when it has one
+    """
+    offset = 2
+    while True:
+        marker_start, marker = _unpack('>BB', data, offset)
+        if marker_start != 0xFF:
+            raise ProbeError('Invalid JPEG marker at {}'.format(offset))
+        if marker == 0xFF:
+            #
+            # fill byte before the marker
+            #
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            yield marker, offset, offset + 2
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            yield marker, offset, len(data)
+            return
+
+        length, = _unpack('>H', data, offset + 2)
+        yield marker, offset, offset + 2 + length
+        offset += 2 + length
+
+
+def _probe_jpeg(data):
+    for marker, start, end in jpeg_segments(data):
+        if marker in JPEG_SOF_MARKERS:
+            precision, height, width, components = _unpack('>BHHB', data, start + 4)
+            if components not in JPEG_MODES:
+                raise ProbeError('Unsupported JPEG with {} components'.format(components))
+            return ImageInfo('jpeg', width, height, 1, JPEG_MODES[components])
+    raise ProbeError('No JPEG frame header before the image data')
+
+
+def _probe_png(data):
+    length, chunk_type = _unpack('>I4s', data, 8)
+    if chunk_type != b'IHDR':
+        raise ProbeError('The PNG header does not start with IHDR')
+    width, height, depth, color_type = _unpack('>IIBB', data, 16)
+    if color_type not in PNG_MODES:
+        raise ProbeError('Unsupported PNG color type {}'.format(color_type))
+    mode = '1' if color_type == 0 and depth == 1 else PNG_MODES[color_type]
+
+    #
+    # an animated PNG has an `acTL` chunk before the image data
+    #
+    frames = None
+    offset = 8 + 12 + length
+    while offset + 8 <= len(data):
+        length, chunk_type = _unpack('>I4s', data, offset)
+        if chunk_type == b'acTL':
+            frames, = _unpack('>I', data, offset + 8)
+            break
+        if chunk_type == b'IDAT':
+            frames = 1
+            break
+        offset += 12 + length
+    return ImageInfo('png', width, height, frames, mode)
+
+
+def _skip_gif_sub_blocks(data, offset):
+    while True:
+        size, = _unpack('B', data, offset)
+        offset += 1 + size
+        if size == 0:
+            return offset
+
+
+def _probe_gif(data):
+    width, height, flags = _unpack('<HHB', data, 6)
+    offset = 13
+    if flags & 0x80:
+        offset += 3 << ((flags & 0x07) + 1)
+
+    #
+    # count the image descriptors, skipping over the compressed data
+    #
+    frames = 0
+    try:
+        while True:
+            block, = _unpack('B', data, offset)
+            if block == 0x3B:
+                break
+            elif block == 0x2C:
+                flags, = _unpack('B', data, offset + 9)
+                offset += 10
+                if flags & 0x80:
+                    offset += 3 << ((flags & 0x07) + 1)
+                offset = _skip_gif_sub_blocks(data, offset + 1)
+                frames += 1
+            elif block == 0x21:
+                offset = _skip_gif_sub_blocks(data, offset + 2)
+            else:
+                raise ProbeError('Invalid GIF block {:#x}'.format(block))
+    except TruncatedHeader:
+        frames = None
+    if frames == 0:
+        raise ProbeError('GIF with no image')
+    return ImageInfo('gif', width, height, frames, 'P')
+
+
+def _probe_webp(data):
+    chunk_type, = _unpack('4s', data, 12)
+    if chunk_type == b'VP8 ':
+        start_code, width, height = _unpack('<3sHH', data, 23)
+        if start_code != b'\x9d\x01\x2a':
+            raise ProbeError('Invalid VP8 start code')
+        return ImageInfo('webp', width & 0x3FFF, height & 0x3FFF, 1, 'RGB')
+    elif chunk_type == b'VP8L':
+        signature, bits = _unpack('<BI', data, 20)
+        if signature != 0x2F:
+            raise ProbeError('Invalid VP8L signature')
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        return ImageInfo('webp', width, height, 1, 'RGBA' if bits >> 28 & 1 else 'RGB')
+    elif chunk_type == b'VP8X':
+        flags, = _unpack('B', data, 20)
+        width = int.from_bytes(_unpack('3s', data, 24)[0], 'little') + 1
+        height = int.from_bytes(_unpack('3s', data, 27)[0], 'little') + 1
+        mode = 'RGBA' if flags & 0x10 else 'RGB'
+        if not flags & 0x02:
+            return ImageInfo('webp', width, height, 1, mode)
+
+        #
+        # count the `ANMF` chunks of the animation
+        #
+        frames = 0
+        offset = 12
+        while offset + 8 <= len(data):
+            chunk_type, length = _unpack('<4sI', data, offset)
+            frames += chunk_type == b'ANMF'
+            offset += 8 + length + (length & 1)
+        if offset != len(data):
+            frames = None
+        return ImageInfo('webp', width, height, frames, mode)
+    raise ProbeError('Unsupported WebP chunk {!r}'.format(chunk_type))
+
+
+def _probe_pillow(data):
+    #
+    # the other formats Pillow reads are only opened, which parses their header without decoding any pixel
+    #
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as img:
+            try:
+                frames = getattr(img, 'n_frames', 1)
+            except Exception:
+                #
+                # the frames may be past the end of the content given
+                #
+                frames = None
+            return ImageInfo(img.format.lower(), img.width, img.height, frames, img.mode)
+    except Exception as e:
+        raise ProbeError('Unsupported image format: {}'.format(e))
+
+
+def probe(data):
+    """
+    Read the format, size, number of frames and mode of the image content `data`
+    from its header. `data` may only be the start of the content. The formats
+    which are not parsed here are opened lazily with Pillow.
+    Returns
+    -------
+    ImageInfo
+        what is known about the image, `ProbeError` is raised if it is
+        not a supported image or its header is corrupt
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        info = _probe_jpeg(data)
+    elif data[:8] == b'\x89PNG\r\n\x1a\n':
+        info = _probe_png(data)
+    elif data[:6] in (b'GIF87a', b'GIF89a'):
+        info = _probe_gif(data)
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        info = _probe_webp(data)
+    else:
+        info = _probe_pillow(data)
+
+    if not info.width or not info.height:
+        raise ProbeError('Invalid image size {}x{}'.format(info.width, info.height))
+    return info
+
+
+def _tiff_thumbnail(tiff):
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if not order:
+        return None
+
+    #
+    # the thumbnail is described by the second IFD, which follows the one of the main image
+    #
+    ifd0, = _unpack(order + 'I', tiff, 4)
+    count, = _unpack(order + 'H', tiff, ifd0)
+    ifd1, = _unpack(order + 'I', tiff, ifd0 + 2 + count * 12)
+    if not ifd1:
+        return None
+
+    tags = {}
+    count, = _unpack(order + 'H', tiff, ifd1)
+    for entry in range(ifd1 + 2, ifd1 + 2 + count * 12, 12):
+        tag, value_type, value_count, value = _unpack(order + 'HHII', tiff, entry)
+        if value_type == 3:
+            value, = _unpack(order + 'H', tiff, entry + 8)
+        tags[tag] = value
+
+    start, length = tags.get(EXIF_THUMBNAIL_OFFSET), tags.get(EXIF_THUMBNAIL_LENGTH)
+    if not start or not length:
+        return None
+    thumbnail = tiff[start:start + length]
+    if len(thumbnail) != length or thumbnail[:3] != b'\xff\xd8\xff':
+        return None
+    return thumbnail
+
+
+def exif_thumbnail(data):
+    """
+    Find the JPEG thumbnail embedded in the EXIF segment of the JPEG content `data`,
+    `data` may only be the start of the content
+    Returns
+    -------
+    bytes
+        the thumbnail or None if there is none, or the EXIF segment is not whole in `data`
+    """
+    if data[:3] != b'\xff\xd8\xff':
+        return None
+    try:
+        for marker, start, end in jpeg_segments(data):
+            if marker in JPEG_SOF_MARKERS:
+                return None
+            if marker == 0xE1 and data[start + 4:start + 10] == b'Exif\x00\x00':
+                if end > len(data):
+                    return None
+                return _tiff_thumbnail(data[start + 10:end])
+    except ProbeError:
+        return None
+    return None
+
+
+def jpeg_quality(data):
+    """
+    Estimate the quality the JPEG content `data` was encoded at, from its luminance
+    quantization table, as libjpeg scales the table of the standard with the quality
+    Returns
+    -------
+    int
+        the estimated quality, between 1 and 100, or None if there is no luminance table
+    """
+    try:
+        for marker, start, end in jpeg_segments(data):
+            if marker in JPEG_SOF_MARKERS:
+                return None
+            if marker != 0xDB:
+                continue
+            #
+            # a DQT segment holds one or more tables, each one is prefixed
+            # by its precision (8 or 16 bits values) and its id
+            #
+            offset = start + 4
+            while offset < end:
+                spec, = _unpack('B', data, offset)
+                fmt = '>64H' if spec >> 4 else '64B'
+                table = _unpack(fmt, data, offset + 1)
+                if spec & 0x0F == 0:
+                    scale = 100.0 * sum(table) / sum(JPEG_STD_LUMINANCE_TABLE)
+                    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+                    return min(100, max(1, int(round(quality))))
+                offset += 1 + struct.calcsize(fmt)
+    except ProbeError:
+        return None
+    return None
@@ -0,0 +1,69 @@
+"""Search the encoder quality of the lossy formats for the operations which set no fixed quality"""
+
+import logging
+
+from snappy.settings import (MAX_BYTES_TRIALS, MAX_BYTES_MIN_QUALITY, COMPRESS_MIN_QUALITY, COMPRESS_TRIALS,
+                             DEFAULT_QUALITY_RATE)
+
+LOG = logging.getLogger(__name__)
+
+
+def search_quality(encode, max_bytes, upper, lower=MAX_BYTES_MIN_QUALITY, trials=MAX_BYTES_TRIALS):
+    """
+    Search for the highest quality between `lower` and `upper` whose output, as returned
+    by `encode(quality)`, fits in `max_bytes`. The size of the output grows with the quality,
+    so `upper` is tried first, then the range is bisected, with at most `trials` encodes.
+    Returns
+    -------
+    tuple
+        the quality and its output, the smallest output tried if none fits
+    """
+    lower = min(lower, upper)
+    best = None
+    smallest = None
+    quality = upper
+    for trial in range(trials):
+        output = encode(quality)
+        LOG.debug('quality {}: {} bytes'.format(quality, len(output)))
+        if len(output) <= max_bytes:
+            best = quality, output
+            lower = quality + 1
+        else:
+            if smallest is None or len(output) < len(smallest[1]):
+                smallest = quality, output
+            upper = quality - 1
+        if lower > upper:
+            break
+        quality = (lower + upper) // 2
+    if best is None:
+        LOG.warning('No quality fits in {} bytes, using {}'.format(max_bytes, smallest[0]))
+    return best or smallest
+
+
+def search_similar_quality(encode, similarity, threshold, upper=DEFAULT_QUALITY_RATE, lower=COMPRESS_MIN_QUALITY,
+                           trials=COMPRESS_TRIALS):
+    """
+    Search for the lowest quality between `lower` and `upper` whose output, as returned by
+    `encode(quality)`, has a `similarity(output)` of at least `threshold`. The similarity grows
+    with the quality, so the range is bisected, with at most `trials` encodes.
+    Returns
+    -------
+    tuple
+        the quality and its output, `upper` if no quality tried is similar enough
+    """
+    highest = upper
+    lower = min(lower, upper)
+    best = None
+    for trial in range(trials):
+        if lower > upper:
+            break
+        quality = (lower + upper) // 2
+        output = encode(quality)
+        score = similarity(output)
+        LOG.debug('quality {}: similarity {:.4f}'.format(quality, score))
+        if score >= threshold:
+            best = quality, output
+            upper = quality - 1
+        else:
+            lower = quality + 1
+    return best or (highest, encode(highest))
@@ -1,6 +1,8 @@
 """Standard API Gateway response objects"""
 
 import json
+from datetime import timezone
+from email.utils import format_datetime
 
 
 def generic(status_code, body, headers=None, **kwargs):
@@ -28,6 +30,24 @@ def ok(body):
     return generic(200, body)
 
 
+def moved_permanently(location, headers=None):
+    """301 Moved Permanently response"""
+    base_headers = {'Location': location}
+    if headers:
+        base_headers.update(headers)
+    return generic(301, '', base_headers)
+
+
+def not_modified(headers=None):
+    """304 Not Modified response"""
+    return generic(304, '', headers)
+
+
+def http_date(value):
+    """Format the datetime `value` as expected by the HTTP headers"""
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
 def error(status_code, errors):
     """Generic error response"""
     body = {
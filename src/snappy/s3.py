@@ -1,57 +1,225 @@
-import boto3
+import hashlib
+import botocore.session
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
-import unittest
-import os
-import ntpath
-import tempfile
-from snappy.settings import AWS_REGION
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from snappy.settings import AWS_REGION, S3_MAX_POOL_CONNECTIONS, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT, S3_MAX_ATTEMPTS, PROBE_BYTES
 
 LOG = logging.getLogger(__name__)
 
+#
+# the content of the object, along with the metadata used to build the response
+#
+S3Object = namedtuple('S3Object', ['body', 'etag', 'cache_control', 'content_type', 'last_modified'])
+
+_s3_client = None
+
+
 def get_aws_resource(aws_resource):
+    #
+    # boto3 is slow to import and only needed for the resources API,
+    # the handler uses the botocore client directly
+    #
+    import boto3
     return boto3.resource(aws_resource, AWS_REGION)
 
 
-def download_s3_obj(bucket, key):
+def get_s3_client():
     """
-    Download the file from s3 given `bucket` and `key`.
+    Get the s3 client shared by all the invocations of the container,
+    so the connections in its pool are reused.
     Returns
     -------
-    str
-        the filename of the downloaded file or None if the file was not found
+    S3.Client
+        the s3 client
+    """
+    global _s3_client
+    if _s3_client is None:
+        config = Config(
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            retries={'max_attempts': S3_MAX_ATTEMPTS},
+        )
+        _s3_client = botocore.session.get_session().create_client('s3', AWS_REGION, config=config)
+    return _s3_client
+
+
+class NotModified(Exception):
+    """The object has not changed since the version the client has"""
+
+    def __init__(self, s3_obj):
+        super(NotModified, self).__init__(s3_obj.etag)
+        #
+        # the metadata of the object, with no body
+        #
+        self.s3_obj = s3_obj
+
+
+def _obj_from_resp(s3_resp, body=None):
+    return S3Object(
+        body=body,
+        etag=s3_resp['ETag'],
+        cache_control=s3_resp.get('CacheControl'),
+        content_type=s3_resp.get('ContentType'),
+        last_modified=s3_resp.get('LastModified'),
+    )
+
+
+def _obj_from_not_modified(error, etag):
+    #
+    # the 304 response may only carry part of the metadata
+    #
+    headers = error.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    last_modified = headers.get('last-modified')
+    if last_modified:
+        last_modified = parsedate_to_datetime(last_modified)
+    return S3Object(
+        body=None,
+        etag=headers.get('etag', etag),
+        cache_control=headers.get('cache-control'),
+        content_type=headers.get('content-type'),
+        last_modified=last_modified,
+    )
+
+
+def _error_code(error):
+    return error.response['Error']['Code']
+
+
+def _is_not_modified(error):
+    return _error_code(error) in ('304', 'NotModified')
+
+
+def _object_size(s3_resp):
+    #
+    # `Content-Range: bytes 0-32767/1048576` on a ranged response
+    #
+    content_range = s3_resp.get('ContentRange')
+    if not content_range:
+        return None
+    return int(content_range.rpartition('/')[2])
+
+
+def _conditions(etag, modified_since):
+    if etag:
+        return {'IfNoneMatch': etag}
+    if modified_since:
+        return {'IfModifiedSince': modified_since}
+    return {}
+
+
+def _matches(s3_obj, etag, modified_since):
+    if etag:
+        return etag == '*' or s3_obj.etag == etag
+    if modified_since and s3_obj.last_modified:
+        return s3_obj.last_modified <= modified_since
+    return False
+
+
+def get_s3_obj(bucket, key, cache=None, etag=None, modified_since=None, check_head=None):
+    """
+    Download the object from s3 given `bucket` and `key`, with a single request for
+    both its body and its metadata.
+    When a `cache` is given, a cached copy of the object is revalidated with
+    a conditional request and only downloaded again if it has changed.
+    When the client already has the version of the object with the given `etag`,
+    or a version not older than `modified_since`, `NotModified` is raised.
+    When `check_head` is given, only the first `PROBE_BYTES` of the object are downloaded
+    first and passed to `check_head` along with the ETag of the object, which raises to stop
+    before the rest is downloaded, or returns the content to use instead of the whole object.
+    Returns
+    -------
+    S3Object
+        the downloaded object or None if the object was not found
     """
     f_info = bucket + ':' + key
-    basename = ntpath.basename(key)
-    name, ext = os.path.splitext(basename)
-    LOG.info('Downloading file from s3 at {}'.format(f_info))
-    s3_res = get_aws_resource('s3')
-    code, tmp_file = tempfile.mkstemp()
-    tmp_file = tmp_file + '.' + ext
+    cache_key = hashlib.sha256(f_info.encode()).hexdigest()
+    kwargs = {'Bucket': bucket, 'Key': key}
+
+    cached_body = cache.get(cache_key) if cache else None
+    cached_obj = cache.meta(cache_key) if cached_body is not None else None
+    if cached_obj:
+        #
+        # the client conditions are checked against the cached metadata once validated
+        #
+        kwargs['IfNoneMatch'] = cached_obj.etag
+    else:
+        kwargs.update(_conditions(etag, modified_since))
+    if check_head:
+        kwargs['Range'] = 'bytes=0-{}'.format(PROBE_BYTES - 1)
+
+    LOG.info('Getting s3 obj. at {}'.format(f_info))
     try:
-        s3_res.Bucket(bucket).download_file(key, tmp_file)
-    except ClientError:
+        s3_resp = get_s3_client().get_object(**kwargs)
+    except ClientError as e:
+        if _is_not_modified(e):
+            if not cached_obj:
+                raise NotModified(_obj_from_not_modified(e, etag))
+            LOG.info('Cached obj. is still valid for {}'.format(f_info))
+            if _matches(cached_obj, etag, modified_since):
+                raise NotModified(cached_obj)
+            return cached_obj._replace(body=cached_body)
+        if _error_code(e) == 'InvalidRange':
+            #
+            # the object is empty
+            #
+            return get_s3_obj(bucket, key, cache, etag, modified_since)
         LOG.exception('File not found: {}'.format(f_info))
         return None
-    return tmp_file
 
+    s3_obj = _obj_from_resp(s3_resp, body=s3_resp['Body'].read())
+
+    size = _object_size(s3_resp)
+    if size is not None and len(s3_obj.body) < size:
+        if _matches(s3_obj, etag, modified_since):
+            raise NotModified(s3_obj._replace(body=None))
+        substitute = check_head(s3_obj.body, s3_obj.etag)
+        if substitute is not None:
+            return s3_obj._replace(body=substitute)
 
-def get_s3_obj(bucket, key):
+        LOG.info('Getting the remaining {} bytes of s3 obj. at {}'.format(size - len(s3_obj.body), f_info))
+        try:
+            s3_resp = get_s3_client().get_object(
+                Bucket=bucket, Key=key, Range='bytes={}-'.format(len(s3_obj.body)), IfMatch=s3_obj.etag)
+        except ClientError as e:
+            if _error_code(e) not in ('412', 'PreconditionFailed'):
+                raise
+            #
+            # the object changed between the two requests
+            #
+            LOG.info('s3 obj. at {} changed while downloading it'.format(f_info))
+            return get_s3_obj(bucket, key, cache, etag, modified_since)
+        s3_obj = s3_obj._replace(body=s3_obj.body + s3_resp['Body'].read())
+
+    if cache:
+        #
+        # only the metadata is kept in memory, the body is stored by the cache
+        #
+        cache.put(cache_key, s3_obj.body, meta=s3_obj._replace(body=None))
+    if _matches(s3_obj, etag, modified_since):
+        raise NotModified(s3_obj._replace(body=None))
+    return s3_obj
+
+
+def head_s3_obj(bucket, key, etag=None, modified_since=None):
     """
-    Get resource representing an s3 object given `bucket` and `key`.
+    Get the metadata of the object in s3 given `bucket` and `key`, without its body.
+    `NotModified` is raised on the same conditions as `get_s3_obj`.
     Returns
     -------
-    S3.Object
-        the s3 object or None if the object does not exist
+    S3Object
+        the object with no body or None if the object was not found
     """
     f_info = bucket + ':' + key
-    LOG.info('Getting s3 obj. at {}'.format(f_info))
-    s3_res = get_aws_resource('s3')
-    obj = s3_res.Object(bucket, key)
+    LOG.info('Getting s3 obj. metadata at {}'.format(f_info))
     try:
-        obj.load()
-    except ClientError:
+        s3_resp = get_s3_client().head_object(Bucket=bucket, Key=key, **_conditions(etag, modified_since))
+    except ClientError as e:
+        if _is_not_modified(e):
+            raise NotModified(_obj_from_not_modified(e, etag))
         LOG.exception('File not found: {}'.format(f_info))
         return None
-    return obj
-    
\ No newline at end of file
+    return _obj_from_resp(s3_resp)
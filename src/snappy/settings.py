@@ -10,6 +10,69 @@ except KeyError:
     AWS_REGION = 'us-west-2'
     BUCKET = 'testing'
 
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+#
+# build the s3 client and the Pillow plugins
+# when the function is loaded, during the init phase of the Lambda
+#
+WARMUP = os.environ.get('WARMUP', 'true').lower() == 'true'
+
+#
+# the s3 client is shared by all the invocations of a container
+#
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 10))
+S3_CONNECT_TIMEOUT = float(os.environ.get('S3_CONNECT_TIMEOUT', 2))
+S3_READ_TIMEOUT = float(os.environ.get('S3_READ_TIMEOUT', 5))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', 2))
+
+#
+# `pillow` transforms the images in process, `imagemagick` runs `convert`
+# for every request and `imagemagick-pool` keeps ImageMagick workers running
+# with the MagickWand binding (the optional `Wand` package).
+# `convert` is always used as a fallback.
+#
+TRANSFORM_ENGINE = os.environ.get('TRANSFORM_ENGINE', 'pillow')
+
+#
+# the `imagemagick-pool` workers are replaced after `MAGICK_POOL_MAX_JOBS` jobs,
+# once their memory goes above `MAGICK_POOL_MAX_RSS_MB`, or when a job takes
+# more than `MAGICK_POOL_TIMEOUT` seconds
+#
+MAGICK_POOL_SIZE = int(os.environ.get('MAGICK_POOL_SIZE', 1))
+MAGICK_POOL_TIMEOUT = float(os.environ.get('MAGICK_POOL_TIMEOUT', 8))
+MAGICK_POOL_MAX_JOBS = int(os.environ.get('MAGICK_POOL_MAX_JOBS', 500))
+MAGICK_POOL_MAX_RSS_MB = int(os.environ.get('MAGICK_POOL_MAX_RSS_MB', 768))
+
+#
+# the renditions are cached in the container's /tmp and,
+# when `RENDITION_CACHE_BUCKET` is set, under a prefix in s3.
+# Set `RENDITION_CACHE_MAX_BYTES` to 0 to disable the cache.
+#
+CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/snappy')
+RENDITION_CACHE_DIR = os.path.join(CACHE_DIR, 'renditions')
+RENDITION_CACHE_MAX_BYTES = int(os.environ.get('RENDITION_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+RENDITION_CACHE_BUCKET = os.environ.get('RENDITION_CACHE_BUCKET')
+RENDITION_CACHE_PREFIX = os.environ.get('RENDITION_CACHE_PREFIX', '_renditions/')
+
+#
+# the source images downloaded by a container are kept in /tmp
+# and revalidated with their ETag on the next requests.
+# Set `SOURCE_CACHE_MAX_BYTES` to 0 to disable the cache.
+#
+SOURCE_CACHE_DIR = os.path.join(CACHE_DIR, 'sources')
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get('SOURCE_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+
+#
+# when enabled, requests are redirected to a single canonical query string:
+# aliases resolved, keys sorted and defaults dropped.
+# `w` and `h` are rounded up to the next of the `SIZE_BREAKPOINTS`, keeping
+# the requested aspect ratio, and `dpr` to the next of the `DPR_BREAKPOINTS`.
+#
+CANONICAL_REDIRECTS = os.environ.get('CANONICAL_REDIRECTS', 'false').lower() == 'true'
+CANONICAL_REDIRECT_MAX_AGE = int(os.environ.get('CANONICAL_REDIRECT_MAX_AGE', 86400))
+SIZE_BREAKPOINTS = tuple(int(v) for v in os.environ.get('SIZE_BREAKPOINTS', '').split(',') if v)
+DPR_BREAKPOINTS = tuple(float(v) for v in os.environ.get('DPR_BREAKPOINTS', '').split(',') if v)
 
 PARAM_ALIASES = {
     'width': 'w',
@@ -25,8 +88,119 @@ AGRESSIVE_QUALITY_RATE = 45
 
 SUPPORTED_FORMATS = ['jpeg', 'jpg', 'png', 'gif', 'webp']
 
+#
+# the resampling filters, from the cheapest to the sharpest. Without `resample`, the images
+# downscaled by `RESAMPLE_FAST_FACTOR` or more use `fast`, the others `RESAMPLE_DEFAULT`.
+#
+RESAMPLE_FILTERS = ['fast', 'balanced', 'sharp']
+RESAMPLE_DEFAULT = os.environ.get('RESAMPLE_DEFAULT', 'sharp')
+RESAMPLE_FAST_FACTOR = float(os.environ.get('RESAMPLE_FAST_FACTOR', 4))
+
+#
+# the settings of the JPEG and WebP encoders, beyond the quality, selected with `profile`
+# or `ENCODER_PROFILE` when not given. `auto` picks `graphic` for the images with a palette
+# or no more than `GRAPHIC_MAX_COLORS` colors, `photo` for the others. A graphic is only
+# encoded as lossless WebP when no `max_bytes` is given.
+#
+ENCODER_PROFILES = {
+    'photo': {'progressive': True, 'optimize': True, 'subsampling': '4:2:0', 'webp_method': 4, 'webp_lossless': False},
+    'graphic': {'progressive': False, 'optimize': True, 'subsampling': '4:4:4', 'webp_method': 6, 'webp_lossless': True},
+    'fast': {'progressive': False, 'optimize': False, 'subsampling': '4:2:0', 'webp_method': 0, 'webp_lossless': False},
+}
+ENCODER_PROFILE = os.environ.get('ENCODER_PROFILE', 'auto')
+GRAPHIC_MAX_COLORS = int(os.environ.get('GRAPHIC_MAX_COLORS', 256))
+
+#
+# the formats `auto=format` chooses from, in order of preference, when the client accepts them
+#
+AUTO_FORMATS = tuple(v for v in os.environ.get('AUTO_FORMATS', 'webp').split(',') if v)
+
+#
+# number of distinct query strings whose validation is memoized
+#
+PARAMS_CACHE_SIZE = 1024
+
+#
+# number of source images whose header probe is kept in memory
+#
+PROBE_CACHE_SIZE = int(os.environ.get('PROBE_CACHE_SIZE', 1024))
+
+#
+# admission limits of the source images, checked from their header before they are
+# downloaded whole. The width and height limits are also set in policy.xml for ImageMagick.
+# Oversized images are either served untransformed (`passthrough`) or rejected with a 422 (`reject`).
+#
+PROBE_BYTES = int(os.environ.get('PROBE_BYTES', 32 * 1024))
+MAX_SOURCE_WIDTH = int(os.environ.get('MAX_SOURCE_WIDTH', 16384))
+MAX_SOURCE_HEIGHT = int(os.environ.get('MAX_SOURCE_HEIGHT', 16384))
+MAX_SOURCE_MEGAPIXELS = float(os.environ.get('MAX_SOURCE_MEGAPIXELS', 50))
+MAX_SOURCE_PIXELS = int(MAX_SOURCE_MEGAPIXELS * 1000 * 1000)
+OVERSIZED_IMAGES = os.environ.get('OVERSIZED_IMAGES', 'passthrough')
+
+#
+# frames are dropped evenly from the animations with more than `ANIMATION_MAX_FRAMES` frames,
+# or `ANIMATION_THUMBNAIL_MAX_FRAMES` when the output fits in `ANIMATION_THUMBNAIL_SIZE` pixels,
+# or more than `ANIMATION_MAX_MEGAPIXELS` megapixels in all their output frames.
+# The frames dropped before the last one kept are still decoded, each frame being composed
+# over the previous ones: the sources with more than `MAX_SOURCE_FRAMES` frames, or more than
+# `ANIMATION_MAX_SOURCE_MEGAPIXELS` megapixels in all their frames, are oversized.
+#
+ANIMATION_MAX_FRAMES = int(os.environ.get('ANIMATION_MAX_FRAMES', 150))
+ANIMATION_THUMBNAIL_SIZE = int(os.environ.get('ANIMATION_THUMBNAIL_SIZE', 200))
+ANIMATION_THUMBNAIL_MAX_FRAMES = int(os.environ.get('ANIMATION_THUMBNAIL_MAX_FRAMES', 30))
+ANIMATION_MAX_MEGAPIXELS = float(os.environ.get('ANIMATION_MAX_MEGAPIXELS', 10))
+ANIMATION_MAX_PIXELS = int(ANIMATION_MAX_MEGAPIXELS * 1000 * 1000)
+MAX_SOURCE_FRAMES = int(os.environ.get('MAX_SOURCE_FRAMES', 1000))
+ANIMATION_MAX_SOURCE_MEGAPIXELS = float(os.environ.get('ANIMATION_MAX_SOURCE_MEGAPIXELS', 200))
+ANIMATION_MAX_SOURCE_PIXELS = int(ANIMATION_MAX_SOURCE_MEGAPIXELS * 1000 * 1000)
+
+#
+# the transformations are planned to complete `DEADLINE_MARGIN_MS` before the Lambda times out,
+# their cost is estimated from the number of megapixels the engines process per second.
+# When it is above the time left divided by `DEADLINE_HEADROOM`, cheaper choices are made
+# and the response is only cached for `DEGRADED_MAX_AGE` seconds. Whatever the estimate,
+# the source is served untransformed when all the output frames have more megapixels
+# than `DEGRADED_MEGAPIXELS_PER_SECOND` times the seconds left, the rate of the cheapest
+# choices on an animated WebP.
+#
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', 1000))
+DEADLINE_HEADROOM = float(os.environ.get('DEADLINE_HEADROOM', 1.5))
+TRANSFORM_MEGAPIXELS_PER_SECOND = float(os.environ.get('TRANSFORM_MEGAPIXELS_PER_SECOND', 20))
+DEGRADED_MEGAPIXELS_PER_SECOND = float(os.environ.get('DEGRADED_MEGAPIXELS_PER_SECOND', 5))
+DEGRADED_MAX_AGE = int(os.environ.get('DEGRADED_MAX_AGE', 60))
+
 MAX_IMAGE_W = 2000
 MAX_IMAGE_H = MAX_IMAGE_W
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+#
+# `max_bytes` searches for the highest quality whose output fits in the budget,
+# between `MAX_BYTES_MIN_QUALITY` and the requested quality, with at most
+# `MAX_BYTES_TRIALS` encodes. The qualities found are kept in memory for
+# `QUALITY_CACHE_SIZE` renditions.
+#
+MAX_BYTES_TRIALS = int(os.environ.get('MAX_BYTES_TRIALS', 7))
+MAX_BYTES_MIN_QUALITY = int(os.environ.get('MAX_BYTES_MIN_QUALITY', 10))
+QUALITY_CACHE_SIZE = int(os.environ.get('QUALITY_CACHE_SIZE', 1024))
+
+#
+# `auto=compress` searches for the lowest quality, between `COMPRESS_MIN_QUALITY` and
+# `DEFAULT_QUALITY_RATE`, whose output keeps a structural similarity (SSIM) to the image
+# of at least `COMPRESS_SSIM_THRESHOLD`, with at most `COMPRESS_TRIALS` encodes.
+# The images are compared once downsampled to `SIMILARITY_SIZE` pixels on their longest side.
+# `AGRESSIVE_QUALITY_RATE` is used by the engines which cannot search.
+#
+COMPRESS_SSIM_THRESHOLD = float(os.environ.get('COMPRESS_SSIM_THRESHOLD', 0.95))
+COMPRESS_MIN_QUALITY = int(os.environ.get('COMPRESS_MIN_QUALITY', 30))
+COMPRESS_TRIALS = int(os.environ.get('COMPRESS_TRIALS', 5))
+SIMILARITY_SIZE = int(os.environ.get('SIMILARITY_SIZE', 256))
+
+#
+# `auto=compress` tries lossless optimizations of the PNG and GIF outputs
+# for `OPTIMIZE_TIME_BUDGET_MS` at most, the best ones are kept in memory
+# for `QUALITY_CACHE_SIZE` renditions
+#
+OPTIMIZE_TIME_BUDGET_MS = int(os.environ.get('OPTIMIZE_TIME_BUDGET_MS', 300))
 
 TRANSFORMATIONS_SCHEMA = {
     '$schema': 'http://json-schema.org/draft-04/schema#',
@@ -60,7 +234,18 @@ TRANSFORMATIONS_SCHEMA = {
             'maximum': 8
         },
         'auto': {
-            'enum': ['compress']
+            'enum': ['compress', 'format', 'compress,format']
+        },
+        'max_bytes': {
+            'type': 'integer',
+            'minimum': 1,
+            'maximum': MAX_IMAGE_BYTES
+        },
+        'resample': {
+            'enum': RESAMPLE_FILTERS
+        },
+        'profile': {
+            'enum': list(ENCODER_PROFILES)
         }
     }
 
@@ -0,0 +1,81 @@
+"""
+Compare an encoded image with the image it was encoded from, using the structural similarity
+index (SSIM) of their luma, downsampled so the comparison stays cheap next to the encode itself.
+"""
+
+from io import BytesIO
+
+from PIL import Image
+
+from snappy.settings import SIMILARITY_SIZE
+
+#
+# the side of the square windows the similarity is computed on, the index of the image
+# is the mean of the index of its windows
+#
+WINDOW = 8
+
+#
+# the constants stabilizing the division, for 8 bits values
+#
+C1 = (0.01 * 255) ** 2
+C2 = (0.03 * 255) ** 2
+
+
+def luma(img):
+    """
+    Returns
+    -------
+    numpy.ndarray
+        the luma of `img` as floats, downsampled to fit into `SIMILARITY_SIZE`
+    """
+    #
+    # numpy takes a while to import, only the requests searching for a quality need it
+    #
+    import numpy
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    img = img.convert('L')
+    scale = SIMILARITY_SIZE / max(img.size)
+    if scale < 1:
+        img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.BILINEAR)
+    return numpy.asarray(img, dtype=numpy.float64)
+
+
+def _windows(values):
+    h, w = values.shape
+    rows, cols = max(1, h // WINDOW), max(1, w // WINDOW)
+    wh, ww = min(h, WINDOW), min(w, WINDOW)
+    values = values[:rows * wh, :cols * ww]
+    return values.reshape(rows, wh, cols, ww).swapaxes(1, 2).reshape(rows * cols, wh * ww)
+
+
+def ssim(a, b):
+    """
+    Compute the structural similarity index of the luma `a` and `b`, of the same shape
+    Returns
+    -------
+    float
+        the index, 1 when they are identical
+    """
+    a, b = _windows(a), _windows(b)
+    mu_a, mu_b = a.mean(axis=1), b.mean(axis=1)
+    var_a, var_b = a.var(axis=1), b.var(axis=1)
+    cov = ((a - mu_a[:, None]) * (b - mu_b[:, None])).mean(axis=1)
+    index = ((2 * mu_a * mu_b + C1) * (2 * cov + C2)) / ((mu_a ** 2 + mu_b ** 2 + C1) * (var_a + var_b + C2))
+    return float(index.mean())
+
+
+def similarity(reference, data):
+    """
+    Returns
+    -------
+    float
+        the structural similarity index of the image content `data`
+        to the `reference` luma, as returned by `luma`
+    """
+    with Image.open(BytesIO(data)) as img:
+        return ssim(reference, luma(img))
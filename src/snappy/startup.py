@@ -0,0 +1,109 @@
+"""
+Report where the cold start of the transform function spends its time:
+the import time of each module, and the time spent by the init phase warmup.
+
+    python -m snappy.startup [--limit N] [module]
+
+The imports are timed by a finder put first in `sys.meta_path`, which wraps the loader
+of every module, as `-X importtime` is only available from Python 3.7.
+"""
+
+import argparse
+import ast
+import subprocess
+import sys
+
+PROFILED_CODE = '''
+import sys
+import time
+
+stack = []
+times = []
+
+
+class TimedLoader(object):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def _timed(self, name, load, *args):
+        #
+        # the time of the imports nested in this one is removed from its own time
+        #
+        start = time.perf_counter()
+        stack.append(0)
+        try:
+            return load(*args)
+        finally:
+            nested = stack.pop()
+            elapsed = time.perf_counter() - start
+            if stack:
+                stack[-1] += elapsed
+            times.append((name, int((elapsed - nested) * 1e6), int(elapsed * 1e6)))
+
+    def create_module(self, spec):
+        return self._timed(spec.name, self.loader.create_module, spec)
+
+    def exec_module(self, module):
+        return self._timed(module.__name__, self.loader.exec_module, module)
+
+
+class TimingFinder(object):
+    @classmethod
+    def find_spec(cls, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is cls or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+sys.meta_path.insert(0, TimingFinder)
+start = time.perf_counter()
+import {module}
+total_ms = (time.perf_counter() - start) * 1000
+sys.meta_path.remove(TimingFinder)
+print(repr({{'times': times, 'total_ms': total_ms}}))
+'''
+
+
+def import_times(module='transform'):
+    """
+    Import `module` in a fresh interpreter, timing the load of every module it imports
+    Returns
+    -------
+    tuple
+        the list of `(module, self_us, cumulative_us)` for every imported module,
+        and the total time spent loading `module` in ms, warmup included
+    """
+    result = subprocess.run(
+        [sys.executable, '-c', PROFILED_CODE.format(module=module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    #
+    # the module may print while it is loaded, the report is the last line
+    #
+    report = ast.literal_eval(result.stdout.splitlines()[-1])
+    return [tuple(t) for t in report['times']], report['total_ms']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('module', nargs='?', default='transform')
+    parser.add_argument('--limit', type=int, default=30, help='number of modules to report')
+    args = parser.parse_args(argv)
+
+    times, total_ms = import_times(args.module)
+    print('{:>12} {:>12}  {}'.format('self [ms]', 'cumul. [ms]', 'module'))
+    for name, self_us, cumulative_us in sorted(times, key=lambda t: t[2], reverse=True)[:args.limit]:
+        print('{:>12.1f} {:>12.1f}  {}'.format(self_us / 1000, cumulative_us / 1000, name))
+    print('\nloaded {} in {:.1f} ms, including the warmup'.format(args.module, total_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 import string
 import random
 import base64
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+_mime_detector = None
+
 
 def rnd_str(length, choices=string.ascii_letters + string.digits):
     return ''.join(random.choice(choices) for i in range(length))
@@ -9,4 +15,30 @@ def base64_encode(b_value):
 	return base64.b64encode(b_value).decode()
 
 def base64_decode(bs64_value):
-	return base64.b64decode(bs64_value)
\ No newline at end of file
+	return base64.b64decode(bs64_value)
+
+@contextmanager
+def workspace():
+    """
+    Temporary directory for the files that cannot be kept in memory,
+    removed with all its content when the context exits
+    """
+    path = tempfile.mkdtemp(prefix='snappy-')
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def mime_detector():
+    """
+    Returns
+    -------
+    magic.Magic
+        the libmagic handle shared by all the invocations of the container
+    """
+    global _mime_detector
+    if _mime_detector is None:
+        import magic
+        _mime_detector = magic.Magic(mime=True)
+    return _mime_detector
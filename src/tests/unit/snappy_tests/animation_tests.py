@@ -0,0 +1,84 @@
+import unittest
+from io import BytesIO
+import PIL.Image
+from unittest import mock
+from snappy.animation import frame_limit, decimate, coalesce, frame_durations, fold_durations, kept_frames
+from snappy.settings import ANIMATION_MAX_FRAMES, ANIMATION_THUMBNAIL_MAX_FRAMES
+
+
+def animated_gif(count, size=(40, 30), duration=40):
+    frames = [PIL.Image.new('RGB', size, (index * 255 // count, 0, 0)) for index in range(count)]
+    output = BytesIO()
+    frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    return output.getvalue()
+
+
+class FrameLimitTests(unittest.TestCase):
+
+    def test_limits(self):
+        self.assertEqual(ANIMATION_MAX_FRAMES, frame_limit((300, 200)))
+        self.assertEqual(20, frame_limit((800, 600)))
+        self.assertEqual(ANIMATION_THUMBNAIL_MAX_FRAMES, frame_limit((200, 100)))
+        self.assertEqual(1, frame_limit((100000, 100000)))
+
+
+class DecimateTests(unittest.TestCase):
+
+    def test_decimate(self):
+        self.assertEqual([0, 1, 2], decimate(3, 10))
+        self.assertEqual([0, 3, 6, 9], decimate(12, 4))
+        self.assertEqual([0], decimate(12, 1))
+
+
+class KeptFramesTests(unittest.TestCase):
+
+    def test_kept(self):
+        self.assertEqual(decimate(300, ANIMATION_THUMBNAIL_MAX_FRAMES), kept_frames(300, (100, 100), 'webp'))
+        self.assertEqual([0], kept_frames(300, (100, 100), 'png'))
+
+
+class FrameDurationsTests(unittest.TestCase):
+
+    def test_gif(self):
+        self.assertEqual([20, 30, 40], frame_durations(animated_gif(3, duration=[20, 30, 40])))
+        self.assertEqual([100, 100], frame_durations(animated_gif(2, duration=0)))
+
+    def test_webp(self):
+        frames = [PIL.Image.new('RGB', (20, 10), (index * 50, 0, 0)) for index in range(3)]
+        output = BytesIO()
+        frames[0].save(output, 'WEBP', save_all=True, append_images=frames[1:], duration=[10, 20, 30])
+        self.assertEqual([10, 20, 30], frame_durations(output.getvalue()))
+
+    def test_not_animated(self):
+        output = BytesIO()
+        PIL.Image.new('RGB', (20, 10)).save(output, 'PNG')
+        self.assertIsNone(frame_durations(output.getvalue()))
+        self.assertIsNone(frame_durations(animated_gif(3)[:100]))
+
+
+class FoldDurationsTests(unittest.TestCase):
+
+    def test_fold(self):
+        self.assertEqual([30, 70], fold_durations([10, 20, 30, 40], [0, 2]))
+        self.assertEqual([10, 20], fold_durations([10, 20], [0, 1]))
+
+
+class CoalesceTests(unittest.TestCase):
+
+    def test_durations(self):
+        img = PIL.Image.open(BytesIO(animated_gif(12)))
+        frames, durations = coalesce(img, decimate(12, 4))
+        self.assertEqual(4, len(frames))
+        self.assertEqual('RGBA', frames[0].mode)
+        self.assertEqual([120] * 4, durations)
+
+    def test_known_durations(self):
+        data = animated_gif(12)
+        img = PIL.Image.open(BytesIO(data))
+        with mock.patch.object(img, 'seek', wraps=img.seek) as seek:
+            frames, durations = coalesce(img, [0, 6], frame_durations(data))
+        #
+        # the frames after the last one kept are not read
+        #
+        self.assertEqual(6, max(call[0][0] for call in seek.call_args_list))
+        self.assertEqual([240, 240], durations)
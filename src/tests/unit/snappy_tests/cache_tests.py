@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+from tests.unit.snappy_tests.s3_tests import S3MockerBase
+from snappy.cache import rendition_key, rendition_etag, source_etag, LocalCache, MemoryCache, S3Cache, RenditionCache
+
+
+class RenditionKeyTests(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(rendition_key('a.jpg', '"etag"', {'w': 10, 'h': 20}),
+                         rendition_key('a.jpg', '"etag"', {'h': 20, 'w': 10}))
+
+    def test_changes(self):
+        key = rendition_key('a.jpg', '"etag"', {'w': 10})
+        self.assertNotEqual(key, rendition_key('b.jpg', '"etag"', {'w': 10}))
+        self.assertNotEqual(key, rendition_key('a.jpg', '"other"', {'w': 10}))
+        self.assertNotEqual(key, rendition_key('a.jpg', '"etag"', {'w': 11}))
+
+
+class RenditionETagTests(unittest.TestCase):
+
+    def test_no_ops(self):
+        self.assertEqual('"abc"', rendition_etag('"abc"', {}))
+        self.assertEqual('"abc"', source_etag('"abc"', {}))
+
+    def test_round_trip(self):
+        etag = rendition_etag('"abc-2"', {'w': 10})
+        self.assertNotEqual('"abc-2"', etag)
+        self.assertEqual('"abc-2"', source_etag(etag, {'w': 10}))
+        self.assertIsNone(source_etag(etag, {'w': 11}))
+        self.assertIsNone(source_etag('W/' + etag, {'w': 10}))
+
+
+class LocalCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LocalCache(tempfile.mkdtemp(), max_bytes=10)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.put('a', b'1234'))
+        self.assertEqual(b'1234', self.cache.get('a'))
+
+    def test_lru_eviction(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.get('a')
+        self.cache.put('c', b'1234')
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(8, self.cache.size)
+
+    def test_too_big(self):
+        self.assertFalse(self.cache.put('a', b'0' * 11))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_reload(self):
+        self.cache.put('a', b'1234')
+        cache = LocalCache(self.cache.directory, max_bytes=10)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(4, cache.size)
+
+
+class MemoryCacheTests(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+
+class RenditionCacheTests(S3MockerBase):
+
+    def test_remote_tier(self):
+        remote = S3Cache(self.main_bucket, 'renditions/')
+        cache = RenditionCache(LocalCache(tempfile.mkdtemp(), max_bytes=10), remote)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'1234')
+
+        cache = RenditionCache(LocalCache(tempfile.mkdtemp(), max_bytes=10), remote)
+        self.assertEqual(b'1234', cache.get('a'))
+        self.assertEqual(b'1234', cache.local.get('a'))
@@ -0,0 +1,111 @@
+import time
+import unittest
+from unittest import mock
+from snappy.deadline import request_deadline, estimate, degrade, DEGRADATIONS
+from snappy.plan import compile_plan
+from snappy.probe import ImageInfo
+from snappy.settings import DEADLINE_MARGIN_MS, DEADLINE_HEADROOM
+
+
+class RequestDeadlineTests(unittest.TestCase):
+
+    def test_no_context(self):
+        self.assertIsNone(request_deadline(None))
+
+    def test_margin(self):
+        context = mock.Mock(**{'get_remaining_time_in_millis.return_value': DEADLINE_MARGIN_MS + 3000})
+        self.assertAlmostEqual(time.monotonic() + 3, request_deadline(context), delta=0.5)
+
+
+class EstimateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.info = ImageInfo('jpeg', 6000, 4000, 1, 'RGB')
+
+    def test_cheaper(self):
+        plan = compile_plan({'w': 1000, 'fm': 'webp'})
+        costs = [estimate(self.info, plan, DEGRADATIONS[:i]) for i in range(len(DEGRADATIONS))]
+        self.assertEqual(sorted(costs, reverse=True), costs)
+        self.assertGreater(costs[0], costs[-1])
+
+    def test_frames(self):
+        plan = compile_plan({'w': 100})
+        gif = ImageInfo('gif', 600, 400, 1, 'P')
+        self.assertAlmostEqual(10 * estimate(gif, plan), estimate(gif._replace(frames=10), plan))
+        #
+        # the frames dropped from a long animation are only decoded
+        #
+        self.assertLess(estimate(gif._replace(frames=1000), plan), 1000 * estimate(gif, plan))
+        self.assertEqual(estimate(gif, compile_plan({'w': 100, 'fm': 'jpg'})),
+                         estimate(gif._replace(frames=10), compile_plan({'w': 100, 'fm': 'jpg'})))
+
+    def test_animated_webp(self):
+        gif = ImageInfo('gif', 400, 400, 500, 'P')
+        plan = compile_plan({'w': 400, 'fm': 'webp'})
+        #
+        # the animation encoder of WebP is much slower at the highest effort
+        #
+        self.assertGreater(estimate(gif, plan), 5 * estimate(gif, compile_plan({'w': 400, 'fm': 'webp', 'profile': 'fast'})))
+        self.assertGreater(estimate(gif, plan), 20)
+        self.assertLess(estimate(gif, plan, ('low-effort',)), 10)
+
+    def test_engine(self):
+        plan = compile_plan({'w': 1000, 'fm': 'jpg', 'auto': 'compress'})
+        self.assertLess(estimate(self.info, plan, engine='imagemagick'), estimate(self.info, plan, engine='pillow'))
+        with mock.patch('snappy.deadline.TRANSFORM_ENGINE', 'imagemagick'):
+            self.assertEqual(estimate(self.info, plan, engine='imagemagick'), estimate(self.info, plan))
+
+    def test_profile(self):
+        fast = estimate(self.info, compile_plan({'w': 1000, 'fm': 'webp', 'profile': 'fast'}))
+        self.assertLess(fast, estimate(self.info, compile_plan({'w': 1000, 'fm': 'webp', 'profile': 'graphic'})))
+
+    def test_shrink_on_load(self):
+        plan = compile_plan({'w': 300})
+        self.assertLess(estimate(self.info, plan), estimate(self.info._replace(format='png'), plan))
+
+
+class DegradeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.info = ImageInfo('jpeg', 6000, 4000, 1, 'RGB')
+        self.plan = compile_plan({'w': 1000, 'fm': 'webp'})
+
+    def deadline(self, degraded):
+        return time.monotonic() + estimate(self.info, self.plan, degraded) * DEADLINE_HEADROOM + 0.5
+
+    def test_no_deadline(self):
+        self.assertEqual((), degrade(self.info, self.plan, None))
+
+    def test_in_time(self):
+        self.assertEqual((), degrade(self.info, self.plan, self.deadline(())))
+
+    def test_degraded(self):
+        with mock.patch('snappy.deadline.TRANSFORM_MEGAPIXELS_PER_SECOND', 1):
+            self.assertEqual(('low-effort',), degrade(self.info, self.plan, self.deadline(('low-effort',))))
+            self.assertEqual(DEGRADATIONS[:3], degrade(self.info, self.plan, self.deadline(DEGRADATIONS[:3])))
+
+    def test_headroom(self):
+        #
+        # the estimate fits in the time left, but not with the headroom
+        #
+        deadline = time.monotonic() + estimate(self.info, self.plan) * (1 + DEADLINE_HEADROOM) / 2
+        self.assertNotEqual((), degrade(self.info, self.plan, deadline))
+
+    def test_original(self):
+        self.assertEqual(DEGRADATIONS, degrade(self.info, self.plan, time.monotonic()))
+
+    def test_output_pixels(self):
+        gif = ImageInfo('gif', 400, 400, 500, 'P')
+        plan = compile_plan({'w': 400, 'fm': 'webp'})
+        deadline = time.monotonic() + 60
+        self.assertNotIn('original', degrade(gif, plan, deadline))
+        #
+        # whatever the estimate, too many pixels to output for the time left
+        #
+        with mock.patch('snappy.deadline.estimate', return_value=0), \
+                mock.patch('snappy.deadline.DEGRADED_MEGAPIXELS_PER_SECOND', 0.1):
+            self.assertEqual(DEGRADATIONS, degrade(gif, plan, deadline))
+
+
+if __name__ == '__main__':
+    unittest.main()
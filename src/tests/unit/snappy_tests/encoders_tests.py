@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+from snappy.encoders import profile_name, encoder_profile, lossless, EncoderProfile
+from snappy.plan import compile_plan
+from snappy.settings import ENCODER_PROFILES, GRAPHIC_MAX_COLORS
+
+
+class ProfileNameTests(unittest.TestCase):
+
+    def test_requested(self):
+        self.assertEqual('fast', profile_name(compile_plan({'profile': 'fast'}), 'P'))
+
+    def test_auto(self):
+        plan = compile_plan({'fm': 'webp'})
+        self.assertEqual('photo', profile_name(plan, 'RGB'))
+        self.assertEqual('graphic', profile_name(plan, 'P'))
+        self.assertEqual('graphic', profile_name(plan, 'RGBA', GRAPHIC_MAX_COLORS))
+        self.assertEqual('photo', profile_name(plan, 'RGBA', None))
+
+    @mock.patch('snappy.encoders.ENCODER_PROFILE', 'fast')
+    def test_policy(self):
+        self.assertEqual('fast', profile_name(compile_plan({}), 'P'))
+        self.assertEqual('photo', profile_name(compile_plan({'profile': 'photo'}), 'P'))
+
+
+class EncoderProfileTests(unittest.TestCase):
+
+    def test_profile(self):
+        self.assertEqual(EncoderProfile(**ENCODER_PROFILES['photo']), encoder_profile(compile_plan({}), 'RGB'))
+
+    def test_low_effort(self):
+        profile = encoder_profile(compile_plan({}), 'RGB', low_effort=True)
+        self.assertEqual((False, False, 0), (profile.progressive, profile.optimize, profile.webp_method))
+        self.assertFalse(lossless(encoder_profile(compile_plan({'fm': 'webp'}), 'P', low_effort=True), 'webp'))
+
+    def test_lossless(self):
+        profile = encoder_profile(compile_plan({'fm': 'webp'}), 'P')
+        self.assertTrue(lossless(profile, 'webp'))
+        self.assertFalse(lossless(profile, 'jpeg'))
+        #
+        # only the quality can meet a byte budget
+        #
+        self.assertFalse(lossless(encoder_profile(compile_plan({'fm': 'webp', 'max_bytes': 1000}), 'P'), 'webp'))
+        #
+        # nor a quality requested
+        #
+        self.assertFalse(lossless(encoder_profile(compile_plan({'fm': 'webp', 'q': 60}), 'P'), 'webp'))
@@ -0,0 +1,20 @@
+import unittest
+from snappy.images import identify, make_result
+from tests.unit.test_transform import read_image
+
+
+class ImagesTests(unittest.TestCase):
+
+    def test_make_result(self):
+        result = make_result(b'data', 'JPG', (10, 20))
+        self.assertEqual(('jpeg', 'image/jpeg', 10, 20, 4),
+                         (result.format, result.mime_type, result.width, result.height, result.length))
+
+    def test_identify(self):
+        result = identify(read_image('dice.png'))
+        self.assertEqual(('png', 'image/png', 800, 600), (result.format, result.mime_type, result.width, result.height))
+
+    def test_identify_unknown(self):
+        result = identify(b'plain text')
+        self.assertIsNone(result.format)
+        self.assertEqual('text/plain', result.mime_type)
@@ -0,0 +1,93 @@
+import os
+import time
+import unittest
+from snappy.magick_pool import WorkerPool, PoolError, JobTimeout, magick_executed
+from snappy.plan import compile_plan
+from snappy.probe import ImageInfo
+
+
+def echo(value):
+    return value, os.getpid()
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def pool(self, execute, timeout=5, max_jobs=100, max_rss=1 << 40):
+        pool = WorkerPool(execute, 1, timeout, max_jobs, max_rss)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_run(self):
+        pool = self.pool(echo)
+        value, pid = pool.run('a')
+        self.assertEqual('a', value)
+        self.assertNotEqual(os.getpid(), pid)
+        #
+        # the same worker runs the next job
+        #
+        self.assertEqual(('b', pid), pool.run('b'))
+
+    def test_start(self):
+        pool = self.pool(echo)
+        pool.start()
+        worker = pool.idle.get_nowait()
+        self.assertTrue(worker.alive())
+        pool.idle.put(worker)
+        self.assertEqual(worker.process.pid, pool.run('a')[1])
+
+    def test_max_jobs(self):
+        pool = self.pool(echo, max_jobs=2)
+        pids = [pool.run(i)[1] for i in range(4)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_max_rss(self):
+        pool = self.pool(echo, max_rss=1)
+        self.assertNotEqual(pool.run('a')[1], pool.run('b')[1])
+
+    def test_timeout(self):
+        pool = self.pool(sleep, timeout=0.5)
+        with self.assertRaises(JobTimeout):
+            pool.run(10)
+        #
+        # the stuck worker is replaced
+        #
+        self.assertIsInstance(pool.run(0), int)
+
+    def test_error(self):
+        pool = self.pool(fail)
+        with self.assertRaises(PoolError) as ctx:
+            pool.run('boom')
+        self.assertIn('boom', str(ctx.exception))
+        with self.assertRaises(PoolError):
+            pool.run('again')
+
+
+class MagickExecutedTests(unittest.TestCase):
+
+    def test_executed(self):
+        info = ImageInfo(format='jpeg', width=300, height=200, mode='RGB', frames=1)
+        self.assertEqual('decode(shrink-on-load) > resize(10x7, fast) > encode(jpeg, q=85, photo)',
+                         magick_executed(compile_plan({'w': 10}), info))
+        #
+        # ImageMagick does not search for a similar quality, nor optimize the output
+        #
+        self.assertEqual('decode > strip > encode(png)', magick_executed(compile_plan({'fm': 'png', 'auto': 'compress'}),
+                                                                        info._replace(format='png', mode='RGBA')))
+        info = ImageInfo(format='gif', width=40, height=30, mode='P', frames=5)
+        self.assertEqual('decode(coalesce, 5/5 frames) > resize(20x15, sharp) > encode(gif) > layers(optimize)',
+                         magick_executed(compile_plan({'w': 20}), info))
+
+
+if __name__ == '__main__':
+    unittest.main()
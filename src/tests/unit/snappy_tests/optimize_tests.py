@@ -0,0 +1,101 @@
+import unittest
+from unittest import mock
+from io import BytesIO
+import numpy
+import PIL.Image
+from snappy.optimize import optimize, opaque, exact_palette, Optimization, ORIGINAL
+from snappy.pillow_engine import image_transform
+from tests.unit.test_transform import read_image
+
+
+def few_colors(mode='RGBA', size=(120, 80)):
+    img = PIL.Image.new(mode, size, (255, 255, 255, 255)[:len(mode)])
+    for i, color in enumerate(((200, 30, 30, 255), (30, 200, 30, 255), (30, 30, 200, 255))):
+        img.paste(color[:len(mode)], (i * 40, 0, i * 40 + 40, 40))
+    return img
+
+
+def pixels(data):
+    with PIL.Image.open(BytesIO(data)) as img:
+        return numpy.asarray(img.convert('RGBA'))
+
+
+class VariantTests(unittest.TestCase):
+
+    def test_opaque(self):
+        self.assertEqual('RGB', opaque(few_colors()).mode)
+        self.assertIsNone(opaque(few_colors('RGB')))
+        img = few_colors()
+        img.putpixel((0, 0), (0, 0, 0, 128))
+        self.assertIsNone(opaque(img))
+
+    def test_exact_palette(self):
+        img = few_colors()
+        img.putpixel((0, 0), (0, 0, 0, 128))
+        palette_img, transparency = exact_palette(img, 'PNG')
+        self.assertEqual('P', palette_img.mode)
+        self.assertEqual(5, len(transparency))
+        #
+        # GIF only has one fully transparent color
+        #
+        self.assertIsNone(exact_palette(img, 'GIF'))
+        img.putpixel((0, 0), (0, 0, 0, 0))
+        self.assertIsNotNone(exact_palette(img, 'GIF')[1])
+
+    def test_too_many_colors(self):
+        img = PIL.Image.open(BytesIO(read_image('lincoln.jpg')))
+        self.assertIsNone(exact_palette(img, 'PNG'))
+
+
+class OptimizeTests(unittest.TestCase):
+
+    def test_smaller_and_identical(self):
+        img = few_colors()
+        img.putpixel((0, 0), (0, 0, 0, 128))
+        baseline = BytesIO()
+        img.save(baseline, 'PNG')
+        optimization, output = optimize(img, 'PNG', {})
+        self.assertEqual('palette', optimization.variant)
+        self.assertLess(len(output), len(baseline.getvalue()))
+        self.assertTrue(numpy.array_equal(numpy.asarray(img), pixels(output)))
+
+    def test_gif(self):
+        img = few_colors('RGB')
+        optimization, output = optimize(img, 'GIF', {})
+        self.assertTrue(numpy.array_equal(numpy.asarray(img.convert('RGBA')), pixels(output)))
+
+    def test_known(self):
+        img = few_colors()
+        optimization, output = optimize(img, 'PNG', {})
+        with mock.patch('snappy.optimize._encode', wraps=lambda *args: output) as encode:
+            self.assertEqual((optimization, output), optimize(img, 'PNG', {}, optimization))
+        encode.assert_called_once()
+
+    def test_source(self):
+        img = few_colors()
+        optimization, output = optimize(img, 'PNG', {})
+        self.assertEqual((ORIGINAL, output[:-1]), optimize(img, 'PNG', {}, source=output[:-1]))
+        self.assertEqual((optimization, output), optimize(img, 'PNG', {}, source=output + b'\0'))
+        #
+        # the source is served again without encoding
+        #
+        with mock.patch('snappy.optimize._encode') as encode:
+            self.assertEqual((ORIGINAL, b'source'), optimize(img, 'PNG', {}, ORIGINAL, b'source'))
+        encode.assert_not_called()
+        self.assertEqual(optimization, optimize(img, 'PNG', {}, ORIGINAL)[0])
+
+    def test_time_budget(self):
+        with mock.patch('snappy.optimize.OPTIMIZE_TIME_BUDGET_MS', -1):
+            self.assertIsNone(optimize(few_colors(), 'PNG', {})[0])
+
+    def test_engine(self):
+        data = BytesIO()
+        few_colors().save(data, 'PNG')
+        output = image_transform(data.getvalue(), {'w': 60, 'auto': 'compress'})
+        self.assertIsInstance(output.optimization, Optimization)
+        self.assertLess(output.length, image_transform(data.getvalue(), {'w': 60}).length)
+        self.assertIsNone(image_transform(data.getvalue(), {'w': 60, 'auto': 'compress'}, ('low-effort',)).optimization)
+
+
+if __name__ == '__main__':
+    unittest.main()
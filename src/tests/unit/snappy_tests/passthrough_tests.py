@@ -0,0 +1,117 @@
+import unittest
+from io import BytesIO
+import PIL.Image
+from snappy.passthrough import passthrough, strip_metadata, stripped_source
+from snappy.probe import probe, jpeg_quality
+from tests.unit.test_transform import read_image
+from tests.unit.snappy_tests.animation_tests import animated_gif
+
+
+def encode(img, fmt, **options):
+    output = BytesIO()
+    img.save(output, fmt, **options)
+    return output.getvalue()
+
+
+class JPEGQualityTests(unittest.TestCase):
+
+    def test_quality(self):
+        img = PIL.Image.open(BytesIO(read_image('lincoln.jpg')))
+        for quality in (30, 45, 70, 85, 95):
+            self.assertEqual(quality, jpeg_quality(encode(img, 'JPEG', quality=quality)))
+
+    def test_no_table(self):
+        self.assertIsNone(jpeg_quality(read_image('dice.png')))
+
+
+class PassthroughTests(unittest.TestCase):
+
+    def test_same_format_and_size(self):
+        data = read_image('dice.png')
+        info = probe(data)
+        self.assertIs(data, passthrough(data, info, {'fm': 'png'}))
+        self.assertIs(data, passthrough(data, info, {'w': 800, 'h': 600, 'fit': 'crop'}))
+        self.assertIs(data, passthrough(data, info, {'w': 800, 'h': 800, 'fit': 'bounds'}))
+
+    def test_transformed(self):
+        data = read_image('dice.png')
+        info = probe(data)
+        self.assertIsNone(passthrough(data, info, {'fm': 'jpeg'}))
+        self.assertIsNone(passthrough(data, info, {'w': 400}))
+        self.assertIsNone(passthrough(data, info, {'w': 800, 'h': 500, 'fit': 'crop'}))
+        self.assertIsNone(passthrough(data, info, {'dpr': 2}))
+
+    def test_quality(self):
+        img = PIL.Image.open(BytesIO(read_image('lincoln.jpg')))
+        data = encode(img, 'JPEG', quality=70)
+        info = probe(data)
+        self.assertIs(data, passthrough(data, info, {'fm': 'jpg'}))
+        self.assertIs(data, passthrough(data, info, {'q': 70}))
+        self.assertIsNone(passthrough(data, info, {'q': 60}))
+        self.assertIs(data, passthrough(data, info, {'max_bytes': len(data)}))
+        self.assertIsNone(passthrough(data, info, {'max_bytes': len(data) - 1}))
+        self.assertIsNone(passthrough(data, info, {'q': 70, 'profile': 'fast'}))
+        self.assertIsNone(passthrough(data, info, {'profile': 'photo'}))
+
+        data = encode(img, 'WEBP', quality=50)
+        self.assertIsNone(passthrough(data, probe(data), {'q': 80}))
+
+    def test_compress(self):
+        data = read_image('lincoln.jpg')
+        self.assertIsNone(passthrough(data, probe(data), {'auto': 'compress'}))
+
+        img = PIL.Image.open(BytesIO(data))
+        data = encode(img, 'JPEG', quality=40, exif=img.info['exif'], icc_profile=img.info['icc_profile'])
+        stripped = passthrough(data, probe(data), {'auto': 'compress'})
+        self.assertLess(len(stripped), len(data))
+        stripped_img = PIL.Image.open(BytesIO(stripped))
+        self.assertNotIn('exif', stripped_img.info)
+        self.assertNotIn('icc_profile', stripped_img.info)
+        self.assertEqual(PIL.Image.open(BytesIO(data)).tobytes(), stripped_img.tobytes())
+
+    def test_optimized(self):
+        #
+        # the PNG and GIF images are optimized, the source is only kept when it is smaller
+        #
+        for name in ('dice.png', 'terminal.gif'):
+            data = read_image(name)
+            self.assertIsNone(passthrough(data, probe(data), {'auto': 'compress'}))
+        data = animated_gif(3)
+        self.assertEqual(data, passthrough(data, probe(data), {'auto': 'compress'}))
+
+    def test_stripped_source(self):
+        data = read_image('dice.png')
+        info = probe(data)
+        self.assertEqual(strip_metadata(data, 'png'), stripped_source(data, info, {'auto': 'compress'}))
+        self.assertIsNone(stripped_source(data, info, {'w': 400, 'auto': 'compress'}))
+
+
+class StripMetadataTests(unittest.TestCase):
+
+    def test_png(self):
+        img = PIL.Image.open(BytesIO(read_image('dice.png')))
+        data = encode(img, 'PNG', icc_profile=b'\0' * 128)
+        stripped = strip_metadata(data, 'png')
+        self.assertLess(len(stripped), len(data))
+        stripped_img = PIL.Image.open(BytesIO(stripped))
+        self.assertNotIn('icc_profile', stripped_img.info)
+        self.assertEqual(img.tobytes(), stripped_img.tobytes())
+
+    def test_gif(self):
+        img = PIL.Image.open(BytesIO(read_image('terminal.gif')))
+        data = encode(img, 'GIF', comment=b'comment' * 10)
+        stripped = strip_metadata(data, 'gif')
+        self.assertLess(len(stripped), len(data))
+        stripped_img = PIL.Image.open(BytesIO(stripped))
+        self.assertNotIn('comment', stripped_img.info)
+        self.assertEqual(img.tobytes(), stripped_img.tobytes())
+        #
+        # the loop count of an animation is kept
+        #
+        data = animated_gif(3)
+        self.assertEqual(data, strip_metadata(data, 'gif'))
+        self.assertIsNone(strip_metadata(data[:20], 'gif'))
+
+    def test_unsupported(self):
+        data = encode(PIL.Image.new('RGB', (20, 10)), 'WEBP')
+        self.assertIsNone(strip_metadata(data, 'webp'))
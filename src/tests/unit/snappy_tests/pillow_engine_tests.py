@@ -0,0 +1,197 @@
+import unittest
+from unittest import mock
+from io import BytesIO
+import PIL.Image
+from PIL.JpegImagePlugin import JpegImageFile
+from snappy.pillow_engine import resize_geometry, draft_size, image_transform
+from snappy.plan import compile_plan
+from snappy.settings import (COMPRESS_MIN_QUALITY, COMPRESS_SSIM_THRESHOLD, DEFAULT_QUALITY_RATE,
+                             ANIMATION_THUMBNAIL_MAX_FRAMES)
+from snappy.similarity import luma, similarity
+from tests.unit.test_transform import read_image
+from tests.unit.snappy_tests.animation_tests import animated_gif
+
+
+class ResizeGeometryTests(unittest.TestCase):
+
+    def test_distort(self):
+        self.assertEqual(((50, 100), None), resize_geometry((35, 28), {'w': 50, 'h': 100}))
+
+    def test_fit(self):
+        ops = {'w': 50, 'h': 100, 'fit': 'bounds'}
+        self.assertEqual(((50, 40), None), resize_geometry((35, 28), ops))
+        ops = {'w': 50, 'h': 100, 'fit': 'crop'}
+        self.assertEqual(((125, 100), (50, 100)), resize_geometry((35, 28), ops))
+
+    def test_single_side(self):
+        self.assertEqual(((25, 20), None), resize_geometry((35, 28), {'w': 25}))
+        self.assertEqual(((25, 20), None), resize_geometry((35, 28), {'h': 20}))
+
+    def test_dpr(self):
+        self.assertEqual(((70, 56), None), resize_geometry((35, 28), {'dpr': 2}))
+        self.assertEqual(((50, 40), None), resize_geometry((35, 28), {'w': 25, 'dpr': 2}))
+
+
+class DraftSizeTests(unittest.TestCase):
+
+    def test_downscale(self):
+        self.assertEqual((100, 50), draft_size((1000, 500), compile_plan({'w': 50})))
+        self.assertEqual((400, 200), draft_size((1000, 500), compile_plan({'w': 100, 'h': 100, 'fit': 'crop'})))
+
+    def test_small_downscale(self):
+        self.assertIsNone(draft_size((1000, 500), compile_plan({'w': 300})))
+        self.assertIsNone(draft_size((1000, 500), compile_plan({'w': 100, 'dpr': 3})))
+        self.assertIsNone(draft_size((1000, 500), compile_plan({})))
+
+
+class PillowTransformTests(unittest.TestCase):
+
+    def test_shrink_on_load(self):
+        data = read_image('lincoln.jpg')
+        with mock.patch.object(JpegImageFile, 'draft', autospec=True, side_effect=JpegImageFile.draft) as draft:
+            output = image_transform(data, {'w': 50})
+        draft.assert_called_once_with(mock.ANY, 'RGB', (100, 66))
+        self.assertEqual((50, 33), (output.width, output.height))
+        self.assertEqual((50, 33), PIL.Image.open(BytesIO(output.data)).size)
+
+        with mock.patch.object(JpegImageFile, 'draft', autospec=True) as draft:
+            image_transform(data, {'w': 300})
+        draft.assert_not_called()
+
+
+    def test_resample(self):
+        data = read_image('dice.png')
+        with mock.patch.object(PIL.Image.Image, 'resize', autospec=True, side_effect=PIL.Image.Image.resize) as resize:
+            output = image_transform(data, {'w': 40})
+        #
+        # the images with an alpha channel are resized again once premultiplied by Pillow
+        #
+        self.assertEqual({((80, 60), PIL.Image.BOX), ((40, 30), PIL.Image.BILINEAR)},
+                         {call[0][1:3] for call in resize.call_args_list})
+        self.assertEqual((40, 30), (output.width, output.height))
+
+        for resample, pil_filter in (('sharp', PIL.Image.LANCZOS), ('balanced', PIL.Image.BICUBIC)):
+            with mock.patch.object(PIL.Image.Image, 'resize', autospec=True, side_effect=PIL.Image.Image.resize) as resize:
+                image_transform(data, {'w': 40, 'resample': resample})
+            self.assertEqual({((40, 30), pil_filter)}, {call[0][1:3] for call in resize.call_args_list})
+
+    def test_profiles(self):
+        img = PIL.Image.open(BytesIO(image_transform(read_image('lincoln.jpg'), {'w': 100}).data))
+        self.assertTrue(img.info.get('progressive'))
+        img = PIL.Image.open(BytesIO(image_transform(read_image('lincoln.jpg'), {'w': 100, 'profile': 'fast'}).data))
+        self.assertFalse(img.info.get('progressive'))
+
+    def test_graphic_to_webp(self):
+        graphic = PIL.Image.new('RGB', (200, 100), (255, 255, 255))
+        graphic.paste((200, 30, 30), (20, 20, 120, 80))
+        data = BytesIO()
+        graphic.save(data, 'PNG')
+        output = image_transform(data.getvalue(), {'fm': 'webp'})
+        self.assertIsNone(output.quality)
+        self.assertEqual(graphic.tobytes(), PIL.Image.open(BytesIO(output.data)).convert('RGB').tobytes())
+        #
+        # a byte budget is met with lossy WebP
+        #
+        self.assertIsNotNone(image_transform(data.getvalue(), {'fm': 'webp', 'max_bytes': 100}).quality)
+        #
+        # and so is a quality requested
+        #
+        self.assertEqual('decode > encode(webp, q=60, graphic)',
+                         image_transform(data.getvalue(), {'fm': 'webp', 'q': 60}).executed)
+        self.assertEqual('decode > encode(webp, q=85, graphic)',
+                         image_transform(data.getvalue(), {'fm': 'webp'}, degraded=('low-effort',)).executed)
+
+    def test_alpha_to_jpeg(self):
+        output = image_transform(read_image('dice.png'), {'fm': 'jpg', 'w': 80})
+        img = PIL.Image.open(BytesIO(output.data))
+        self.assertEqual('JPEG', img.format)
+        self.assertEqual((80, 60), img.size)
+        self.assertEqual(('jpeg', 'image/jpeg', 80, 60, len(output.data)),
+                         (output.format, output.mime_type, output.width, output.height, output.length))
+
+    def test_max_bytes(self):
+        data = read_image('lincoln.jpg')
+        full = image_transform(data, {'w': 300, 'fm': 'webp'})
+        output = image_transform(data, {'w': 300, 'fm': 'webp', 'max_bytes': full.length // 2})
+        self.assertLessEqual(output.length, full.length // 2)
+        self.assertLess(output.quality, 85)
+        self.assertEqual((300, 200), PIL.Image.open(BytesIO(output.data)).size)
+        #
+        # the budget is ignored by the lossless formats
+        #
+        self.assertIsNone(image_transform(data, {'w': 30, 'fm': 'png', 'max_bytes': 100}).quality)
+
+    def test_compress(self):
+        data = read_image('lincoln.jpg')
+        for width in (400, 100):
+            output = image_transform(data, {'w': width, 'fm': 'jpg', 'auto': 'compress'})
+            self.assertLessEqual(COMPRESS_MIN_QUALITY, output.quality)
+            self.assertLessEqual(output.quality, DEFAULT_QUALITY_RATE)
+            reference = PIL.Image.open(BytesIO(image_transform(data, {'w': width, 'fm': 'png'}).data))
+            self.assertGreaterEqual(similarity(luma(reference), output.data), COMPRESS_SSIM_THRESHOLD - 0.01)
+        #
+        # a fixed quality is used as is
+        #
+        self.assertIsNone(image_transform(data, {'w': 100, 'q': 60, 'auto': 'compress'}).quality)
+
+    def test_keeps_profiles(self):
+        data = read_image('lincoln.jpg')
+        img = PIL.Image.open(BytesIO(image_transform(data, {'w': 100}).data))
+        self.assertIn('icc_profile', img.info)
+        img = PIL.Image.open(BytesIO(image_transform(data, {'w': 100, 'auto': 'compress'}).data))
+        self.assertNotIn('icc_profile', img.info)
+        self.assertNotIn('exif', img.info)
+
+    def test_animation(self):
+        output = image_transform(animated_gif(300, (400, 300)), {'w': 100})
+        img = PIL.Image.open(BytesIO(output.data))
+        self.assertEqual(ANIMATION_THUMBNAIL_MAX_FRAMES, img.n_frames)
+        durations = []
+        for index in range(img.n_frames):
+            img.seek(index)
+            durations.append(img.info['duration'])
+        self.assertEqual(300 * 40, sum(durations))
+
+        img = PIL.Image.open(BytesIO(image_transform(animated_gif(5), {'w': 20, 'fm': 'webp'}).data))
+        self.assertEqual(('WEBP', 5), (img.format, img.n_frames))
+
+    def test_animation_loop(self):
+        img = PIL.Image.open(BytesIO(image_transform(animated_gif(2), {'w': 20}).data))
+        self.assertEqual(0, img.info['loop'])
+        #
+        # a GIF without a loop extension plays once
+        #
+        frames = [PIL.Image.new('RGB', (40, 30), color) for color in ((255, 0, 0), (0, 255, 0))]
+        data = BytesIO()
+        frames[0].save(data, 'GIF', save_all=True, append_images=frames[1:], duration=50)
+        self.assertNotIn('loop', PIL.Image.open(BytesIO(data.getvalue())).info)
+        img = PIL.Image.open(BytesIO(image_transform(data.getvalue(), {'w': 20}).data))
+        self.assertEqual(2, img.n_frames)
+        self.assertNotIn('loop', img.info)
+
+    def test_animation_transparency(self):
+        frames = [PIL.Image.new('RGBA', (40, 30), (255, 0, 0, 0)) for _ in range(3)]
+        frames[1].paste((0, 255, 0, 255), (0, 0, 20, 30))
+        data = BytesIO()
+        frames[0].save(data, 'GIF', save_all=True, append_images=frames[1:], duration=50, disposal=2)
+        img = PIL.Image.open(BytesIO(image_transform(data.getvalue(), {'w': 20}).data))
+        img.seek(1)
+        frame = img.convert('RGBA')
+        self.assertEqual(0, frame.getpixel((15, 5))[3])
+        self.assertEqual((0, 255, 0, 255), frame.getpixel((2, 5)))
+
+    def test_executed(self):
+        data = read_image('lincoln.jpg')
+        self.assertEqual('decode(shrink-on-load) > resize(10x7, fast) > encode(jpeg, q=85, photo)',
+                         image_transform(data, {'w': 10}).executed)
+        output = image_transform(data, {'w': 100, 'fm': 'webp', 'auto': 'compress'})
+        self.assertEqual('decode > resize(100x67, sharp) > strip > similarity({}) > encode(webp, q={}, photo)'
+                         .format(COMPRESS_SSIM_THRESHOLD, output.quality), output.executed)
+        #
+        # only the stages which change the image are described
+        #
+        self.assertEqual('decode > encode(png)', image_transform(data, {'fm': 'png'}).executed)
+        self.assertEqual('decode > colorspace(jpg) > encode(jpg, q=85, graphic)',
+                         image_transform(animated_gif(1), {'fm': 'jpg'}).executed)
+        self.assertEqual('decode(30/40 frames) > resize(20x15, sharp) > colorspace(gif) > encode(gif)',
+                         image_transform(animated_gif(40), {'w': 20}).executed)
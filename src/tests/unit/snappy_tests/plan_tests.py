@@ -0,0 +1,88 @@
+import unittest
+from snappy.plan import (compile_plan, fuse, explain, geometry, Decode, Resample, Resize, Crop, Extent, Dpr, Scale,
+                         Colorspace, Strip, Similarity, Optimize, Lossy, Encode, output_size, resample_filter, box_factor)
+from snappy.settings import DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE, COMPRESS_SSIM_THRESHOLD
+
+
+class CompilePlanTests(unittest.TestCase):
+
+    def test_order(self):
+        plan = compile_plan({'w': 10, 'fm': 'png', 'auto': 'compress'})
+        self.assertEqual((Decode(True), Resize(10, None, 'fit'), Colorspace('png'), Strip(),
+                          Similarity(COMPRESS_SSIM_THRESHOLD), Optimize(), Encode('png', AGRESSIVE_QUALITY_RATE)), plan)
+
+    def test_quality(self):
+        self.assertEqual(Encode(None, DEFAULT_QUALITY_RATE), compile_plan({})[-1])
+        plan = compile_plan({'q': 70, 'auto': 'compress'})
+        self.assertEqual([Strip, Optimize, Lossy, Encode], [type(stage) for stage in plan[-4:]])
+        self.assertEqual(Encode(None, 70), plan[-1])
+
+    def test_fit(self):
+        self.assertEqual(Resize(10, 20, 'distort'), compile_plan({'w': 10, 'h': 20})[1])
+        self.assertEqual(Resize(10, 20, 'fit'), compile_plan({'w': 10, 'h': 20, 'fit': 'clip'})[1])
+        self.assertEqual(Resize(10, 20, 'fit'), compile_plan({'w': 10, 'h': 20, 'fit': 'bounds'})[1])
+        self.assertEqual(Extent(10, 20), compile_plan({'w': 10, 'h': 20, 'fit': 'crop'})[1])
+
+    def test_resample(self):
+        self.assertEqual((Decode(True), Resample('fast'), Resize(10, None, 'fit')),
+                         compile_plan({'w': 10, 'resample': 'fast'})[:3])
+
+    def test_memoized(self):
+        self.assertIs(compile_plan({'w': 10, 'h': 20}), compile_plan({'h': 20, 'w': 10}))
+
+
+class FuseTests(unittest.TestCase):
+
+    def test_dpr_into_resize(self):
+        self.assertEqual([Resize(20.0, None, 'fit')], fuse([Resize(10, None, 'fit'), Dpr(2.0)]))
+        self.assertEqual([Extent(20.0, 30.0)], fuse([Resize(10, 15, 'cover'), Crop(10, 15), Dpr(2.0)]))
+
+    def test_dpr_alone(self):
+        self.assertEqual([Decode(False), Scale(2.0)], fuse([Decode(False), Dpr(2.0)]))
+        self.assertEqual([Decode(False)], fuse([Decode(False), Dpr(1.0)]))
+
+    def test_crop_into_extent(self):
+        self.assertEqual([Extent(10, 15)], fuse([Resize(10, 15, 'cover'), Crop(10, 15)]))
+
+
+class GeometryTests(unittest.TestCase):
+
+    def test_stages(self):
+        self.assertEqual(((50, 40), None), geometry((35, 28), Resize(50, 100, 'fit')))
+        self.assertEqual(((50, 100), None), geometry((35, 28), Resize(50, 100, 'distort')))
+        self.assertEqual(((125, 100), (50, 100)), geometry((35, 28), Extent(50, 100)))
+        self.assertEqual(((70, 56), None), geometry((35, 28), Scale(2.0)))
+        self.assertEqual(((35, 28), None), geometry((35, 28), None))
+
+    def test_output_size(self):
+        self.assertEqual((50, 100), output_size((35, 28), compile_plan({'w': 50, 'h': 100, 'fit': 'crop'})))
+        self.assertEqual((50, 40), output_size((35, 28), compile_plan({'w': 50})))
+        self.assertEqual((35, 28), output_size((35, 28), compile_plan({'fm': 'png'})))
+
+
+class ResampleTests(unittest.TestCase):
+
+    def test_filter(self):
+        self.assertEqual('sharp', resample_filter((400, 300), compile_plan({'w': 200})))
+        self.assertEqual('fast', resample_filter((400, 300), compile_plan({'w': 100})))
+        self.assertEqual('balanced', resample_filter((400, 300), compile_plan({'w': 100, 'resample': 'balanced'})))
+        self.assertEqual('fast', resample_filter((400, 300), compile_plan({'w': 200, 'resample': 'sharp'}), fast=True))
+
+    def test_box_factor(self):
+        self.assertEqual(1, box_factor((400, 300), (200, 150)))
+        self.assertEqual(2, box_factor((400, 300), (100, 75)))
+        self.assertEqual(3, box_factor((700, 300), (100, 50)))
+
+
+class ExplainTests(unittest.TestCase):
+
+    def test_explain(self):
+        plan = compile_plan({'w': 100, 'h': 50, 'fit': 'crop', 'dpr': 2.0, 'fm': 'webp', 'auto': 'compress'})
+        self.assertEqual('decode(shrink-on-load) > extent(200x100) > colorspace(webp) > strip > similarity({:g}) > '
+                         'optimize > encode(webp, q=45)'.format(COMPRESS_SSIM_THRESHOLD), explain(plan))
+        self.assertEqual('decode > scale(1.5) > encode(source, q=85)', explain(compile_plan({'dpr': 1.5})))
+        self.assertEqual('decode > budget(20000) > encode(source, q=85)', explain(compile_plan({'max_bytes': 20000})))
+        self.assertEqual('decode(shrink-on-load) > resample(fast) > resize(100x, fit) > encode(source, q=85)',
+                         explain(compile_plan({'w': 100, 'resample': 'fast'})))
+        self.assertEqual('decode > colorspace(jpg) > profile(photo) > encode(jpg, q=85)',
+                         explain(compile_plan({'fm': 'jpg', 'profile': 'photo'})))
@@ -0,0 +1,93 @@
+import struct
+import unittest
+from io import BytesIO
+import PIL.Image
+from snappy.probe import probe, exif_thumbnail, ImageInfo, ProbeError, TruncatedHeader
+from tests.unit.test_transform import read_image
+
+
+def encode(fmt, frames, **options):
+    output = BytesIO()
+    frames[0].save(output, fmt, save_all=True, append_images=frames[1:], **options)
+    return output.getvalue()
+
+
+def exif_jpeg(size, thumbnail_size):
+    """
+    Returns
+    -------
+    tuple
+        a JPEG of `size` with an EXIF thumbnail of `thumbnail_size`, and the thumbnail
+    """
+    thumbnail = BytesIO()
+    PIL.Image.new('RGB', thumbnail_size, (200, 0, 0)).save(thumbnail, 'JPEG')
+    thumbnail = thumbnail.getvalue()
+    #
+    # an empty IFD0 followed by an IFD1 pointing at the thumbnail
+    #
+    tiff = b'II*\x00' + struct.pack('<IHI', 8, 0, 14)
+    tiff += struct.pack('<HHHIIHHIII', 2, 0x0201, 4, 1, 44, 0x0202, 4, 1, len(thumbnail), 0)
+    output = BytesIO()
+    PIL.Image.new('RGB', size, (0, 0, 200)).save(output, 'JPEG', exif=b'Exif\x00\x00' + tiff + thumbnail)
+    return output.getvalue(), thumbnail
+
+
+class ProbeTests(unittest.TestCase):
+
+    def test_images(self):
+        self.assertEqual(ImageInfo('jpeg', 400, 266, 1, 'RGB'), probe(read_image('lincoln.jpg')))
+        self.assertEqual(ImageInfo('png', 800, 600, 1, 'RGBA'), probe(read_image('dice.png')))
+        self.assertEqual(ImageInfo('gif', 35, 28, 1, 'P'), probe(read_image('terminal.gif')))
+
+    def test_webp(self):
+        for mode in ('RGB', 'RGBA'):
+            frames = [PIL.Image.new(mode, (30, 20))]
+            self.assertEqual(ImageInfo('webp', 30, 20, 1, mode), probe(encode('WEBP', frames)))
+            self.assertEqual(ImageInfo('webp', 30, 20, 1, mode), probe(encode('WEBP', frames, lossless=True)))
+
+    def test_animations(self):
+        frames = [PIL.Image.new('RGB', (30, 20), (i * 50, 0, 0)) for i in range(3)]
+        for fmt in ('GIF', 'PNG', 'WEBP'):
+            info = probe(encode(fmt, frames))
+            self.assertEqual((fmt.lower(), 30, 20, 3), info[:4])
+
+    def test_partial_content(self):
+        data = read_image('lincoln.jpg')
+        self.assertEqual(probe(data), probe(data[:16 * 1024]))
+        with self.assertRaises(TruncatedHeader):
+            probe(data[:1024])
+        self.assertIsNone(probe(read_image('terminal.gif')[:100]).frames)
+
+    def test_invalid(self):
+        with self.assertRaises(ProbeError):
+            probe(b'not an image')
+        with self.assertRaises(ProbeError):
+            probe(b'\xff\xd8\xff\xda\x00\x02')
+
+    def test_other_formats(self):
+        for fmt in ('BMP', 'TIFF'):
+            output = BytesIO()
+            PIL.Image.new('RGB', (10, 8)).save(output, fmt)
+            self.assertEqual(ImageInfo(fmt.lower(), 10, 8, 1, 'RGB'), probe(output.getvalue()))
+
+    def test_bomb(self):
+        #
+        # the header is valid, the size is checked by the caller
+        #
+        self.assertEqual((64250, 64250), probe(read_image('bad_image.jpg'))[1:3])
+
+
+class EXIFThumbnailTests(unittest.TestCase):
+
+    def test_thumbnail(self):
+        data, thumbnail = exif_jpeg((400, 300), (160, 120))
+        self.assertEqual(thumbnail, exif_thumbnail(data))
+        self.assertEqual((160, 120), probe(exif_thumbnail(data))[1:3])
+
+    def test_partial_content(self):
+        data, thumbnail = exif_jpeg((400, 300), (160, 120))
+        self.assertIsNone(exif_thumbnail(data[:len(thumbnail)]))
+
+    def test_no_thumbnail(self):
+        self.assertIsNone(exif_thumbnail(read_image('lincoln.jpg')))
+        self.assertIsNone(exif_thumbnail(read_image('dice.png')))
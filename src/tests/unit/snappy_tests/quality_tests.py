@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+from snappy.quality import search_quality, search_similar_quality
+
+
+class SearchQualityTests(unittest.TestCase):
+
+    def encoder(self):
+        return mock.Mock(side_effect=lambda quality: b'x' * quality * 10)
+
+    def test_upper_fits(self):
+        encode = self.encoder()
+        self.assertEqual((85, b'x' * 850), search_quality(encode, 1000, 85))
+        encode.assert_called_once_with(85)
+
+    def test_bisect(self):
+        encode = self.encoder()
+        quality, output = search_quality(encode, 500, 85, lower=10, trials=8)
+        self.assertEqual(50, quality)
+        self.assertLessEqual(len(output), 500)
+
+    def test_trials(self):
+        encode = self.encoder()
+        quality, output = search_quality(encode, 500, 85, lower=10, trials=3)
+        self.assertEqual(3, encode.call_count)
+        self.assertLessEqual(len(output), 500)
+
+    def test_none_fits(self):
+        encode = self.encoder()
+        self.assertEqual((10, b'x' * 100), search_quality(encode, 50, 85, lower=10))
+
+
+class SearchSimilarQualityTests(unittest.TestCase):
+
+    def search(self, threshold, trials=7):
+        encode = mock.Mock(side_effect=lambda quality: quality)
+        return encode, search_similar_quality(encode, lambda quality: quality / 100, threshold, upper=85, lower=20,
+                                              trials=trials)
+
+    def test_lowest(self):
+        encode, result = self.search(0.6)
+        self.assertEqual((60, 60), result)
+
+    def test_trials(self):
+        encode, (quality, output) = self.search(0.6, trials=3)
+        self.assertEqual(3, encode.call_count)
+        self.assertGreaterEqual(quality, 60)
+
+    def test_none_similar(self):
+        encode, result = self.search(0.9, trials=3)
+        self.assertEqual((85, 85), result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 """Response Testing"""
 
 import unittest
+from datetime import datetime, timezone
 
 from snappy import response
 
@@ -133,3 +134,19 @@ class ResponseTests(unittest.TestCase):
         self.assertEquals(
             res["body"],
             """{"errors": {"_internal": "Method Not Allowed"}}""")
+
+    def test_not_modified(self):
+        res = response.not_modified({"ETag": '"abc"'})
+        self.assertEquals(res["statusCode"], 304)
+        self.assertEquals(res["headers"]["ETag"], '"abc"')
+        self.assertEquals(res["body"], "")
+
+    def test_http_date(self):
+        value = datetime(2018, 12, 11, 10, 30, tzinfo=timezone.utc)
+        self.assertEquals(response.http_date(value), "Tue, 11 Dec 2018 10:30:00 GMT")
+
+    def test_moved_permanently(self):
+        res = response.moved_permanently("/path?w=10", {"Cache-Control": "max-age=60"})
+        self.assertEquals(res["statusCode"], 301)
+        self.assertEquals(res["headers"]["Location"], "/path?w=10")
+        self.assertEquals(res["headers"]["Cache-Control"], "max-age=60")
@@ -1,6 +1,10 @@
+import tempfile
 import unittest
+from unittest import mock
 from moto import mock_s3
-from snappy.s3 import get_aws_resource, download_s3_obj, get_s3_obj
+from snappy import s3
+from snappy.s3 import get_aws_resource, get_s3_client, get_s3_obj, head_s3_obj, NotModified
+from snappy.cache import LocalCache
 from snappy.utils import rnd_str
 
 class S3MockerBase(unittest.TestCase):
@@ -11,6 +15,10 @@ class S3MockerBase(unittest.TestCase):
     def setUp(self):
         self.s3_mock = mock_s3()
         self.s3_mock.start()
+        #
+        # the shared client has to be created within the mock
+        #
+        s3._s3_client = None
         self.s3_resource = get_aws_resource('s3')
         self.main_bucket = self.get_main_bucket()
         self.s3_resource.create_bucket(Bucket=self.main_bucket)
@@ -38,21 +46,102 @@ class S3Tests(S3MockerBase):
     def test_download_file(self):
         ext = '.jpg'
         bucket, key, body = self.put_s3(key='test' + ext)
-        filename = download_s3_obj(bucket, key)
-        with open(filename) as fp:
-            self.assertEqual(fp.read(), body)
-        self.assertIn(ext, filename)
+        self.assertEqual(get_s3_obj(bucket, key).body, body.encode())
 
     def test_file_not_found(self):
         bucket, key, body = self.put_s3()
-        self.assertIsNone(download_s3_obj(bucket, key + 'wont_find'))
-        self.assertIsNone(download_s3_obj(bucket + 'wont_find' , key))
+
+    def test_download_cached_file(self):
+        cache = LocalCache(tempfile.mkdtemp(), max_bytes=1024)
+        bucket, key, body = self.put_s3(key='test.jpg')
+        obj = get_s3_obj(bucket, key, cache)
+        self.assertEqual(len(body), cache.size)
+
+        client = get_s3_client()
+        with mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+            self.assertEqual(obj, get_s3_obj(bucket, key, cache))
+            self.assertEqual(obj.etag, get_object.call_args[1]['IfNoneMatch'])
+
+        bucket, key, body = self.put_s3(key='test.jpg', body='changed')
+        self.assertEqual(get_s3_obj(bucket, key, cache).body, body.encode())
 
     def test_get_obj(self):
         test_cc = 'max-age=3600'
         bucket, key, body = self.put_s3(**{'CacheControl': test_cc})
         obj = get_s3_obj(bucket, key)
         self.assertEqual(obj.cache_control, test_cc)
+        self.assertTrue(obj.etag)
+        self.assertTrue(obj.last_modified)
+
+    def test_cached_obj_metadata(self):
+        test_cc = 'max-age=3600'
+        cache = LocalCache(tempfile.mkdtemp(), max_bytes=1024)
+        bucket, key, body = self.put_s3(**{'CacheControl': test_cc})
+        obj = get_s3_obj(bucket, key, cache)
+        self.assertEqual(obj, get_s3_obj(bucket, key, cache))
+        self.assertEqual(test_cc, get_s3_obj(bucket, key, cache).cache_control)
+
+    def test_not_modified(self):
+        cache = LocalCache(tempfile.mkdtemp(), max_bytes=1024)
+        bucket, key, body = self.put_s3()
+        obj = get_s3_obj(bucket, key)
+        with self.assertRaises(NotModified) as cm:
+            get_s3_obj(bucket, key, etag=obj.etag)
+        self.assertEqual(obj.etag, cm.exception.s3_obj.etag)
+
+        get_s3_obj(bucket, key, cache)
+        with self.assertRaises(NotModified):
+            get_s3_obj(bucket, key, cache, modified_since=obj.last_modified)
+        self.assertEqual(obj, get_s3_obj(bucket, key, cache, etag='"other"'))
+
+    def test_ranged_download(self):
+        bucket, key, body = self.put_s3(body=rnd_str(100))
+        check_head = mock.Mock(return_value=None)
+        with mock.patch('snappy.s3.PROBE_BYTES', 10):
+            self.assertEqual(body.encode(), get_s3_obj(bucket, key, check_head=check_head).body)
+            check_head.assert_called_once_with(body.encode()[:10], get_s3_obj(bucket, key).etag)
+
+            check_head.return_value = b'substitute'
+            obj = get_s3_obj(bucket, key, check_head=check_head)
+            self.assertEqual(b'substitute', obj.body)
+            self.assertTrue(obj.etag)
+
+            client = get_s3_client()
+            check_head.side_effect = ValueError
+            with mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+                with self.assertRaises(ValueError):
+                    get_s3_obj(bucket, key, check_head=check_head)
+                self.assertEqual(1, get_object.call_count)
+
+    def test_ranged_download_small_obj(self):
+        check_head = mock.Mock()
+        bucket, key, body = self.put_s3(body='small')
+        self.assertEqual(b'small', get_s3_obj(bucket, key, check_head=check_head).body)
+        self.s3_resource.Bucket(bucket).put_object(Key='empty', Body=b'')
+        self.assertEqual(b'', get_s3_obj(bucket, 'empty', check_head=check_head).body)
+        check_head.assert_not_called()
+
+    def test_ranged_download_changed(self):
+        bucket, key, body = self.put_s3(body=rnd_str(100))
+
+        def change(head, etag):
+            self.put_s3(key=key, body='changed')
+
+        with mock.patch('snappy.s3.PROBE_BYTES', 10):
+            self.assertEqual(b'changed', get_s3_obj(bucket, key, check_head=change).body)
+
+    def test_head_obj(self):
+        test_cc = 'max-age=3600'
+        bucket, key, body = self.put_s3(**{'CacheControl': test_cc})
+        obj = head_s3_obj(bucket, key)
+        self.assertIsNone(obj.body)
+        self.assertEqual(test_cc, obj.cache_control)
+        with self.assertRaises(NotModified):
+            head_s3_obj(bucket, key, etag=obj.etag)
+        self.assertIsNone(head_s3_obj(bucket, key + 'wont_find'))
+
+    def test_shared_client(self):
+        self.assertIs(get_s3_client(), get_s3_client())
 
     def test_obj_not_found(self):
         bucket, key, body = self.put_s3()
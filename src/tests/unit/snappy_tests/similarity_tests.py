@@ -0,0 +1,47 @@
+import unittest
+from io import BytesIO
+import numpy
+import PIL.Image
+from snappy.similarity import luma, ssim, similarity
+from snappy.settings import SIMILARITY_SIZE
+from tests.unit.test_transform import read_image
+
+
+class SimilarityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = PIL.Image.open(BytesIO(read_image('lincoln.jpg')))
+
+    def encode(self, quality):
+        output = BytesIO()
+        self.img.save(output, 'JPEG', quality=quality)
+        return output.getvalue()
+
+    def test_luma(self):
+        values = luma(self.img)
+        self.assertEqual(SIMILARITY_SIZE, max(values.shape))
+        self.assertEqual((2, 3), luma(self.img.resize((3, 2))).shape)
+        self.assertEqual((60, 80), luma(PIL.Image.open(BytesIO(read_image('dice.png'))).resize((80, 60))).shape)
+
+    def test_identical(self):
+        values = luma(self.img)
+        self.assertAlmostEqual(1.0, ssim(values, values))
+
+    def test_degraded(self):
+        values = luma(self.img)
+        noisy = numpy.clip(values + numpy.random.RandomState(0).normal(0, 30, values.shape), 0, 255)
+        self.assertLess(ssim(values, noisy), 0.8)
+
+    def test_quality(self):
+        reference = luma(self.img)
+        scores = [similarity(reference, self.encode(quality)) for quality in (10, 45, 95)]
+        self.assertEqual(sorted(scores), scores)
+        self.assertGreater(scores[-1], 0.99)
+
+    def test_tiny(self):
+        values = luma(self.img.resize((5, 3)))
+        self.assertAlmostEqual(1.0, ssim(values, values))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+from snappy.startup import import_times
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_import_times(self):
+        times, total_ms = import_times('json')
+        modules = [name for name, self_us, cumulative_us in times]
+        self.assertIn('json', modules)
+        self.assertIn('json.decoder', modules)
+        self.assertGreater(total_ms, 0)
+        for name, self_us, cumulative_us in times:
+            self.assertLessEqual(self_us, cumulative_us)
+
+    def test_lazy_numpy(self):
+        for module in ('snappy.similarity', 'snappy.optimize'):
+            times, total_ms = import_times(module)
+            self.assertNotIn('numpy', [name for name, self_us, cumulative_us in times])
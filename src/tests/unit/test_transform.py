@@ -3,45 +3,63 @@ import json
 import os
 from copy import copy
 import tempfile
+from io import BytesIO
+from unittest import mock
 import vendored
 import PIL.Image
 from tests.unit.snappy_tests.s3_tests import S3MockerBase
-from snappy.settings import BUCKET, DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE, SUPPORTED_FORMATS, MAX_IMAGE_W, MAX_IMAGE_H
+from snappy.s3 import get_s3_obj, get_s3_client
+from snappy.settings import BUCKET, PROBE_BYTES, DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE, SUPPORTED_FORMATS, MAX_IMAGE_W, MAX_IMAGE_H
 from snappy.utils import base64_decode
-from transform import image_transform, param_validation, InvalidParamsError, make_response, parse_event, handler, is_valid_image
+from snappy.pillow_engine import PIL_FORMATS
+from snappy.images import identify, make_result
+from snappy.cache import MemoryCache
+from snappy.plan import compile_plan
+from snappy.magick_pool import PoolError, JobTimeout
+from snappy import probe
+from transform import accepted_types, negotiate_format, image_transform, imagemagick_transform, imagemagick_args, canonicalize_ops, canonical_redirect, thumbnail_for, param_validation, InvalidParamsError, make_response, parse_event, handler, is_valid_image
 
 BASE_DIR = 'tests/data'
 
 ALL_IMAGES = ('lincoln.jpg', 'terminal.gif', 'dice.png')
 
+
+def read_image(name):
+    with open(os.path.join(BASE_DIR, name), 'rb') as fp:
+        return fp.read()
+
+
+def open_image(data):
+    return PIL.Image.open(BytesIO(data))
+
 class ImageTranformTests(unittest.TestCase):
 
     def test_resize(self):
-        filename = os.path.join(BASE_DIR, 'terminal.gif')  # 35x28
+        data = read_image('terminal.gif')  # 35x28
         operations = {'w': 50, 'h': 100}
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual((operations['w'], operations['h']), img.size)
 
         operations = {'w': 25}
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual(operations['w'], img.size[0])
 
         operations = {'h': 25}
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual(operations['h'], img.size[1])
 
 
     def test_resize_with_fit(self):
-        filename = os.path.join(BASE_DIR, 'terminal.gif')  # 35x28
+        data = read_image('terminal.gif')  # 35x28
         base_ops = {'w': 50, 'h': 100}
 
         operations = copy(base_ops)
         operations.update({'fit': 'crop'})
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual((operations['w'], operations['h']), img.size)
 
         #
@@ -50,115 +68,267 @@ class ImageTranformTests(unittest.TestCase):
         #
         operations = copy(base_ops)
         operations.update({'fit': 'bounds'})
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual((operations['w'], 40), img.size)
 
         operations = copy(base_ops)
         operations.update({'fit': 'clip'})
-        output = image_transform(filename, operations)
-        img = PIL.Image.open(output)
+        output = image_transform(data, operations)
+        img = open_image(output.data)
         self.assertEqual((operations['w'], 40), img.size)
 
     def test_auto_compress(self):
-        filename = os.path.join(BASE_DIR, 'lincoln.jpg')
-        w, h = PIL.Image.open(filename).size
-        in_file_size = os.stat(filename).st_size
+        data = read_image('lincoln.jpg')
+        w, h = open_image(data).size
+        in_file_size = len(data)
 
-        w, h = PIL.Image.open(filename).size
+        w, h = open_image(data).size
         operations = {'q': AGRESSIVE_QUALITY_RATE}
-        output = image_transform(filename, operations)
-        size_with_metadata = os.stat(output).st_size
-        self.assertLess(os.stat(output).st_size, in_file_size)
+        output = image_transform(data, operations)
+        size_with_metadata = output.length
+        self.assertLess(output.length, in_file_size)
 
         # applies agressive quality and remove metadata
         operations = {'auto': 'compress'}
-        output = image_transform(filename, operations)
-        self.assertLess(os.stat(output).st_size, in_file_size)
-        size_with_no_metadata = os.stat(output).st_size
+        output = image_transform(data, operations)
+        self.assertLess(output.length, in_file_size)
+        size_with_no_metadata = output.length
         self.assertLess(size_with_no_metadata, size_with_metadata)
 
 
     def test_format(self):
 
-        filename = os.path.join(BASE_DIR, 'lincoln.jpg')
+        data = read_image('lincoln.jpg')
 
-        in_file_size = os.stat(filename).st_size
+        in_file_size = len(data)
         operations = {'fm': 'png'}
-        output = image_transform(filename, operations)
-        self.assertIn('png', output)
-        self.assertGreater(os.stat(output).st_size, in_file_size)
+        output = image_transform(data, operations)
+        self.assertEqual('PNG', open_image(output.data).format)
+        self.assertGreater(output.length, in_file_size)
 
-        filename = os.path.join(BASE_DIR, 'terminal.gif')
-        in_file_size = os.stat(filename).st_size
+        data = read_image('terminal.gif')
+        in_file_size = len(data)
         operations = {'fm': 'jpeg', 'q': 10}
-        output = image_transform(filename, operations)
-        self.assertIn('jpeg', output)
-        self.assertGreater(os.stat(output).st_size, in_file_size)
+        output = image_transform(data, operations)
+        self.assertEqual('JPEG', open_image(output.data).format)
+        self.assertGreater(output.length, in_file_size)
 
         for fm in SUPPORTED_FORMATS:
             #FIXME: https://github.com/caffeinetv/snappy/issues/10
             if fm != 'webp':
                 operations = {'fm': fm}
-                output = image_transform(filename, operations)
-                self.assertIn(fm, output)
+                output = image_transform(data, operations)
+                self.assertEqual(PIL_FORMATS[fm], open_image(output.data).format)
 
 
     def test_quality(self):
-        filename = os.path.join(BASE_DIR, 'lincoln.jpg')
-        w, h = PIL.Image.open(filename).size
+        data = read_image('lincoln.jpg')
+        w, h = open_image(data).size
         #
         # applying no transformation with the default quality
         #
         operations = {'w': w, 'h': h}
-        output = image_transform(filename, operations)
-        out_file_size = os.stat(output).st_size
+        output = image_transform(data, operations)
+        out_file_size = output.length
 
         operations = {'q': DEFAULT_QUALITY_RATE - 5}
-        output = image_transform(filename, operations)
-        self.assertLess(os.stat(output).st_size, out_file_size)
+        output = image_transform(data, operations)
+        self.assertLess(output.length, out_file_size)
 
 
     def test_dpr(self):
-        filename = os.path.join(BASE_DIR, 'lincoln.jpg')
-        w, h = PIL.Image.open(filename).size
+        data = read_image('lincoln.jpg')
+        w, h = open_image(data).size
         dpr = 2
         operations = {'dpr': dpr}
-        output = image_transform(filename, operations)
-        ow, oh = PIL.Image.open(output).size
+        output = image_transform(data, operations)
+        ow, oh = open_image(output.data).size
         self.assertEqual((w*dpr, h*dpr), (ow, oh))
 
         scale = 2
         w, h = w*scale, h*scale
         operations = {'dpr': dpr, 'w': w, 'h': h}
-        output = image_transform(filename, operations)
-        ow, oh = PIL.Image.open(output).size
+        output = image_transform(data, operations)
+        ow, oh = open_image(output.data).size
         self.assertEqual((w*dpr, h*dpr), (ow, oh))
 
 
     def test_all_ops(self):
         for img in ALL_IMAGES:
-            filename = os.path.join(BASE_DIR, img)
+            data = read_image(img)
             side = 100
             dpr = 2
             operations = {'w': side,'h': side, 'fit': 'crop', 'fm': 'gif', 'dpr': dpr, 'q': 50, 'auto': 'compress'}
-            output = image_transform(filename, operations)
-            ow, oh = PIL.Image.open(output).size
+            output = image_transform(data, operations)
+            ow, oh = open_image(output.data).size
             self.assertEqual((side*dpr, side*dpr), (ow, oh))
 
 
+    def test_engine_fallback(self):
+        data = read_image('lincoln.jpg')
+        fallback = make_result(b'fallback', 'png', (10, 7), executed='decode > encode(png)')
+        with mock.patch('transform.TRANSFORM_ENGINE', 'pillow'), \
+                mock.patch('snappy.pillow_engine.image_transform', side_effect=OSError), \
+                mock.patch('transform.imagemagick_transform', return_value=fallback) as im:
+            output = image_transform(data, {'w': 10})
+            im.assert_called_once_with(data, {'w': 10}, None, ())
+        self.assertEqual(b'fallback', output.data)
+        self.assertEqual('fallback(convert) > decode > encode(png)', output.executed)
+
+    def test_magick_pool_fallback(self):
+        data = read_image('lincoln.jpg')
+        pool = mock.Mock(**{'run.side_effect': PoolError('failed')})
+        fallback = make_result(b'fallback', 'png', (10, 7), executed='decode > encode(png)')
+        with mock.patch('transform.TRANSFORM_ENGINE', 'imagemagick-pool'), \
+                mock.patch('transform.magick_pool', return_value=pool), \
+                mock.patch('transform.imagemagick_transform', return_value=fallback) as im:
+            output = image_transform(data, {'w': 10})
+            self.assertEqual(compile_plan({'w': 10}), pool.run.call_args[0][1])
+            im.assert_called_once_with(data, {'w': 10}, probe.probe(data), ())
+        self.assertEqual('fallback(convert) > decode > encode(png)', output.executed)
+
+    def test_magick_pool_timeout(self):
+        data = read_image('lincoln.jpg')
+        pool = mock.Mock(**{'run.side_effect': JobTimeout('timeout')})
+        with mock.patch('transform.TRANSFORM_ENGINE', 'imagemagick-pool'), \
+                mock.patch('transform.magick_pool', return_value=pool), \
+                mock.patch('transform.imagemagick_transform') as im:
+            with self.assertRaises(JobTimeout):
+                image_transform(data, {'w': 10})
+            im.assert_not_called()
+
+    def test_magick_pool(self):
+        data = read_image('lincoln.jpg')
+        pool = mock.Mock(**{'run.return_value': (b'output', 'png', (10, 12))})
+        with mock.patch('transform.TRANSFORM_ENGINE', 'imagemagick-pool'), \
+                mock.patch('transform.magick_pool', return_value=pool):
+            output = image_transform(data, {'w': 10, 'fm': 'png'})
+            self.assertEqual((b'output', 'image/png', 10, 12), (output.data, output.mime_type, output.width, output.height))
+            self.assertEqual('decode(shrink-on-load) > resize(10x7, fast) > colorspace(png) > encode(png)', output.executed)
+
+    def test_imagemagick_workspace(self):
+        workspaces = []
+
+        def convert(args, cwd):
+            workspaces.append(cwd)
+            self.assertTrue(os.path.exists(os.path.join(cwd, 'source')))
+            with open(os.path.join(cwd, args[-1]), 'wb') as fp:
+                fp.write(b'output')
+            return b''
+
+        with mock.patch('subprocess.check_output', side_effect=convert):
+            self.assertEqual(b'output', imagemagick_transform(read_image('lincoln.jpg'), {'w': 10}).data)
+        self.assertFalse(os.path.exists(workspaces[0]))
+
+    def test_imagemagick_args(self):
+        info = probe.ImageInfo('png', 400, 300, 1, 'RGBA')
+        self.assertEqual(['convert', 'source', '-resize', '300x200^', '-gravity', 'center', '-extent', '300x200',
+                          '-strip', '-interlace', 'Plane', '-define', 'jpeg:optimize-coding=true',
+                          '-define', 'jpeg:sampling-factor=4:2:0', '-quality', '45', 'output.jpg'],
+                         imagemagick_args(compile_plan({'w': 150, 'h': 100, 'fit': 'crop', 'dpr': 2.0,
+                                                        'fm': 'jpg', 'auto': 'compress'}), info))
+        self.assertEqual(['convert', 'source', '-resize', 'x150', 'output.png'],
+                         imagemagick_args(compile_plan({'h': 150, 'q': 60}), info))
+        self.assertEqual(['convert', 'source', '-scale', '150%', 'output.png'],
+                         imagemagick_args(compile_plan({'dpr': 1.5}), info))
+        self.assertEqual(['convert', 'source', 'output.png'],
+                         imagemagick_args(compile_plan({'max_bytes': 1000}), info))
+        self.assertEqual(['convert', 'source', '-define', 'webp:target-size=1000', '-define', 'webp:method=4',
+                          '-define', 'webp:lossless=false', '-quality', '85', 'output.webp'],
+                         imagemagick_args(compile_plan({'fm': 'webp', 'max_bytes': 1000}), info))
+        info = probe.ImageInfo('gif', 400, 300, 20, 'P')
+        self.assertEqual(['convert', 'source', '-coalesce', '-resize', '200x', '-layers', 'Optimize', 'output.gif'],
+                         imagemagick_args(compile_plan({'w': 200}), info))
+
+    def test_imagemagick_frames(self):
+        info = probe.ImageInfo('gif', 400, 300, 60, 'P')
+        self.assertEqual(['convert', 'source', '-coalesce', '-delete', ','.join(str(index) for index in range(1, 60, 2)),
+                          '-set', 'delay', '8', '-resize', '200x', '-layers', 'Optimize', 'output.gif'],
+                         imagemagick_args(compile_plan({'w': 200}), info, durations=[40] * 60))
+        #
+        # a format which is not animated only keeps the first frame
+        #
+        self.assertEqual(['convert', 'source', '-coalesce', '-delete', '1-59', '-resize', '200x', '-interlace', 'None',
+                          '-define', 'jpeg:optimize-coding=true', '-define', 'jpeg:sampling-factor=4:4:4', '-quality', '85',
+                          'output.jpg'], imagemagick_args(compile_plan({'w': 200, 'fm': 'jpg'}), info))
+
+    def test_imagemagick_resample(self):
+        info = probe.ImageInfo('png', 400, 300, 1, 'RGBA')
+        self.assertEqual(['convert', 'source', '-filter', 'Triangle', '-scale', '50%', '-resize', 'x50', 'output.png'],
+                         imagemagick_args(compile_plan({'h': 50}), info))
+        self.assertEqual(['convert', 'source', '-resize', 'x50', 'output.png'],
+                         imagemagick_args(compile_plan({'h': 50, 'resample': 'sharp'}), info))
+        self.assertEqual(['convert', 'source', '-filter', 'Catrom', '-resize', 'x150', 'output.png'],
+                         imagemagick_args(compile_plan({'h': 150, 'resample': 'balanced'}), info))
+        self.assertEqual(['convert', 'source', '-filter', 'Triangle', '-resize', 'x150', 'output.png'],
+                         imagemagick_args(compile_plan({'h': 150, 'resample': 'fast'}), info))
+
+    def test_imagemagick_profile(self):
+        info = probe.ImageInfo('gif', 400, 300, 1, 'P')
+        self.assertEqual(['convert', 'source', '-define', 'webp:method=6', '-define', 'webp:lossless=true', 'output.webp'],
+                         imagemagick_args(compile_plan({'fm': 'webp'}), info))
+        self.assertEqual(['convert', 'source', '-interlace', 'None', '-define', 'jpeg:optimize-coding=false',
+                          '-define', 'jpeg:sampling-factor=4:2:0', '-quality', '85', 'output.jpg'],
+                         imagemagick_args(compile_plan({'fm': 'jpg', 'profile': 'fast'}), info))
+
+    def test_imagemagick_degraded(self):
+        info = probe.ImageInfo('jpeg', 4000, 3000, 1, 'RGB')
+        self.assertEqual(['convert', '-define', 'jpeg:size=400x300', 'source', '-filter', 'Triangle',
+                          '-define', 'png:compression-level=1', '-resize', '400x',
+                          'output.png'],
+                         imagemagick_args(compile_plan({'w': 400, 'fm': 'png'}), info,
+                                          ('low-effort', 'fast-filter', 'shrink-on-load')))
+
+    def test_degraded(self):
+        data = read_image('lincoln.jpg')
+        output = image_transform(data, {'w': 100, 'fm': 'webp'}, degraded=('low-effort', 'fast-filter', 'shrink-on-load'))
+        self.assertEqual((100, 67), open_image(output.data).size)
+
+    def test_imagemagick_shrink_on_load(self):
+        with mock.patch('subprocess.check_output', side_effect=OSError) as convert:
+            with self.assertRaises(OSError):
+                imagemagick_transform(read_image('lincoln.jpg'), {'w': 50})
+        self.assertEqual(['convert', '-define', 'jpeg:size=100x66', 'source'], convert.call_args[0][0][:4])
+
     def test_bad_image(self):
-        filename = os.path.join(BASE_DIR, 'bad_image.jpg')
+        data = read_image('bad_image.jpg')
         operations = {'auto': 'compress'}
-        self.assertFalse(is_valid_image(filename))
+        self.assertFalse(is_valid_image(data))
 
     def test_good_images(self):
         for img in ALL_IMAGES:
-            filename = os.path.join(BASE_DIR, img)
+            data = read_image(img)
             operations = {'auto': 'compress'}
-            self.assertTrue(is_valid_image(filename))
+            self.assertTrue(is_valid_image(data))
+
+
+
+
+class ThumbnailTests(unittest.TestCase):
+
+    def setUp(self):
+        from tests.unit.snappy_tests.probe_tests import exif_jpeg
+        self.data, self.thumbnail = exif_jpeg((400, 300), (160, 120))
+        self.info = probe.probe(self.data)
 
+    def test_small_rendition(self):
+        ops = {'w': 64, 'auto': 'compress'}
+        self.assertEqual(self.thumbnail, thumbnail_for(self.data, self.info, ops))
+        ops = {'w': 100, 'h': 100, 'fit': 'crop', 'auto': 'compress'}
+        self.assertEqual(self.thumbnail, thumbnail_for(self.data, self.info, ops))
 
+    def test_large_rendition(self):
+        self.assertIsNone(thumbnail_for(self.data, self.info, {'w': 200, 'auto': 'compress'}))
+        self.assertIsNone(thumbnail_for(self.data, self.info, {'w': 64, 'dpr': 3, 'auto': 'compress'}))
+
+    def test_keeps_metadata(self):
+        self.assertIsNone(thumbnail_for(self.data, self.info, {'w': 64}))
+
+    def test_aspect_ratio(self):
+        from tests.unit.snappy_tests.probe_tests import exif_jpeg
+        data, thumbnail = exif_jpeg((400, 200), (160, 120))
+        self.assertIsNone(thumbnail_for(data, probe.probe(data), {'w': 64, 'auto': 'compress'}))
 
 
 class ParamValidationTests(unittest.TestCase):
@@ -212,6 +382,15 @@ class ParamValidationTests(unittest.TestCase):
         self.assertIn('fm', params)
         self.assertIn('auto', params)
 
+    def test_auto_list(self):
+        self.assertEqual({'auto': 'compress,format'}, param_validation({'auto': 'Format, compress'}))
+        self.assertEqual({'auto': 'format'}, param_validation({'auto': 'format'}))
+        self.assertEqual({}, param_validation({'auto': 'format,other'}))
+
+    def test_max_bytes_fmt(self):
+        self.assertEqual({'fm': 'jpg', 'max_bytes': 1000}, param_validation({'fm': 'jpg', 'max_bytes': '1000'}))
+        self.assertEqual({'fm': 'png'}, param_validation({'fm': 'png', 'max_bytes': '1000'}))
+
     def test_invalid_quality_fmt(self):
         ops = {'fm': 'gif', 'q': 75}
         params = param_validation(ops)
@@ -252,6 +431,41 @@ class ParamValidationTests(unittest.TestCase):
         exp_ops = {'dpr': 8}
         self.assertEqual(exp_ops, params)
 
+    def test_memoized(self):
+        ops = {'w': '10', 'fm': 'PNG'}
+        params = param_validation(ops)
+        with mock.patch('transform._param_validation') as validation:
+            self.assertEqual(params, param_validation(dict(ops)))
+            validation.assert_not_called()
+        params['w'] = 20
+        self.assertEqual({'w': 10, 'fm': 'png'}, param_validation(ops))
+
+    def test_nan(self):
+        self.assertEqual({}, param_validation({'dpr': 'nan'}))
+
+class CanonicalOpsTests(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual({'w': 10, 'fm': 'jpg'}, canonicalize_ops({'w': 10, 'fm': 'jpg', 'dpr': 1.0, 'q': DEFAULT_QUALITY_RATE}))
+        #
+        # the quality makes WebP lossy, the source may be a WebP image
+        #
+        for ops in ({'w': 10, 'q': DEFAULT_QUALITY_RATE}, {'fm': 'webp', 'q': DEFAULT_QUALITY_RATE}):
+            self.assertEqual(ops, canonicalize_ops(ops))
+        ops = {'q': DEFAULT_QUALITY_RATE, 'auto': 'compress'}
+        self.assertEqual(ops, canonicalize_ops(ops))
+        self.assertEqual({'fm': 'png'}, canonicalize_ops({'fm': 'png', 'resample': 'fast'}))
+        self.assertEqual({'w': 10, 'resample': 'fast'}, canonicalize_ops({'w': 10, 'resample': 'fast'}))
+
+    @mock.patch('transform.SIZE_BREAKPOINTS', (100, 200, 400))
+    @mock.patch('transform.DPR_BREAKPOINTS', (1.5, 2, 3))
+    def test_breakpoints(self):
+        self.assertEqual({'w': 200}, canonicalize_ops({'w': 101}))
+        self.assertEqual({'h': 400}, canonicalize_ops({'h': 201}))
+        self.assertEqual({'w': 500}, canonicalize_ops({'w': 500}))
+        self.assertEqual({'w': 200, 'h': 100, 'fit': 'crop'}, canonicalize_ops({'w': 150, 'h': 75, 'fit': 'crop'}))
+        self.assertEqual({'dpr': 2}, canonicalize_ops({'dpr': 1.8}))
+
 class HTTPTests(S3MockerBase):
 
     def get_main_bucket(self):
@@ -260,16 +474,14 @@ class HTTPTests(S3MockerBase):
     def test_make_response(self):
         test_cc = 'max-age=3600'
         bucket, key, body = self.put_s3(**{'CacheControl': test_cc})
-        filename = os.path.join(BASE_DIR, 'lincoln.jpg')
-        resp = make_response(filename, key)
+        resp = make_response(identify(read_image('lincoln.jpg')), get_s3_obj(bucket, key))
         self.assertEqual(test_cc, resp['headers']['Cache-Control'])
         self.assertEqual(True, resp['isBase64Encoded'])
         self.assertTrue(type(resp['body']) == str)
         self.assertEqual('image/jpeg', resp['headers']['Content-Type'])
 
         bucket, key, body = self.put_s3()
-        filename = os.path.join(BASE_DIR, 'terminal.gif')
-        resp = make_response(filename, key)
+        resp = make_response(identify(read_image('terminal.gif')), get_s3_obj(bucket, key))
         self.assertNotIn('Cache-Control', resp['headers'])
         self.assertEqual('image/gif', resp['headers']['Content-Type'])
 
@@ -296,14 +508,158 @@ class HTTPTests(S3MockerBase):
         event = self.make_event(s3_key, raw_ops)
         resp = handler(event, None)
         self.assertEqual(resp['statusCode'], 200)
-        img_data = base64_decode(resp['body'])
-        code, tmp_file = tempfile.mkstemp()
-        with open(tmp_file, 'wb') as fp:
-            fp.write(img_data)
-        img = PIL.Image.open(tmp_file)
+        img = open_image(base64_decode(resp['body']))
         self.assertEqual((raw_ops['w'], raw_ops['h']), img.size)
 
 
+    def test_rendition_cache(self):
+        filename = os.path.join(BASE_DIR, 'terminal.gif')
+        with open(filename, 'rb') as fp:
+            bucket, s3_key, body = self.put_s3(body=fp.read())
+        event = self.make_event(s3_key, {'w': 30, 'fm': 'png'})
+        first = handler(event, None)
+        with mock.patch('transform.image_transform') as transform:
+            second = handler(event, None)
+            transform.assert_not_called()
+        self.assertEqual(first['body'], second['body'])
+
+    def test_other_format(self):
+        bmp = BytesIO()
+        PIL.Image.new('RGB', (40, 30), (0, 0, 200)).save(bmp, 'BMP')
+        bucket, s3_key, body = self.put_s3(body=bmp.getvalue())
+        resp = handler(self.make_event(s3_key, {'w': '20'}), None)
+        self.assertEqual((200, 'image/bmp'), (resp['statusCode'], resp['headers']['Content-Type']))
+        self.assertEqual((20, 15), open_image(base64_decode(resp['body'])).size)
+
+    def test_rendition_cache_before_download(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        event = self.make_event(s3_key, {'w': 30})
+        first = handler(event, None)
+        client = get_s3_client()
+        with mock.patch('transform.SOURCE_CACHE', None), \
+                mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+            second = handler(event, None)
+        self.assertEqual(first['body'], second['body'])
+        #
+        # only the first bytes are downloaded to find the rendition
+        #
+        get_object.assert_called_once_with(Bucket=BUCKET, Key=s3_key, Range=mock.ANY)
+
+    def put_image(self, name):
+        with open(os.path.join(BASE_DIR, name), 'rb') as fp:
+            return self.put_s3(body=fp.read())
+
+    def test_accepted_types(self):
+        event = {'headers': {'accept': 'image/avif,image/webp;q=0.9, image/png;q=0,*/*;q=0.8'}}
+        self.assertEqual({'image/avif', 'image/webp', '*/*'}, accepted_types(event))
+        self.assertEqual(set(), accepted_types({'headers': None}))
+
+    def test_negotiate_format(self):
+        webp = {'headers': {'Accept': 'image/webp,*/*'}}
+        other = {'headers': {'Accept': 'image/png,image/*,*/*'}}
+        self.assertEqual({'auto': 'format', 'fm': 'webp'}, negotiate_format(webp, {'auto': 'format'}))
+        self.assertEqual({'auto': 'format'}, negotiate_format(other, {'auto': 'format'}))
+        self.assertEqual({'auto': 'format', 'fm': 'png'}, negotiate_format(webp, {'auto': 'format', 'fm': 'png'}))
+        self.assertEqual({'w': 10}, negotiate_format(webp, {'w': 10}))
+
+    def test_auto_format(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        event = self.make_event(s3_key, {'w': '100', 'auto': 'format'})
+        event['headers'] = {'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8'}
+        webp = handler(event, None)
+        self.assertEqual('image/webp', webp['headers']['Content-Type'])
+        self.assertEqual('Accept', webp['headers']['Vary'])
+        self.assertEqual('WEBP', open_image(base64_decode(webp['body'])).format)
+
+        event['headers'] = {'Accept': 'image/png,image/*'}
+        jpeg = handler(event, None)
+        self.assertEqual('image/jpeg', jpeg['headers']['Content-Type'])
+        self.assertEqual('Accept', jpeg['headers']['Vary'])
+        self.assertNotEqual(webp['headers']['ETag'], jpeg['headers']['ETag'])
+
+        event['headers'] = {'Accept': 'image/webp', 'If-None-Match': webp['headers']['ETag']}
+        resp = handler(event, None)
+        self.assertEqual(304, resp['statusCode'])
+        self.assertEqual('Accept', resp['headers']['Vary'])
+
+    def test_validation_headers(self):
+        bucket, s3_key, body = self.put_image('terminal.gif')
+        resp = handler(self.make_event(s3_key, {'w': 10}), None)
+        self.assertTrue(resp['headers']['ETag'].startswith('"'))
+        self.assertIn('GMT', resp['headers']['Last-Modified'])
+        other = handler(self.make_event(s3_key, {'w': 11}), None)
+        self.assertNotEqual(resp['headers']['ETag'], other['headers']['ETag'])
+
+    def test_if_none_match(self):
+        bucket, s3_key, body = self.put_image('terminal.gif')
+        event = self.make_event(s3_key, {'w': 10})
+        etag = handler(event, None)['headers']['ETag']
+
+        event['headers'] = {'if-none-match': etag}
+        with mock.patch('transform.image_transform') as transform:
+            resp = handler(event, None)
+            transform.assert_not_called()
+        self.assertEqual(304, resp['statusCode'])
+        self.assertEqual(etag, resp['headers']['ETag'])
+        self.assertEqual('', resp['body'])
+
+        event = self.make_event(s3_key, {'w': 12})
+        event['headers'] = {'If-None-Match': etag}
+        self.assertEqual(200, handler(event, None)['statusCode'])
+
+    def test_if_modified_since(self):
+        bucket, s3_key, body = self.put_image('terminal.gif')
+        event = self.make_event(s3_key, {'w': 10})
+        last_modified = handler(event, None)['headers']['Last-Modified']
+        event['headers'] = {'If-Modified-Since': last_modified}
+        self.assertEqual(304, handler(event, None)['statusCode'])
+        event['headers'] = {'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'}
+        self.assertEqual(200, handler(event, None)['statusCode'])
+
+    def test_head(self):
+        bucket, s3_key, body = self.put_image('terminal.gif')
+        event = self.make_event(s3_key, {'w': 10, 'fm': 'png'})
+        etag = handler(event, None)['headers']['ETag']
+        event['httpMethod'] = 'HEAD'
+        resp = handler(event, None)
+        self.assertEqual(200, resp['statusCode'])
+        self.assertEqual('', resp['body'])
+        self.assertEqual('image/png', resp['headers']['Content-Type'])
+        self.assertEqual(etag, resp['headers']['ETag'])
+
+        event['headers'] = {'If-None-Match': etag}
+        self.assertEqual(304, handler(event, None)['statusCode'])
+
+    @mock.patch('transform.CANONICAL_REDIRECTS', True)
+    def test_canonical_redirect(self):
+        bucket, s3_key, body = self.put_image('terminal.gif')
+        event = self.make_event(s3_key, {'Width': '10', 'fm': 'PNG', 'dpr': '1'})
+        resp = handler(event, None)
+        self.assertEqual(301, resp['statusCode'])
+        self.assertEqual(event['path'] + '?fm=png&w=10', resp['headers']['Location'])
+
+        event = self.make_event(s3_key, {'fm': 'png', 'w': '10'})
+        self.assertEqual(200, handler(event, None)['statusCode'])
+        event['rawQueryString'] = 'fm=png&w=10'
+        self.assertEqual(200, handler(event, None)['statusCode'])
+
+        #
+        # the order of the parameters is part of the URL cached by the CDN
+        #
+        event = self.make_event(s3_key, {'w': '10', 'fm': 'png'})
+        event['requestContext']['path'] = '/prod' + event['path']
+        resp = handler(event, None)
+        self.assertEqual(301, resp['statusCode'])
+        self.assertEqual('/prod' + event['path'] + '?fm=png&w=10', resp['headers']['Location'])
+
+        #
+        # an explicit quality encodes a graphic as lossy WebP, a different rendition
+        #
+        event = self.make_event(s3_key, {'fm': 'webp', 'q': '85'})
+        event['rawQueryString'] = 'fm=webp&q=85'
+        self.assertIsNone(canonical_redirect(event, {'fm': 'webp', 'q': '85'}, {'fm': 'webp', 'q': 85}))
+        self.assertEqual(200, handler(event, None)['statusCode'])
+
     def test_no_ops(self):
         filename = os.path.join(BASE_DIR, 'terminal.gif')
         with open(filename, 'rb') as fp:
@@ -346,6 +702,167 @@ class HTTPTests(S3MockerBase):
         img_data = base64_decode(resp['body'])
         self.assertEqual(body, img_data)
 
+        with mock.patch('transform.image_transform') as transform:
+            resp = handler(self.make_event(s3_key, {'w': '10'}), None)
+        transform.assert_not_called()
+        self.assertEqual(body, base64_decode(resp['body']))
+
+    def test_oversized_image(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        event = self.make_event(s3_key, {'w': '10'})
+        with mock.patch('transform.MAX_SOURCE_PIXELS', 1000):
+            resp = handler(event, None)
+            self.assertEqual(200, resp['statusCode'])
+            self.assertEqual(body, base64_decode(resp['body']))
+
+            client = get_s3_client()
+            with mock.patch('transform.OVERSIZED_IMAGES', 'reject'), \
+                    mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+                self.assertEqual(422, handler(event, None)['statusCode'])
+            self.assertEqual('bytes=0-{}'.format(PROBE_BYTES - 1), get_object.call_args[1]['Range'])
+            self.assertEqual(1, get_object.call_count)
+
+    def test_oversized_animation(self):
+        from tests.unit.snappy_tests.animation_tests import animated_gif
+        bucket, s3_key, body = self.put_s3(body=animated_gif(20, (40, 30)))
+        event = self.make_event(s3_key, {'w': '10'})
+        self.assertNotEqual(body, base64_decode(handler(event, None)['body']))
+        #
+        # all the frames are decoded, even if few are kept
+        #
+        with mock.patch('transform.ANIMATION_MAX_SOURCE_PIXELS', 10 * 40 * 30), \
+                mock.patch('transform.RENDITION_CACHE', None):
+            self.assertEqual(body, base64_decode(handler(event, None)['body']))
+
+    def test_exif_thumbnail(self):
+        from tests.unit.snappy_tests.probe_tests import exif_jpeg
+        data, thumbnail = exif_jpeg((3000, 2250), (160, 120))
+        self.assertGreater(len(data), PROBE_BYTES)
+        bucket, s3_key, body = self.put_s3(body=data)
+
+        client = get_s3_client()
+        with mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+            resp = handler(self.make_event(s3_key, {'w': '64', 'auto': 'compress'}), None)
+        self.assertEqual(1, get_object.call_count)
+        img = open_image(base64_decode(resp['body']))
+        self.assertEqual((64, 48), img.size)
+        #
+        # the thumbnail is red, the image is blue
+        #
+        red, green, blue = img.convert('RGB').getpixel((32, 24))
+        self.assertGreater(red, blue)
+
+        resp = handler(self.make_event(s3_key, {'w': '64'}), None)
+        red, green, blue = open_image(base64_decode(resp['body'])).convert('RGB').getpixel((32, 24))
+        self.assertGreater(blue, red)
+
+    def test_passthrough(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        with mock.patch('transform.image_transform') as transform:
+            resp = handler(self.make_event(s3_key, {'q': '90', 'w': '400'}), None)
+        transform.assert_not_called()
+        self.assertEqual(body, base64_decode(resp['body']))
+        self.assertEqual('image/jpeg', resp['headers']['Content-Type'])
+
+    def test_explain(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        event = self.make_event(s3_key, {'w': '10'})
+        self.assertNotIn('X-Snappy-Plan', handler(event, None)['headers'])
+
+        event['headers'] = {'x-snappy-explain': '1'}
+        self.assertEqual('rendition-cache', handler(event, None)['headers']['X-Snappy-Plan'])
+        with mock.patch('transform.RENDITION_CACHE', None):
+            self.assertEqual('decode(shrink-on-load) > resize(10x7, fast) > encode(jpeg, q=85, photo)',
+                             handler(event, None)['headers']['X-Snappy-Plan'])
+        event = self.make_event(s3_key, {'q': '90'})
+        event['headers'] = {'X-Snappy-Explain': '1'}
+        self.assertEqual('passthrough', handler(event, None)['headers']['X-Snappy-Plan'])
+
+    def test_degraded(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        context = mock.Mock(**{'get_remaining_time_in_millis.return_value': 9000})
+        with mock.patch('transform.RENDITION_CACHE') as cache:
+            cache.get.return_value = None
+            resp = handler(self.make_event(s3_key, {'w': '10'}), context)
+            self.assertNotIn('X-Snappy-Degraded', resp['headers'])
+            with mock.patch('snappy.deadline.TRANSFORM_MEGAPIXELS_PER_SECOND', 0.001):
+                resp = handler(self.make_event(s3_key, {'w': '10'}), context)
+        self.assertEqual(1, cache.put.call_count)
+        self.assertEqual(body, base64_decode(resp['body']))
+        self.assertEqual('low-effort, fast-filter, shrink-on-load, original', resp['headers']['X-Snappy-Degraded'])
+        self.assertTrue(resp['headers']['ETag'].startswith('W/"'))
+        self.assertEqual('public, max-age=60', resp['headers']['Cache-Control'])
+
+    def test_max_bytes(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        event = self.make_event(s3_key, {'w': '200', 'max_bytes': '9000'})
+        with mock.patch('transform.RENDITION_CACHE', None), \
+                mock.patch('transform.QUALITY_CACHE', MemoryCache(10)), \
+                mock.patch('transform.image_transform', wraps=image_transform) as transform:
+            first = handler(event, None)
+            second = handler(event, None)
+        self.assertLessEqual(len(base64_decode(first['body'])), 9000)
+        self.assertEqual(first['body'], second['body'])
+        #
+        # the quality found by the first request is used by the next ones
+        #
+        first_ops = transform.call_args_list[0][0][1]
+        ops = transform.call_args_list[1][0][1]
+        self.assertEqual({'w': 200, 'max_bytes': 9000}, first_ops)
+        self.assertEqual(200, ops['w'])
+        self.assertNotIn('max_bytes', ops)
+        self.assertLess(ops['q'], DEFAULT_QUALITY_RATE)
+
+    def test_compress_quality(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        with mock.patch('transform.RENDITION_CACHE', None), \
+                mock.patch('transform.QUALITY_CACHE', MemoryCache(10)), \
+                mock.patch('transform.image_transform', wraps=image_transform) as transform:
+            first = handler(self.make_event(s3_key, {'w': '200', 'auto': 'compress'}), None)
+            #
+            # the quality is found once for each output size
+            #
+            second = handler(self.make_event(s3_key, {'w': '200', 'h': '133', 'auto': 'compress'}), None)
+        self.assertEqual(first['body'], second['body'])
+        self.assertEqual({'w': 200, 'auto': 'compress'}, transform.call_args_list[0][0][1])
+        ops = transform.call_args_list[1][0][1]
+        self.assertEqual((200, 133), (ops['w'], ops['h']))
+        self.assertLessEqual(ops['q'], DEFAULT_QUALITY_RATE)
+
+    def test_optimization_cache(self):
+        bucket, s3_key, body = self.put_image('dice.png')
+        event = self.make_event(s3_key, {'w': '100', 'auto': 'compress'})
+        with mock.patch('transform.RENDITION_CACHE', None), \
+                mock.patch('transform.OPTIMIZATION_CACHE', MemoryCache(10)), \
+                mock.patch('transform.image_transform', wraps=image_transform) as transform:
+            first = handler(event, None)
+            second = handler(event, None)
+        self.assertEqual(first['body'], second['body'])
+        self.assertIsNone(transform.call_args_list[0][0][4])
+        self.assertIsNotNone(transform.call_args_list[1][0][4])
+
+    def test_compress_no_larger(self):
+        for name in ('terminal.gif', 'dice.png'):
+            bucket, s3_key, body = self.put_image(name)
+            event = self.make_event(s3_key, {'auto': 'compress'})
+            event['headers'] = {'x-snappy-explain': '1'}
+            with mock.patch('transform.RENDITION_CACHE', None):
+                resp = handler(event, None)
+            self.assertLessEqual(len(base64_decode(resp['body'])), len(body))
+            self.assertTrue(resp['headers']['X-Snappy-Plan'].endswith('optimize(original)'))
+
+    def test_probe_cache(self):
+        bucket, s3_key, body = self.put_image('lincoln.jpg')
+        with mock.patch('transform.PROBE_CACHE', MemoryCache(10)), \
+                mock.patch('transform.probe', wraps=probe.probe) as probe_mock:
+            for width in ('10', '20'):
+                resp = handler(self.make_event(s3_key, {'w': width}), None)
+                self.assertEqual(200, resp['statusCode'])
+        #
+        # the head of the image is still probed by the admission control
+        #
+        self.assertEqual(1, [args[0] for args, kwargs in probe_mock.call_args_list].count(body))
+
 
 
 
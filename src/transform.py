@@ -2,27 +2,40 @@ import logging
 import json
 import os
 import subprocess
-import ntpath
-from copy import copy
-import tempfile
+from functools import lru_cache
+from email.utils import parsedate_to_datetime
+import mimetypes
+from urllib.parse import quote, urlencode, parse_qsl
 
 # Import our dependencies
 import vendored
-import jsonschema
-import boto3
-import magic
 from PIL import Image
-import PIL.Image
 
-from snappy import response
-from snappy.s3 import get_s3_obj, download_s3_obj
-from snappy.settings import TRANSFORMATIONS_SCHEMA, PARAM_ALIASES, LOSSY_IMAGE_FMTS, BUCKET, DEFAULT_QUALITY_RATE, AGRESSIVE_QUALITY_RATE
-from snappy.utils import rnd_str, base64_encode
-import warnings
+from snappy import response, pillow_engine
+from snappy.cache import (rendition_cache, rendition_key, source_cache, rendition_etag, source_etag, canonical_ops,
+                          MemoryCache)
+from snappy.probe import probe, exif_thumbnail, ProbeError
+from snappy.passthrough import passthrough, stripped_source
+from snappy.animation import fold_durations, frame_durations, kept_frames
+from snappy.deadline import request_deadline, degrade
+from snappy.encoders import encoder_profile, lossless
+from snappy.magick_pool import (WorkerPool, PoolError, JobTimeout, run_plan, wand_available, degraded_options, budget_option,
+                                magick_executed, profile_options, MAGICK_FILTERS)
+from snappy.plan import (compile_plan, describe_executed, explain, find, auto_options, output_size, box_factor, geometry, resample_filter, Decode, Resize, Extent, Scale, Colorspace, Strip,
+                         Similarity, Budget, Optimize, Encode)
+from snappy.s3 import get_s3_obj, head_s3_obj, get_s3_client, NotModified
+from snappy.settings import (TRANSFORMATIONS_SCHEMA, PARAM_ALIASES, LOSSY_IMAGE_FMTS, BUCKET, DEFAULT_QUALITY_RATE,
+                             TRANSFORM_ENGINE, PARAMS_CACHE_SIZE, LOG_LEVEL, WARMUP, CANONICAL_REDIRECTS, CANONICAL_REDIRECT_MAX_AGE,
+                             SIZE_BREAKPOINTS, DPR_BREAKPOINTS, MAX_IMAGE_W, MAX_IMAGE_H, PROBE_CACHE_SIZE,
+                             MAX_SOURCE_WIDTH, MAX_SOURCE_HEIGHT, MAX_SOURCE_PIXELS, MAX_SOURCE_FRAMES, OVERSIZED_IMAGES,
+                             MAGICK_POOL_SIZE, MAGICK_POOL_TIMEOUT, MAGICK_POOL_MAX_JOBS, MAGICK_POOL_MAX_RSS_MB,
+                             ANIMATION_MAX_SOURCE_PIXELS, DEGRADED_MAX_AGE, QUALITY_CACHE_SIZE, AUTO_FORMATS)
+from snappy.images import identify, make_result, normalize_format, MIME_TYPES
+from snappy.utils import base64_encode, workspace
 
 # Set up the default logger
 LOG = logging.getLogger()
-LOG.setLevel(logging.DEBUG)
+LOG.setLevel(LOG_LEVEL)
 LOG.info('Loading Lambda Function...')
 
 # Set boto logging to INFO
@@ -30,125 +43,247 @@ logging.getLogger('botocore').setLevel(logging.INFO)
 logging.getLogger('boto3').setLevel(logging.INFO)
 
 
+RENDITION_CACHE = rendition_cache()
+SOURCE_CACHE = source_cache()
+PROBE_CACHE = MemoryCache(PROBE_CACHE_SIZE)
+QUALITY_CACHE = MemoryCache(QUALITY_CACHE_SIZE)
+OPTIMIZATION_CACHE = MemoryCache(QUALITY_CACHE_SIZE)
+MAGICK_POOL = None
+
+
 class InvalidParamsError(Exception):
     pass
 
 
-def is_lossy(ext, ops):
-    return ('fm' in ops and ops['fm'] in LOSSY_IMAGE_FMTS) or ext in LOSSY_IMAGE_FMTS
+class OversizedImage(Exception):
+    """The source image is above the admission limits and they are set to reject it"""
 
 
-def size_with_dpr(size, ops):
-    if 'dpr' in ops:
-        size = (s * float(ops['dpr']) for s in size)
-    return size
+def image_transform(data, ops, info=None, degraded=(), optimization=None, source=None):
+    """
+    Transform the image content `data` using the transformations specified by `ops` (operations)
+    with the engine selected by `TRANSFORM_ENGINE`. ImageMagick is used as a fallback
+    when the Pillow engine cannot handle the image, or when an ImageMagick worker failed
+    other than by timing out. `info` is the probe of the image, if known,
+    `degraded` the cheaper choices to make to complete in time (see `snappy.deadline`)
+    and `optimization` the lossless optimization found by a previous transformation,
+    `source` the content served when the lossless optimizations do not make the output smaller.
+    Returns
+    -------
+    TransformResult
+        the transformed image
+    """
+    fallback = False
+    if TRANSFORM_ENGINE == 'pillow':
+        try:
+            return pillow_engine.image_transform(data, ops, degraded, optimization, source)
+        except Exception:
+            LOG.exception('Pillow engine failed, falling back to ImageMagick')
+            fallback = True
+    elif TRANSFORM_ENGINE == 'imagemagick-pool':
+        info = info or probe(data)
+        pool = magick_pool()
+        #
+        # the animations are left to `convert`, which transforms all their frames
+        #
+        if pool and info.frames == 1:
+            try:
+                plan = compile_plan(ops)
+                output, ext, size = pool.run(data, plan, info, degraded)
+                return make_result(output, ext, size, executed=magick_executed(plan, info, degraded))
+            except JobTimeout:
+                #
+                # `convert` would run the same job again, without a time limit, in the little time left
+                #
+                LOG.exception('ImageMagick worker timed out')
+                raise
+            except PoolError:
+                LOG.exception('ImageMagick worker failed, falling back to convert')
+                fallback = True
+
+    result = imagemagick_transform(data, ops, info, degraded)
+    if fallback:
+        result = result._replace(executed='fallback(convert) > ' + result.executed)
+    return result
 
 
-def image_transform(filename, ops):
+def magick_pool():
     """
-    Transform the image specified by `filename` using the transformations specified by `ops` (operations)
+    Get the pool of ImageMagick workers shared by all the invocations of the container
     Returns
     -------
-    str
-        the filename of the transformed image
+    WorkerPool
+        the pool or None if the MagickWand binding is not available
     """
+    global MAGICK_POOL
+    if MAGICK_POOL is None:
+        if not wand_available():
+            LOG.warning('Wand is not installed, ImageMagick workers are disabled')
+            MAGICK_POOL = False
+        else:
+            MAGICK_POOL = WorkerPool(run_plan, MAGICK_POOL_SIZE, MAGICK_POOL_TIMEOUT, MAGICK_POOL_MAX_JOBS,
+                                     MAGICK_POOL_MAX_RSS_MB * 1024 * 1024)
+    return MAGICK_POOL or None
 
-    args = ['convert', filename]
 
-    basename = ntpath.basename(filename)
-    name, ext = os.path.splitext(basename)
-    ext = ext.strip('.')
+def _geometry(width, height):
+    return '{}x{}'.format(_size(width), _size(height))
 
-    if 'w' in ops and 'h' in ops:
-        resize = (ops['w'], ops['h'])
-        resize = size_with_dpr(resize, ops)
-        new_size = '{}x{}'.format(*resize)
-        args.extend(['-resize', new_size])
-        if 'fit' in ops:
-            if ops['fit'] == 'clip':
-                #
-                # same behavior as `bounds` for compatibility, may be removed later
-                # https://github.com/caffeinetv/snappy/issues/5
-                #
-                #
-                pass
-            elif ops['fit'] == 'crop':
-                #
-                # `^` is used to resize the image based on the smallest fitting dimension
-                # then `-extents` crops exactly the image to the size specified from the center
-                #
-                args[-1] += '^'
-                args.extend(['-gravity', 'center', '-extent', new_size])
-            elif ops['fit'] == 'bounds':
-                #
-                # by default `-resize` will fit the image into the requested size
-                # and keep the original aspect ratio
-                #
-                pass
-        else:
-            #
-            # ignore the aspect ratio and distort the image so it always
-            # generates an image exactly the size specified
-            #
-            args[-1] += '!'
 
+def _size(value):
+    return '' if value is None else '{:g}'.format(value)
+
+
+def _box_args(size, stage):
     #
-    # if only `w` or `h` is provided, then we scale the target side
-    # to the specified value, and keep the aspect ratio.
-    # `fit` does not apply when only one side is given.
+    # `-scale` averages boxes of pixels, the final filter then resizes a much smaller image.
+    # The size of a JPEG scaled while read is not known, it is already reduced anyway.
     #
-    elif 'w' in ops:
-        resize = size_with_dpr((ops['w'],), ops)
-        new_size = '{}x'.format(*resize)
-        args.extend(['-resize', new_size])
-    elif 'h' in ops:
-        resize = size_with_dpr((ops['h'],), ops)
-        new_size = 'x{}'.format(*resize)
-        args.extend(['-resize', new_size])
+    factor = box_factor(size, geometry(size, stage)[0])
+    return ['-scale', '{:g}%'.format(100 / factor)] if factor > 1 else []
 
+
+def _frame_args(plan, info, durations):
     #
-    # if `dpr` is provided with no resize, then we just scale the image
+    # the frames dropped are deleted once coalesced, their duration added to the frame kept
+    # before them. `-set delay` is in hundredths of second and sets the same delay to every frame,
+    # the mean of the frames kept when they differ.
     #
-    elif 'dpr' in ops:
-        scale_factor = '{}%'.format(float(ops['dpr']) * 100)
-        args.extend(['-scale', scale_factor])
+    count = len(durations) if durations else info.frames
+    if not count:
+        return []
+    size = (info.width, info.height)
+    colorspace = find(plan, Colorspace)
+    kept = kept_frames(count, output_size(size, plan), colorspace.format if colorspace else info.format)
+    if len(kept) == count:
+        return []
+    dropped = sorted(set(range(count)) - set(kept))
+    ranges = []
+    for index in dropped:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    args = ['-delete', ','.join(str(start) if start == end else '{}-{}'.format(start, end) for start, end in ranges)]
+    if durations and len(kept) > 1:
+        folded = fold_durations(durations, kept)
+        args.extend(['-set', 'delay', str(round(sum(folded) / len(folded) / 10))])
+    return args
 
-    if 'fm' in ops:
-        #
-        # just use the format as filename extension,
-        # then IM will handle conversion automatically
-        #
-        ext = ops['fm']
 
-    if 'auto' in ops and ops['auto'] == 'compress':
-        #
-        # removes any image profile attached to the image
-        #
-        args.append('-strip')
-
-        #
-        # this will overide any existing `q` operation
-        #
-        if is_lossy(ext, ops) and 'q' not in ops:
-            new_ops = copy(ops)
-            new_ops.update({'q': AGRESSIVE_QUALITY_RATE})
-            return image_transform(filename, new_ops)
-
-    if is_lossy(ext, ops):
-        if 'q' in ops:
-            q = str(ops['q'])
-            args.extend(['-quality', q])
-        else:
-            args.extend(['-quality', str(DEFAULT_QUALITY_RATE)])
+def imagemagick_args(plan, info, degraded=(), durations=None):
+    """
+    Build the arguments of ImageMagick's `convert` executing the stages of `plan`
+    on the image probed as `info`, read from the `source` file, with the `degraded` choices.
+    The frames of an animation are selected as by the Pillow engine, with the `durations`
+    read by `snappy.animation.frame_durations`, or the number of frames of `info` if not known.
+    Returns
+    -------
+    list
+        the command line, writing the image into `output.<ext>`
+    """
+    args = ['convert', 'source']
+    size = (info.width, info.height)
+    method = resample_filter(size, plan, 'fast-filter' in degraded)
+    profile = encoder_profile(plan, info.mode, low_effort='low-effort' in degraded)
+    if MAGICK_FILTERS[method]:
+        args.extend(['-filter', MAGICK_FILTERS[method]])
+    for option, value in degraded_options(degraded):
+        args.extend(['-define', '{}={}'.format(option, value)])
+    ext = info.format
+    scaled_on_load = False
+    for stage in plan:
+        if isinstance(stage, Decode):
+            reducing_gap = 1 if 'shrink-on-load' in degraded else None
+            hint = pillow_engine.draft_size((info.width, info.height), plan, reducing_gap) if stage.shrink_on_load else None
+            if hint and ext == 'jpeg':
+                #
+                # the JPEG decoder scales the image down while reading it,
+                # when the output is much smaller than the source
+                #
+                args[1:1] = ['-define', 'jpeg:size={}x{}'.format(*hint)]
+                scaled_on_load = True
+            if info.frames != 1:
+                #
+                # the frames of an animation may only hold the area changed from the
+                # previous one, they are each made whole before being transformed
+                #
+                args.append('-coalesce')
+                args.extend(_frame_args(plan, info, durations))
+        elif isinstance(stage, Resize):
+            if method == 'fast' and not scaled_on_load:
+                args.extend(_box_args(size, stage))
+            #
+            # by default `-resize` fits the image into the requested size and keeps
+            # the aspect ratio, `!` ignores it and distorts the image so it always
+            # has exactly the size specified
+            #
+            args.extend(['-resize', _geometry(stage.width, stage.height) + ('!' if stage.fit == 'distort' else '')])
+        elif isinstance(stage, Extent):
+            #
+            # `^` is used to resize the image based on the smallest fitting dimension
+            # then `-extent` crops exactly the image to the size specified from the center
+            #
+            if method == 'fast' and not scaled_on_load:
+                args.extend(_box_args(size, stage))
+            extent = _geometry(stage.width, stage.height)
+            args.extend(['-resize', extent + '^', '-gravity', 'center', '-extent', extent])
+        elif isinstance(stage, Scale):
+            args.extend(['-scale', '{:g}%'.format(stage.factor * 100)])
+        elif isinstance(stage, Colorspace):
+            #
+            # just use the format as filename extension,
+            # then IM will handle conversion automatically
+            #
+            ext = stage.format
+        elif isinstance(stage, Strip):
+            #
+            # removes any image profile attached to the image
+            #
+            args.append('-strip')
+        elif isinstance(stage, Budget):
+            #
+            # the encoders search for the quality fitting in the budget themselves
+            #
+            option = budget_option(stage, ext)
+            if option:
+                args.extend(['-define', '{}={}'.format(*option)])
+        elif isinstance(stage, Encode):
+            if ext in ('jpg', 'jpeg'):
+                args.extend(['-interlace', 'Plane' if profile.progressive else 'None'])
+            for option, value in profile_options(profile, ext):
+                args.extend(['-define', '{}={}'.format(option, value)])
+            if ext in LOSSY_IMAGE_FMTS and not lossless(profile, ext):
+                args.extend(['-quality', str(stage.quality)])
+    if info.frames != 1 and ext == 'gif':
+        args.extend(['-layers', 'Optimize'])
+    args.append('output.' + ext)
+    return args
+
+
+def imagemagick_transform(data, ops, info=None, degraded=()):
+    """
+    Transform the image content `data` using ImageMagick's `convert`, `info` is the probe
+    of the image, which is read from `data` if not given, `degraded` the cheaper choices to make.
+    The input and output files only live in a workspace removed after the call.
+    Returns
+    -------
+    TransformResult
+        the transformed image
+    """
 
-    code, path = tempfile.mkstemp()
-    output = path + '.' + ext
-    args.append(output)
+    info = info or probe(data)
+    plan = compile_plan(ops)
+    durations = frame_durations(data) if info.frames != 1 else None
+    args = imagemagick_args(plan, info, degraded, durations)
     LOG.debug('args: {}'.format(args))
-    im_result = subprocess.check_output(args)
-    LOG.debug('IM output: {}'.format(im_result.decode()))
-
-    return output
+    with workspace() as path:
+        with open(os.path.join(path, 'source'), 'wb') as fp:
+            fp.write(data)
+        im_result = subprocess.check_output(args, cwd=path)
+        LOG.debug('IM output: {}'.format(im_result.decode()))
+        with open(os.path.join(path, args[-1]), 'rb') as fp:
+            return identify(fp.read())._replace(executed=magick_executed(plan, info, degraded))
 
 
 def normalize_params(params):
@@ -175,15 +310,64 @@ def normalize_params(params):
         if key in PARAM_ALIASES:
             key = PARAM_ALIASES[key]
 
+        #
+        # `auto` takes a comma separated list, in any order
+        #
+        if key == 'auto' and type(value) == str:
+            value = ','.join(sorted(set(v.strip() for v in value.split(','))))
+
         norm_params[key] = value
 
     return norm_params
 
 
+def compile_schema(schema):
+    """
+    Compile the properties of the `schema` into a validator function per key,
+    which converts the value from the query string into the expected type,
+    and clamps it into the `minimum` and `maximum` bounds.
+    The validators raise `ValueError` when the value cannot be used.
+    Returns
+    -------
+    dict
+        the validator function for each key
+    """
+    validators = {}
+    for key, prop in schema['properties'].items():
+        validators[key] = _compile_property(prop)
+    return validators
+
+
+def _compile_property(prop):
+    convert = {'integer': int, 'number': float}.get(prop.get('type'))
+    enum = prop.get('enum')
+    minimum = prop.get('minimum')
+    maximum = prop.get('maximum')
+
+    def validate(value):
+        if convert:
+            value = convert(value)
+            if value != value:
+                raise ValueError('NaN is not a valid value')
+        if enum is not None and value not in enum:
+            raise ValueError('{} is not one of {}'.format(value, enum))
+        if minimum is not None and value < minimum:
+            return minimum
+        if maximum is not None and value > maximum:
+            return maximum
+        return value
+
+    return validate
+
+
+PARAM_VALIDATORS = compile_schema(TRANSFORMATIONS_SCHEMA)
+
+
 def param_validation(params):
     """
     Normalize and validate the params.
     It silently removes the invalid or not supported operations.
+    The result is memoized, so repeated query strings are validated only once.
     Returns
     -------
     dict
@@ -191,61 +375,180 @@ def param_validation(params):
     """
     norm_params = {}
     if any(params):
+        try:
+            items = tuple(sorted(params.items()))
+            hash(items)
+        except TypeError:
+            return _param_validation(params)
+        norm_params = dict(_cached_param_validation(items))
 
-        norm_params = normalize_params(params)
+    return norm_params
 
-        tmp_params = copy(norm_params)
 
-        #
-        # convert all values to the expected type,
-        # as all params comes from the query string
-        #
-        properties = TRANSFORMATIONS_SCHEMA['properties']
-        for k, v in tmp_params.items():
-            if k in properties and 'type' in properties[k]:
-                try:
+@lru_cache(maxsize=PARAMS_CACHE_SIZE)
+def _cached_param_validation(items):
+    return tuple(_param_validation(dict(items)).items())
 
-                    k_type = properties[k]['type']
-                    if k_type == 'integer':
-                        norm_params[k] = int(v)
-                    elif k_type == 'number':
-                        norm_params[k] = float(v)
-                except ValueError:
-                    LOG.warning('Cannot convert to {} to {}'.format(v, k_type))
-                    norm_params.pop(k)
 
-        #
-        # validate logic of certain operations altogether
-        #
-        tmp_params = copy(norm_params)
+def _param_validation(params):
+    norm_params = {}
 
-        for k, v in tmp_params.items():
-            try:
-                item = {k: v}
-                jsonschema.validate(item, TRANSFORMATIONS_SCHEMA)
-            except jsonschema.ValidationError as ve:
-                LOG.warning('Error validating schema for {}'.format(item))
-                if ve.validator == 'maximum' or ve.validator == 'minimum':
-                    new_value = ve.validator_value
-                    norm_params[k] = new_value
-                else:
-                    norm_params.pop(k)
+    for k, v in normalize_params(params).items():
+        if k not in PARAM_VALIDATORS:
+            norm_params[k] = v
+            continue
+        try:
+            norm_params[k] = PARAM_VALIDATORS[k](v)
+        except (TypeError, ValueError):
+            LOG.warning('Error validating schema for {}'.format({k: v}))
+
+    if 'fit' in norm_params and not ('w' in norm_params or 'h' in norm_params):
+        LOG.warning('`fit` is valid only for resize operations')
+        norm_params.pop('fit')
+
+    if 'q' in norm_params and 'fm' in norm_params and norm_params['fm'] not in LOSSY_IMAGE_FMTS:
+        LOG.warning(
+            'Cannot set `quality` with non-lossy formats: {}'.format(norm_params['fm']))
+        norm_params.pop('q')
+
+    if 'max_bytes' in norm_params and 'fm' in norm_params and norm_params['fm'] not in LOSSY_IMAGE_FMTS:
+        LOG.warning(
+            'Cannot set `max_bytes` with non-lossy formats: {}'.format(norm_params['fm']))
+        norm_params.pop('max_bytes')
 
-        if 'fit' in norm_params and not ('w' in norm_params or 'h' in norm_params):
-            LOG.warning('`fit` is valid only for resize operations')
-            norm_params.pop('fit')
+    return norm_params
 
-        if 'q' in norm_params and 'fm' in norm_params and norm_params['fm'] not in LOSSY_IMAGE_FMTS:
-            LOG.warning(
-                'Cannot set `quality` with non-lossy formats: {}'.format(norm_params['fm']))
-            norm_params.pop('q')
 
-    return norm_params
+def validation_headers(s3_obj, ops):
+    """
+    Build the caching and validation headers of the rendition of `s3_obj` with the operations `ops`
+    Returns
+    -------
+    dict
+        the `ETag`, `Last-Modified`, `Cache-Control` and `Vary` headers
+    """
+    headers = {}
+    if s3_obj.etag:
+        headers['ETag'] = rendition_etag(s3_obj.etag, ops)
+    if s3_obj.last_modified:
+        headers['Last-Modified'] = response.http_date(s3_obj.last_modified)
+    if s3_obj.cache_control:
+        headers['Cache-Control'] = s3_obj.cache_control
+    if 'format' in auto_options(ops):
+        headers['Vary'] = 'Accept'
+    return headers
+
+
+def _breakpoint(value, breakpoints):
+    #
+    # the smallest breakpoint not below `value`, or `value` itself above the last one
+    #
+    for bp in sorted(breakpoints):
+        if bp >= value:
+            return bp
+    return value
 
 
-def make_response(output_img, s3_source_key):
+def canonicalize_ops(ops):
     """
-    Build HTTP response for the transformed image.
+    Drop the operations which have no effect and round the sizes up to the configured breakpoints.
+    When both `w` and `h` are given, `h` is scaled with `w` to keep the requested aspect ratio.
+    Returns
+    -------
+    dict
+        the canonical operations
+    """
+    canonical = dict(ops)
+
+    if canonical.get('dpr') == 1:
+        canonical.pop('dpr')
+    elif 'dpr' in canonical and DPR_BREAKPOINTS:
+        canonical['dpr'] = _breakpoint(canonical['dpr'], DPR_BREAKPOINTS)
+
+    #
+    # an explicit quality makes WebP lossy (see `snappy.encoders`), it is only a default value
+    # when the output is in another format, that of the source is not known yet
+    #
+    if canonical.get('q') == DEFAULT_QUALITY_RATE and 'compress' not in auto_options(canonical) \
+            and canonical.get('fm') not in (None, 'webp'):
+        canonical.pop('q')
+
+    if not any(key in canonical for key in ('w', 'h', 'dpr')):
+        canonical.pop('resample', None)
+
+    if SIZE_BREAKPOINTS:
+        if 'w' in canonical:
+            w = min(_breakpoint(canonical['w'], SIZE_BREAKPOINTS), MAX_IMAGE_W)
+            if 'h' in canonical:
+                canonical['h'] = max(1, min(int(canonical['h'] * w / canonical['w'] + 0.5), MAX_IMAGE_H))
+            canonical['w'] = w
+        elif 'h' in canonical:
+            canonical['h'] = min(_breakpoint(canonical['h'], SIZE_BREAKPOINTS), MAX_IMAGE_H)
+
+    return canonical
+
+
+def _query_value(value):
+    if isinstance(value, float):
+        return '{:g}'.format(value)
+    return str(value)
+
+
+def query_items(event, raw_ops):
+    """
+    Returns
+    -------
+    list
+        the `(name, value)` pairs of the query string of the request, in their order
+    """
+    if event.get('rawQueryString') is not None:
+        return parse_qsl(event['rawQueryString'], keep_blank_values=True)
+    #
+    # the parameters of a REST API event are listed in the order of the query string
+    #
+    return [(k, _query_value(v)) for k, v in raw_ops.items()]
+
+
+def request_path(event):
+    """
+    Returns
+    -------
+    str
+        the path requested by the client, which starts with the stage of the API
+        or the base path of its custom domain, unlike the `path` of the event
+    """
+    path = (event.get('requestContext') or {}).get('path') or ''
+    #
+    # the request context of a test invocation has the path of the resource instead
+    #
+    return path if path.endswith(event['path']) else event['path']
+
+
+def canonical_redirect(event, raw_ops, ops):
+    """
+    Build the redirect to the canonical query string of the request, see `canonicalize_ops`,
+    its parameters are sorted so each rendition has a single URL
+    Returns
+    -------
+    dict
+        the 301 response or None if the request is already canonical
+    """
+    canonical = sorted((k, _query_value(v)) for k, v in canonicalize_ops(ops).items())
+    if canonical == query_items(event, raw_ops):
+        return None
+    location = quote(request_path(event))
+    if canonical:
+        location += '?' + urlencode(canonical, quote_via=quote)
+    LOG.info('Redirecting to the canonical {}'.format(location))
+    headers = {'Cache-Control': 'public, max-age={}'.format(CANONICAL_REDIRECT_MAX_AGE)}
+    return response.moved_permanently(location, headers)
+
+
+def make_response(result, s3_obj, ops=None, degraded=()):
+    """
+    Build HTTP response for the transformed image `result`. A rendition `degraded` to complete
+    in time is only cached for a short time and its ETag is weak, so the next requests are not
+    revalidated against it and get the full rendition.
     Returns
     -------
     dict
@@ -253,17 +556,37 @@ def make_response(output_img, s3_source_key):
     """
     status_code = 200
     kwargs = {'isBase64Encoded': True}
-    s3_obj = get_s3_obj(BUCKET, s3_source_key)
-    mime = magic.Magic(mime=True)
-    headers = {'Content-Type': mime.from_file(output_img)}
-    if s3_obj.cache_control:
-        headers.update({'Cache-Control': s3_obj.cache_control})
-    with open(output_img, 'rb') as fp:
-        bs64_str = base64_encode(fp.read())
+    headers = {'Content-Type': result.mime_type}
+    headers.update(validation_headers(s3_obj, ops or {}))
+    if degraded:
+        headers['X-Snappy-Degraded'] = ', '.join(degraded)
+        headers['Cache-Control'] = 'public, max-age={}'.format(DEGRADED_MAX_AGE)
+        if 'ETag' in headers:
+            headers['ETag'] = 'W/' + headers['ETag']
+    bs64_str = base64_encode(result.data)
 
     return response.generic(status_code=status_code, body=bs64_str, headers=headers, **kwargs)
 
 
+def make_head_response(s3_key, s3_obj, ops):
+    """
+    Build HTTP response for a HEAD request, from the metadata of the source only.
+    Returns
+    -------
+    dict
+        the full response dict as expected by APIGateway/Lambda Proxy
+    """
+    if 'fm' in ops:
+        content_type = MIME_TYPES[normalize_format(ops['fm'])]
+    elif s3_obj.content_type and s3_obj.content_type.startswith('image/'):
+        content_type = s3_obj.content_type
+    else:
+        content_type = mimetypes.guess_type(s3_key)[0] or 'application/octet-stream'
+    headers = {'Content-Type': content_type}
+    headers.update(validation_headers(s3_obj, ops))
+    return response.generic(status_code=200, body='', headers=headers)
+
+
 def parse_event(event):
     s3_key = event['pathParameters']['proxy']
     raw_ops = event['queryStringParameters']
@@ -271,20 +594,232 @@ def parse_event(event):
         raw_ops = {}
     return s3_key, raw_ops
 
-def is_valid_image(filename):
-    img = None
-    warnings.filterwarnings('error')
-    try:
-        img = Image.open(filename)
-        img.verify()
+
+def get_header(event, name):
+    """
+    Returns
+    -------
+    str
+        the value of the request header `name`, whatever its case, or None
+    """
+    headers = event.get('headers') or {}
+    name = name.lower()
+    for k, v in headers.items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def accepted_types(event):
+    """
+    Returns
+    -------
+    set
+        the media types listed in the `Accept` header of the request, except the ones with `q=0`
+    """
+    types = set()
+    for item in (get_header(event, 'Accept') or '').split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    LOG.warning('Invalid Accept weight: {}'.format(param))
+        if media_type and weight > 0:
+            types.add(media_type.lower())
+    return types
+
+
+def negotiate_format(event, ops):
+    """
+    Choose the output format for `auto=format` from the `Accept` header of the request,
+    the first of the `AUTO_FORMATS` accepted by the client, or the format of the source.
+    A format set with `fm` is kept as is.
+    Returns
+    -------
+    dict
+        the operations with the negotiated format, which is part of the rendition cache key and ETag
+    """
+    if 'format' not in auto_options(ops) or 'fm' in ops:
+        return ops
+    accepted = accepted_types(event)
+    for fmt in AUTO_FORMATS:
+        if MIME_TYPES[normalize_format(fmt)] in accepted:
+            LOG.debug('Negotiated format: {}'.format(fmt))
+            return dict(ops, fm=fmt)
+    return ops
+
+
+def parse_conditions(event, ops):
+    """
+    Translate the conditional headers of the request into conditions on the source object.
+    `If-Modified-Since` is ignored when `If-None-Match` is present.
+    Returns
+    -------
+    dict
+        the `etag` and `modified_since` conditions for `get_s3_obj`
+    """
+    conditions = {}
+    if_none_match = get_header(event, 'If-None-Match')
+    if_modified_since = get_header(event, 'If-Modified-Since')
+    if if_none_match:
+        for etag in if_none_match.split(','):
+            etag = '*' if etag.strip() == '*' else source_etag(etag, ops)
+            if etag:
+                conditions['etag'] = etag
+                break
+    elif if_modified_since:
+        try:
+            conditions['modified_since'] = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            LOG.warning('Invalid If-Modified-Since: {}'.format(if_modified_since))
+    return conditions
+
+def probe_image(s3_key, s3_obj):
+    """
+    Probe the header of the image in `s3_obj`, the probes are kept in memory
+    by key and ETag, so a source is only parsed once per container
+    Returns
+    -------
+    ImageInfo
+        the probe of the image, or None if it is not a supported image
+    """
+    cache_key = (s3_key, s3_obj.etag)
+    info = PROBE_CACHE.get(cache_key)
+    if info is None:
+        try:
+            info = probe(s3_obj.body)
+        except ProbeError:
+            LOG.exception('Not valid image')
+            info = False
+        PROBE_CACHE.put(cache_key, info)
+    return info or None
+
+
+def is_admitted(info):
+    """
+    Check the size of the image probed as `info` against the admission limits,
+    `OversizedImage` is raised if oversized images are rejected
+    Returns
+    -------
+    bool
+        True if the image can be transformed
+    """
+    if (info.width <= MAX_SOURCE_WIDTH and info.height <= MAX_SOURCE_HEIGHT
+            and info.width * info.height <= MAX_SOURCE_PIXELS and (info.frames or 1) <= MAX_SOURCE_FRAMES
+            and (info.frames or 1) * info.width * info.height <= ANIMATION_MAX_SOURCE_PIXELS):
         return True
-    except Exception as e:
-        LOG.exception('Not valid image')
-        return False
-    finally:
-        warnings.resetwarnings()
-        if img:
-            img.close()
+    LOG.warning('Image of {}x{} with {} frames is too large to be transformed'.format(info.width, info.height,
+                                                                                      info.frames))
+    if OVERSIZED_IMAGES == 'reject':
+        raise OversizedImage('{}x{}'.format(info.width, info.height))
+    return False
+
+
+def thumbnail_for(head, info, ops):
+    """
+    Find the EXIF thumbnail in the first bytes `head` of the JPEG probed as `info`, when it
+    is large enough for the operations `ops`. The thumbnail has no ICC profile nor EXIF data,
+    so it is only used when they are removed by `auto=compress`.
+    Returns
+    -------
+    bytes
+        the thumbnail to transform instead of the image, or None
+    """
+    if info.format != 'jpeg' or 'compress' not in auto_options(ops):
+        return None
+    thumbnail = exif_thumbnail(head)
+    if not thumbnail:
+        return None
+    try:
+        thumbnail_info = probe(thumbnail)
+    except ProbeError:
+        return None
+
+    #
+    # some cameras letterbox the thumbnail, its aspect ratio must be the one of the image
+    #
+    if abs(thumbnail_info.height - info.height * thumbnail_info.width / info.width) > 1:
+        return None
+    resize, crop = pillow_engine.resize_geometry((info.width, info.height), ops)
+    if resize[0] > thumbnail_info.width or resize[1] > thumbnail_info.height:
+        return None
+    return thumbnail
+
+
+def cached_rendition(s3_key, etag, ops):
+    """
+    Returns
+    -------
+    bytes
+        the cached rendition of the operations `ops` on the source `s3_key` at `etag`, or None
+    """
+    if not any(ops) or not RENDITION_CACHE:
+        return None
+    return RENDITION_CACHE.get(rendition_key(s3_key, etag, ops))
+
+
+class SourceHead(object):
+    """
+    Check the first bytes of a source image before the rest of it is downloaded,
+    as `check_head` for `get_s3_obj`. `rendition` is set when the rendition of the
+    operations `ops` on the image `s3_key` is cached, and `thumbnail` when the embedded
+    thumbnail of the image is enough for `ops`, either is used instead of the whole image.
+    `checked` is set once the first bytes are checked.
+    """
+
+    def __init__(self, s3_key, ops):
+        self.s3_key = s3_key
+        self.ops = ops
+        self.checked = False
+        self.rendition = None
+        self.thumbnail = None
+
+    def __call__(self, head, etag):
+        self.checked = True
+        #
+        # the ETag of the first bytes is enough to find the rendition
+        #
+        self.rendition = cached_rendition(self.s3_key, etag, self.ops)
+        if self.rendition is not None:
+            return self.rendition
+        try:
+            info = probe(head)
+        except ProbeError:
+            #
+            # the header may go past `head`, the whole image is checked once downloaded
+            #
+            return None
+        #
+        # the thumbnail of an oversized image can still be transformed
+        #
+        self.thumbnail = thumbnail_for(head, info, self.ops)
+        if self.thumbnail is None:
+            is_admitted(info)
+        else:
+            LOG.info('Using the {} bytes EXIF thumbnail of the image'.format(len(self.thumbnail)))
+        return self.thumbnail
+
+
+def is_valid_image(data, info=None):
+    """
+    Check the image content `data` can be transformed, from its header only.
+    `info` is the probe of the image, which is read from `data` if not given.
+    Returns
+    -------
+    bool
+        False if the image is not supported, corrupt or oversized
+    """
+    if info is None:
+        try:
+            info = probe(data)
+        except ProbeError:
+            LOG.exception('Not valid image')
+            return False
+    return is_admitted(info)
 
 
 def print_im_resources():
@@ -292,38 +827,166 @@ def print_im_resources():
     im_result = subprocess.check_output(args)
     LOG.debug('\n{}'.format(im_result.decode()))
 
+def search_key(s3_key, s3_obj, info, ops):
+    """
+    Build the key of the quality searched for by the engine for the operations `ops` on the image
+    in `s3_obj` probed as `info`: the one fitting in `max_bytes` depends on all the operations,
+    the one similar enough to the image only on the output format and size
+    Returns
+    -------
+    tuple
+        the key or None if there is no quality to search for
+    """
+    if 'max_bytes' in ops:
+        return s3_key, s3_obj.etag, canonical_ops(ops)
+    plan = compile_plan(ops)
+    fmt = normalize_format(find(plan, Encode).format or info.format)
+    if find(plan, Similarity) is not None and fmt in LOSSY_IMAGE_FMTS:
+        return s3_key, s3_obj.etag, fmt, output_size((info.width, info.height), plan)
+    return None
+
+
+def render(s3_key, s3_obj, ops, thumbnail=False, deadline=None, lookup=True):
+    """
+    Apply the operations `ops` to the source image in `s3_obj`, whose body is
+    the EXIF thumbnail of the source image when `thumbnail` is set. The transformation
+    is degraded when it would not complete before the `deadline` (see `snappy.deadline`).
+    The rendition cache is not looked up again when `lookup` is False.
+    Returns
+    -------
+    tuple
+        the TransformResult, the description of what was executed to get it
+        and the degradations made to complete in time
+    """
+    cache_key = rendition_key(s3_key, s3_obj.etag, ops) if any(ops) and RENDITION_CACHE else None
+    cached_img = cached_rendition(s3_key, s3_obj.etag, ops) if lookup else None
+    if cached_img is not None:
+        return identify(cached_img), 'rendition-cache', ()
+
+    info = probe(s3_obj.body) if thumbnail else probe_image(s3_key, s3_obj)
+    if not info:
+        return identify(s3_obj.body), 'original', ()
+    if not any(ops) or not is_valid_image(s3_obj.body, info):
+        return make_result(s3_obj.body, info.format, (info.width, info.height)), 'original', ()
+
+    data = passthrough(s3_obj.body, info, ops)
+    if data is not None:
+        LOG.info('The transformations do not change the image, skipping them')
+        executed = 'passthrough > strip' if data is not s3_obj.body else 'passthrough'
+        return make_result(data, info.format, (info.width, info.height)), executed, ()
+
+    #
+    # once found, the quality searched for is used as is
+    #
+    quality_key = search_key(s3_key, s3_obj, info, ops)
+    quality = quality_key and QUALITY_CACHE.get(quality_key)
+    if quality:
+        ops = dict(ops, q=quality)
+        ops.pop('max_bytes', None)
+
+    plan = compile_plan(ops)
+    LOG.debug('plan: {}'.format(explain(plan)))
+    degraded = degrade(info, plan, deadline)
+    if 'original' in degraded:
+        return make_result(s3_obj.body, info.format, (info.width, info.height)), 'original', degraded
+
+    optimization_key = (s3_key, s3_obj.etag, canonical_ops(ops)) if find(plan, Optimize) is not None else None
+    optimization = optimization_key and OPTIMIZATION_CACHE.get(optimization_key)
+    source = stripped_source(s3_obj.body, info, ops) if optimization_key else None
+    result = image_transform(s3_obj.body, ops, info, degraded, optimization, source)
+    #
+    # the degraded renditions are not cached, the next request may have the time to do better
+    #
+    if cache_key and not degraded:
+        RENDITION_CACHE.put(cache_key, result.data)
+    if quality_key and result.quality:
+        QUALITY_CACHE.put(quality_key, result.quality)
+    if optimization_key and result.optimization:
+        OPTIMIZATION_CACHE.put(optimization_key, result.optimization)
+    #
+    # the engines describe the stages they ran, preceded by the choices made before them
+    #
+    executed = [result.executed]
+    if degraded:
+        executed.insert(0, describe_executed('degraded', *degraded))
+    if quality:
+        executed.insert(0, describe_executed('quality-cache', quality))
+    if thumbnail:
+        executed.insert(0, 'exif-thumbnail')
+    return result, ' > '.join(executed), degraded
+
+
 def handler(event, context):
+    deadline = request_deadline(context)
 
-    LOG.debug(json.dumps(event, indent=2))
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug(json.dumps(event, indent=2))
     LOG.debug("Using %s bucket", BUCKET)
     try:
         # Do HTTP handling
         method = event['httpMethod']
-        if method == 'GET':
+        if method in ('GET', 'HEAD'):
             s3_key, raw_ops = parse_event(event)
             if not s3_key:
                 return response.not_found()
-            source_filename = download_s3_obj(BUCKET, s3_key)
-            if source_filename:
-                if is_valid_image(source_filename):
-                    ops = param_validation(raw_ops)
-                    if any(ops):
-                        output_img = image_transform(source_filename, ops)
-                    else:
-                        output_img = source_filename
+            ops = param_validation(raw_ops)
+            if CANONICAL_REDIRECTS:
+                redirect = canonical_redirect(event, raw_ops, ops)
+                if redirect:
+                    return redirect
+            ops = negotiate_format(event, ops)
+            conditions = parse_conditions(event, ops)
+
+            try:
+                if method == 'HEAD':
+                    s3_obj = head_s3_obj(BUCKET, s3_key, **conditions)
                 else:
-                    output_img = source_filename
-                
-                return make_response(output_img, s3_key)
+                    source_head = SourceHead(s3_key, ops) if any(ops) else None
+                    s3_obj = get_s3_obj(BUCKET, s3_key, SOURCE_CACHE, check_head=source_head, **conditions)
+            except NotModified as e:
+                return response.not_modified(validation_headers(e.s3_obj, ops))
+            if not s3_obj:
+                return response.not_found()
+            if method == 'HEAD':
+                return make_head_response(s3_key, s3_obj, ops)
 
+            if source_head is not None and source_head.rendition is not None:
+                result, executed, degraded = identify(source_head.rendition), 'rendition-cache', ()
             else:
-                return response.not_found()
+                checked = source_head is not None and source_head.checked
+                thumbnail = source_head is not None and source_head.thumbnail is not None
+                result, executed, degraded = render(s3_key, s3_obj, ops, thumbnail, deadline, not checked)
+            LOG.debug('executed: {}'.format(executed))
+            resp = make_response(result, s3_obj, ops, degraded)
+            if get_header(event, 'X-Snappy-Explain'):
+                resp['headers']['X-Snappy-Plan'] = executed
+            return resp
         else:
             return response.method_not_allowed()
+    except OversizedImage as e:
+        return response.unprocessable({'_image': ['the image is too large to be transformed: {}'.format(e)]})
     except Exception:
         LOG.exception("Unexpected error while processing request")
         return response.internal_server_error()
     
 
 
+def warmup():
+    """
+    Build the expensive singletons once, while the Lambda is initialized,
+    instead of during the first request
+    """
+    get_s3_client()
+    #
+    # load all the Pillow plugins, otherwise they are loaded
+    # the first time a format other than the most common ones is used
+    #
+    Image.init()
+    if TRANSFORM_ENGINE == 'imagemagick-pool' and magick_pool():
+        magick_pool().start()
+
+
+if WARMUP:
+    warmup()
+
 LOG.info('Loaded successfully')